@@ -14,6 +14,11 @@ class Config:
     RABBITMQ_PASSWORD = os.getenv('RABBITMQ_PASSWORD', 'guest')
     RABBITMQ_VHOST = os.getenv('RABBITMQ_VHOST', '/')
 
+    # RabbitMQ连接池配置
+    RABBITMQ_HEARTBEAT = int(os.getenv('RABBITMQ_HEARTBEAT', 60))  # 心跳间隔（秒）
+    RABBITMQ_POOL_SIZE = int(os.getenv('RABBITMQ_POOL_SIZE', 4))  # 同步连接池大小
+    RABBITMQ_CHANNEL_POOL_SIZE = int(os.getenv('RABBITMQ_CHANNEL_POOL_SIZE', 8))  # 异步发布通道池大小
+
     # 构图服务队列配置
     # 服务1: 基础构图服务
     COMPOSE_SERVICE_1_QUEUE = os.getenv('COMPOSE_SERVICE_1_QUEUE', 'compose.service.basic')
@@ -23,6 +28,35 @@ class Config:
     COMPOSE_SERVICE_2_QUEUE = os.getenv('COMPOSE_SERVICE_2_QUEUE', 'compose.service.advanced')
     COMPOSE_SERVICE_2_RESULT_QUEUE = os.getenv('COMPOSE_SERVICE_2_RESULT_QUEUE', 'compose.service.advanced.result')
 
+    # 死信配置：过期（超过截止时间仍未被消费）或被 Server 拒绝的任务转入死信队列
+    DEAD_LETTER_EXCHANGE = os.getenv('RABBITMQ_DEAD_LETTER_EXCHANGE', 'compose.dlx')
+    DEAD_LETTER_QUEUE = os.getenv('RABBITMQ_DEAD_LETTER_QUEUE', 'compose.dead')
+    DEAD_LETTER_TTL = int(os.getenv('RABBITMQ_DEAD_LETTER_TTL', 86400))  # 死信保留时间（秒）
+
+    # 取消通知：客户端断开后向该 fanout 交换机广播被取消的 task_id，Server 据此跳过任务
+    CANCEL_EXCHANGE = os.getenv('RABBITMQ_CANCEL_EXCHANGE', 'compose.cancel')
+    DISCONNECT_POLL_INTERVAL = float(os.getenv('DISCONNECT_POLL_INTERVAL', 1))  # 等待结果时检查客户端断开的间隔（秒）
+    SSE_CANCEL_GRACE = float(os.getenv('SSE_CANCEL_GRACE', 5))  # SSE 连接在任务结束前关闭后，等待客户端改为轮询的时间（秒），超时未查询则取消任务
+
+    # 任务优先级配置（0 为最低，数值越大越先处理）
+    TASK_MAX_PRIORITY = int(os.getenv('TASK_MAX_PRIORITY', 10))  # 任务队列支持的最高优先级
+    TASK_PRIORITY_INTERACTIVE = int(os.getenv('TASK_PRIORITY_INTERACTIVE', 5))  # 单个提交（用户在等待结果）
+    TASK_PRIORITY_BATCH = int(os.getenv('TASK_PRIORITY_BATCH', 1))  # 批量提交
+    # 指定用户的优先级（VIP 展位、付费用户等），格式: user_id:优先级，逗号分隔；批量提交时同样生效
+    TASK_PRIORITY_USERS = {
+        item.split(':', 1)[0].strip(): int(item.split(':', 1)[1])
+        for item in os.getenv('TASK_PRIORITY_USERS', '').split(',') if ':' in item
+    }
+
+    # 任务队列声明参数（Client 与 Server 必须一致，已存在的队列参数不一致时只做被动声明）
+    TASK_QUEUE_ARGUMENTS = {
+        'x-dead-letter-exchange': DEAD_LETTER_EXCHANGE,
+        'x-max-priority': TASK_MAX_PRIORITY
+    }
+
+    # 兼容旧版 Server：同时订阅共享结果队列（新版 Server 按 reply_to 回传结果，无需开启）
+    CONSUME_SHARED_RESULT_QUEUE = os.getenv('RABBITMQ_CONSUME_SHARED_RESULT_QUEUE', 'false').lower() == 'true'
+
     # 队列映射配置
     QUEUE_CONFIG = {
         'basic': {
@@ -39,5 +73,53 @@ class Config:
     APP_HOST = os.getenv('APP_HOST', 'localhost')
     APP_PORT = 8005
 
-    # 任务超时配置
-    TASK_TIMEOUT = 180  # 秒
+    # 任务超时配置：同时作为任务截止时间和消息过期时间，超时后消息不再投递给 Server
+    TASK_TIMEOUT = int(os.getenv('TASK_TIMEOUT', 180))  # 秒
+
+    # 批量提交单次最多任务数
+    BATCH_MAX_JOBS = int(os.getenv('BATCH_MAX_JOBS', 50))
+
+    # 结果缓存配置（相同图片 + 提示词 + 示例图直接返回缓存结果）
+    RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', 'true').lower() == 'true'
+    RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', 86400))  # 有效期（秒）
+    RESULT_CACHE_MAX_SIZE = int(os.getenv('RESULT_CACHE_MAX_SIZE', 1000))  # 内存层最大条目数
+    RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', '')  # 磁盘层目录，为空时不启用
+    RESULT_CACHE_DISK_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_DISK_MAX_ENTRIES', 10000))  # 磁盘层最大条目数
+    # 不缓存的风格（需要每次生成不同结果），逗号分隔
+    RESULT_CACHE_EXCLUDED_STYLES = [
+        style.strip() for style in os.getenv('RESULT_CACHE_EXCLUDED_STYLES', '').split(',') if style.strip()
+    ]
+
+    # 任务存储配置（异步模式查询结果）
+    TASK_STORE_TTL = int(os.getenv('TASK_STORE_TTL', 3600))  # 记录保留时间（秒）
+    TASK_STORE_MAX_SIZE = int(os.getenv('TASK_STORE_MAX_SIZE', 10000))  # 最大记录数
+
+    # 人脸/头发分割池配置（参考图遮罩处理）
+    SEGMENTER_POOL_SIZE = int(os.getenv('SEGMENTER_POOL_SIZE', min(4, os.cpu_count() or 1)))  # 分割器实例数
+    SEGMENTER_MAX_PENDING = int(os.getenv('SEGMENTER_MAX_PENDING', 32))  # 排队 + 处理中的最大任务数
+    SEGMENTER_MASK_MAX_SIDE = int(os.getenv('SEGMENTER_MASK_MAX_SIDE', 512))  # 计算遮罩时的最大边长，0 表示原图尺寸
+
+    # 参考图遮罩缓存配置（同一参考图只做一次遮罩处理和上传）
+    MASK_CACHE_ENABLED = os.getenv('MASK_CACHE_ENABLED', 'true').lower() == 'true'
+    MASK_CACHE_TTL = int(os.getenv('MASK_CACHE_TTL', 86400))  # 有效期（秒），不应超过 COS 临时文件夹的生命周期
+    MASK_CACHE_MAX_SIZE = int(os.getenv('MASK_CACHE_MAX_SIZE', 500))  # 内存层最大条目数
+    MASK_CACHE_DIR = os.getenv('MASK_CACHE_DIR', '')  # 磁盘层目录，为空时不启用
+    MASK_CACHE_DISK_MAX_ENTRIES = int(os.getenv('MASK_CACHE_DISK_MAX_ENTRIES', 1000))  # 磁盘层最大条目数
+
+    # 图片下载配置（共享连接池）
+    DOWNLOAD_POOL_SIZE = int(os.getenv('DOWNLOAD_POOL_SIZE', 100))  # 总连接数上限
+    DOWNLOAD_LIMIT_PER_HOST = int(os.getenv('DOWNLOAD_LIMIT_PER_HOST', 16))  # 单主机连接数上限
+    DOWNLOAD_TIMEOUT = int(os.getenv('DOWNLOAD_TIMEOUT', 30))  # 总超时（秒）
+    DOWNLOAD_CONNECT_TIMEOUT = int(os.getenv('DOWNLOAD_CONNECT_TIMEOUT', 5))  # 连接超时（秒）
+    DOWNLOAD_MAX_BYTES = int(os.getenv('DOWNLOAD_MAX_BYTES', 20 * 1024 * 1024))  # 响应体大小上限（字节）
+
+    # 公平调度配置：已发送到 RabbitMQ 且未完成的任务数上限，其余任务按用户在本地排队，0 表示不启用
+    SCHEDULER_MAX_INFLIGHT = int(os.getenv('SCHEDULER_MAX_INFLIGHT', 32))
+
+    # 准入控制配置（超过阈值时返回 429，阈值为 0 表示不检查该项）
+    ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'true').lower() == 'true'
+    ADMISSION_MAX_QUEUE_DEPTH = int(os.getenv('ADMISSION_MAX_QUEUE_DEPTH', 200))  # 任务队列最大积压消息数
+    ADMISSION_MAX_INFLIGHT = int(os.getenv('ADMISSION_MAX_INFLIGHT', 500))  # 本进程最大在途任务数（含公平调度器中本地排队的任务）
+    ADMISSION_MAX_LOOP_LAG = float(os.getenv('ADMISSION_MAX_LOOP_LAG', 0.5))  # 事件循环最大延迟（秒）
+    ADMISSION_SAMPLE_INTERVAL = float(os.getenv('ADMISSION_SAMPLE_INTERVAL', 2))  # 队列深度采样间隔（秒）
+    ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', 10))  # 建议客户端重试间隔（秒）
@@ -3,16 +3,27 @@ FastAPI主应用 - Client层
 支持多个构图服务
 """
 
-from fastapi import FastAPI, Request, HTTPException, UploadFile, File
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, Request, HTTPException, UploadFile, File, Form
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+import asyncio
+import json
 import logging
 import time
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 from services.service_factory import ServiceFactory
+from services.async_producer import async_producer
+from services.task_store import task_store, TaskStatus
+from services.result_cache import result_cache, build_fingerprint
+from services.single_flight import single_flight
+from services.http_client import image_downloader
+from services.admission import admission_controller, AdmissionRejected
+from services.fair_scheduler import fair_scheduler, client_address
 from services.cos_service import cos_service
-from services.anonymize_faces import anonymize_faces_with_hair
+from services.anonymize_faces import anonymize_faces_with_hair, masked_reference_cache, start_masking
 from config import Config
 
 
@@ -26,13 +37,85 @@ app = FastAPI(
     version="2.0.0"
 )
 
-# 添加允许摄像头访问的中间件
-@app.middleware("http")
-async def add_camera_permission_headers(request: Request, call_next):
-    response = await call_next(request)
-    # 添加允许摄像头访问的响应头
-    response.headers["Permissions-Policy"] = "camera=(self), microphone=(self)"
-    return response
+@app.on_event("startup")
+async def startup():
+    """启动时建立RabbitMQ长连接，启动事件循环延迟监测和公平调度"""
+    admission_controller.start()
+    fair_scheduler.start()
+    if not await async_producer.connect():
+        logger.warning("RabbitMQ暂不可用，将在首次提交任务时重试连接")
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """关闭时释放RabbitMQ连接、图片下载会话和上传线程池"""
+    await admission_controller.stop()
+    await fair_scheduler.stop()
+    await async_producer.close()
+    await image_downloader.close()
+    cos_service.close()
+
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    """准入控制拒绝时返回 429，并提示客户端重试间隔"""
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
+class CameraPermissionMiddleware:
+    """
+    添加允许摄像头访问的响应头
+
+    使用纯 ASGI 中间件而不是 @app.middleware("http")：后者会包装 receive，
+    接口中的 request.is_disconnected() 无法感知客户端断开，同步模式的任务就不会被取消
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message: Message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers["Permissions-Policy"] = "camera=(self), microphone=(self)"
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
+class ClientAddressMiddleware:
+    """
+    记录当前请求的客户端地址，公平调度器据此区分未提供 user_id 的匿名请求
+
+    部署在反向代理后时需让 uvicorn 信任代理的 X-Forwarded-For（--forwarded-allow-ips），
+    否则所有请求的客户端地址都是代理地址
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not scope.get("client"):
+            await self.app(scope, receive, send)
+            return
+
+        token = client_address.set(scope["client"][0])
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            client_address.reset(token)
+
+
+app.add_middleware(CameraPermissionMiddleware)
+app.add_middleware(ClientAddressMiddleware)
 
 # 挂载静态文件和模板
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -69,13 +152,26 @@ async def health_check():
     }
 
 
+def prefetch_reference(image_url: str, purpose: Optional[str]):
+    """上传用途为参考图时，在后台提前开始面部和头发遮罩处理"""
+    if purpose != "reference":
+        return
+    try:
+        start_masking(image_url)
+        logger.info(f"已提前开始参考图遮罩处理: {image_url}")
+    except Exception as e:
+        logger.warning(f"提前开始参考图遮罩处理失败: {image_url}, {e}")
+
+
 @app.post("/api/upload/image")
-async def upload_image(file: UploadFile = File(...)):
+async def upload_image(file: UploadFile = File(...), purpose: Optional[str] = Form(None)):
     """
     上传图片到腾讯云COS
 
     参数：
     - file: 图片文件
+    - purpose: 图片用途 (可选)，为 reference 时立即在后台开始参考图遮罩处理，
+      之后的构图请求直接等待处理结果
 
     Returns:
         - success: 是否成功
@@ -92,7 +188,7 @@ async def upload_image(file: UploadFile = File(...)):
 
         # 上传文件到COS
         logger.info("开始上传到COS...")
-        upload_result = cos_service.upload_file(file, folder='temp')
+        upload_result = await cos_service.aupload_file(file, folder='temp')
 
         logger.info(f"COS上传结果: {upload_result}")
 
@@ -103,6 +199,7 @@ async def upload_image(file: UploadFile = File(...)):
 
         # 返回上传结果
         logger.info(f"上传成功，URL: {upload_result['data']['url']}")
+        prefetch_reference(upload_result['data']['url'], purpose)
         return {
             "success": True,
             "url": upload_result['data']['url']
@@ -115,53 +212,152 @@ async def upload_image(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=f"上传失败: {str(e)}")
 
 
-@app.post("/api/basic/compose")
-async def submit_basic_compose(task_data: Dict[str, Any]):
+@app.post("/api/upload/presign")
+async def presign_upload(task_data: Dict[str, Any]):
     """
-    提交基础构图任务
+    获取浏览器直传 COS 的预签名 URL
+
+    浏览器使用返回的 upload_url 和 headers 直接 PUT 到 COS，完成后调用 /api/upload/complete
 
     参数：
-    - image_url: 基础图像URL (必填)
-    - style_type: 特效风格类型 (style1, style2, style3, style4, style5, style6) (可选)
-    - user_id: 用户ID (可选)
+    - filename: 文件名 (必填)
+    - size: 文件大小（字节）(必填)，参与签名，上传的文件必须与之一致
+    - content_type: 文件类型 (可选，默认按扩展名推断)
+
+    Returns:
+        - upload_url: 预签名上传URL
+        - headers: 上传时必须携带的请求头（Content-Length 由浏览器按请求体设置）
+        - key: 对象路径（完成回调时提交）
+        - url: 上传完成后的访问URL
+        - expires_in: 有效期（秒）
     """
-    try:
-        # 验证必填参数
-        if not task_data.get("image_url"):
-            raise HTTPException(status_code=400, detail="image_url参数不能为空")
+    filename = task_data.get("filename")
+    if not filename:
+        raise HTTPException(status_code=400, detail="必须提供filename参数")
 
-        # 获取风格类型
-        style_type = task_data.get("style_type")
-        image_url = task_data.get("image_url")
-        user_id = task_data.get("user_id", "anonymous")
+    content_type = task_data.get("content_type")
+    if content_type and not content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="只支持图片文件上传")
 
-        # 根据风格类型设置不同参数
-        prompt = ""
-        example_image_url = None
+    size = task_data.get("size")
+    if not isinstance(size, int) or isinstance(size, bool):
+        raise HTTPException(status_code=400, detail="必须提供size参数（文件字节数）")
 
-        #新年烟花
-        if style_type == "new_year_style":
-            # 风格1参数配置
-            prompt = "请勿以任何方式修改原始照片。保持原始图像完全不变，包括主体、背景、光线、色彩、视角和整体构图。原始主体必须保持逼真且未被改动。仅使用上传的图像作为身份和环境的唯一来源。精确保留主体、相机角度构图、天际线、建筑物、灯光、地平线和构图。不要修改或风格化背景或天际线。仅在现有天空中添加烟花。添加超逼真、专业的新年前夜烟花，其规模和效果与纽约真实的烟花相匹配。使用物理上精确的烟火（菊花、垂柳、棕榈、噼啪作响的金色爆发），具有层次感、逼真的烟雾、薄雾、渐逝的余烬和微妙的天空照明。通过协调的空中烟花编排形成“2026”，而非火花棒或霓虹文字。这些数字应醒目、清晰、远距离可辨，采用明亮的白色和香槟金，自然地融入天空，带有逼真的烟雾和消散效果。匹配原始的寒冷冬夜光线。颜色限制为白色、金色以及微妙的红色或蓝色点缀。不要过度饱和，也不要给建筑物或主体添加光晕。让烟花位于主体后方和上方，避免重叠。不要改变天际线轮廓或视角。风格：超逼真、电影感但自然、高动态范围。禁用：天际线变化、地标改动、火花棒书写、霓虹文字、卡通效果、奇幻色彩、夸张的光晕或人工智能塑料质感。"
-            example_image_url = None
+    presign_result = cos_service.create_presigned_upload(filename, size, content_type)
+    if not presign_result.get('success'):
+        status_code = 400 if presign_result.get('code') != 'COS_ERROR' else 500
+        raise HTTPException(status_code=status_code, detail=presign_result.get('error'))
 
-        elif style_type == "winter_four_frame_grid":
-            # 风格2参数配置
-            prompt = ("创建一个逼真的 2×2 单人照片网格拼贴画，四幅画面中均为同一位年轻亚裔女性。所有画面中的面部特征、脸型、皮肤质感、发型和身份必须 100% "
-                      "一致，不能有任何变化。主题：圣诞冬季人像，沉浸式降雪氛围，高端工作室时尚摄影。主体：年轻亚裔女性（20-23 "
-                      "岁），面容精致优雅，拥有大而有神的双眼皮眼睛、高颧骨，肌肤白皙如瓷，质感真实，毛孔清晰可见。妆容（重要 —— "
-                      "精致冬日妆容）：冬日轻薄透亮的妆容风格。底妆通透干净，带有自然光泽。脸颊上淡淡晕染着柔和细腻的粉色腮红。淡雅的裸粉色眼影，妆面干净。极细的内眼线修饰眼型，毫无厚重感。睫毛自然卷曲，根根分明，精致动人。"
-                      "水润有光泽的玫瑰豆沙色 / 柔和淡紫色唇釉，质地柔软水润。整体妆容显得清新、优雅且高端。发型（重要 —— 自然动感）：齐肩深棕色头发，带有柔和的蓬松度和自然的垂坠感。几缕纤细的发丝被冬日微风轻轻吹起。"
-                      "一些散落的发丝轻柔地拂过脸颊和下颌线附近。头发的动感显得微妙、可控且自然 —— 绝不凌乱，也不过分夸张。服装（所有画面保持一致）：鲜红色粗针织无边便帽，鲜红色粗羊毛围巾（质感优良，尽显高级），黑色羊毛大衣。"
-                      "帽子的针织纹路、围巾的褶皱、发丝、肩膀和大衣表面都明显积有雪花。背景与氛围（重要）：高调明亮的白色工作室背景，干净且富有光泽。纯白色调，带有柔和的光晕，无灰色调、无渐变、无纹理。在明亮的背景下，雪花依然清晰可见。"
-                      "雪景与氛围：大量多层次的雪花布满整个场景。前景是大片柔软的雪花，主体周围是中等大小的雪花，背景则是细小的飘雪。雪花缓缓飘落，有些略带动态模糊，柔和地反射着光线。"
-                      "光线与氛围：专业工作室柔光照明，以清冷的冬日自然光为基调，脸部带有微妙的温暖高光。光线均匀，对比度柔和，皮肤过渡自然，无刺眼阴影。营造出干净、明亮、通透且优雅的冬日氛围。相机与画质：85 毫米人像镜头效果，浅景深（f/1.8–2.8）。高分辨率，超逼真的皮肤细节，高端时尚人像质感，色彩平衡精致自然。2×2 画面构图：左上：近距离工作室人像。女性轻轻将红色围巾拢在唇边附近，直视镜头。几缕纤细的发丝轻柔地划过脸颊。雪花从镜头前飘过，增添了层次感。表情温暖而优雅。右上：侧颜人像。女性微微抬头望向飘落的雪花。微风拂起脸部附近的几缕发丝，更添柔美与动感。左下：正面人像，头上举着一把红色雨伞。伞沿堆积着雪花。头发保持整齐，仅脸颊附近有微妙的动感。目光平静而沉稳。右下：四分之三侧面人像。女性身体微微转动，轻轻触碰着围巾。一抹温柔的微笑，几缕散落的发丝拂过脸庞，营造出自然而亲切的冬日感觉。")
-            example_image_url = None
+    return {"success": True, **presign_result['data']}
+
+
+@app.post("/api/upload/complete")
+async def complete_upload(task_data: Dict[str, Any]):
+    """
+    浏览器直传完成回调
+
+    只检查对象大小和图片文件头，超过存储尺寸时才下载缩放；校验失败的对象会被删除
+
+    参数：
+    - key: /api/upload/presign 返回的对象路径 (必填)
+    - purpose: 图片用途 (可选)，为 reference 时立即在后台开始参考图遮罩处理
+
+    Returns:
+        - success: 是否成功
+        - url: 图片访问URL
+    """
+    remote_key = task_data.get("key")
+    if not remote_key:
+        raise HTTPException(status_code=400, detail="必须提供key参数")
+
+    complete_result = await cos_service.acomplete_direct_upload(remote_key)
+    if not complete_result.get('success'):
+        status_code = 400 if complete_result.get('code') in ('INVALID_KEY', 'INVALID_FILE') else 500
+        raise HTTPException(status_code=status_code, detail=complete_result.get('error'))
+
+    prefetch_reference(complete_result['data']['url'], task_data.get("purpose"))
+
+    return {
+        "success": True,
+        "url": complete_result['data']['url']
+    }
 
-        #宽幅拍立得
-        elif style_type == "wide_format_instant_camera":
-            # 风格3参数配置
-            prompt = """
+
+async def build_compose_fingerprint(service_type: str, task_data: Dict[str, Any],
+                                    image_urls: List[str], **params) -> Optional[str]:
+    """
+    生成构图任务的内容指纹，用于结果缓存
+
+    图片按内容（上传MD5或COS ETag）识别，无法识别时使用URL本身。
+    缓存关闭、请求指定 no_cache 或风格在排除列表中时返回 None。
+
+    Args:
+        service_type: 服务类型 (basic, advanced)
+        task_data: 请求参数
+        image_urls: 参与计算的图片URL（输入图、示例图等）
+        params: 其他参与计算的参数（提示词、构图类型等）
+
+    Returns:
+        str: 任务指纹，不使用缓存时返回 None
+    """
+    if not Config.RESULT_CACHE_ENABLED or task_data.get("no_cache"):
+        return None
+    if task_data.get("style_type") in Config.RESULT_CACHE_EXCLUDED_STYLES:
+        return None
+
+    async def identify(url: Optional[str]) -> Optional[str]:
+        if not url:
+            return None
+        try:
+            content_id = await cos_service.aget_content_id(url)
+        except Exception as e:
+            logger.warning(f"获取图片内容标识失败: {url}, {e}")
+            content_id = None
+        return content_id or url
+
+    image_ids = await asyncio.gather(*[identify(url) for url in image_urls])
+    return build_fingerprint(service_type, image_ids, params)
+
+
+async def resolve_basic_style(task_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    根据风格类型解析基础构图任务参数
+
+    Args:
+        task_data: 请求参数（style_type, reference_image 等）
+
+    Returns:
+        Dict: 包含 prompt 和 example_image_url
+    """
+    style_type = task_data.get("style_type")
+
+    # 根据风格类型设置不同参数
+    prompt = ""
+    example_image_url = None
+
+    #新年烟花
+    if style_type == "new_year_style":
+        # 风格1参数配置
+        prompt = "请勿以任何方式修改原始照片。保持原始图像完全不变，包括主体、背景、光线、色彩、视角和整体构图。原始主体必须保持逼真且未被改动。仅使用上传的图像作为身份和环境的唯一来源。精确保留主体、相机角度构图、天际线、建筑物、灯光、地平线和构图。不要修改或风格化背景或天际线。仅在现有天空中添加烟花。添加超逼真、专业的新年前夜烟花，其规模和效果与纽约真实的烟花相匹配。使用物理上精确的烟火（菊花、垂柳、棕榈、噼啪作响的金色爆发），具有层次感、逼真的烟雾、薄雾、渐逝的余烬和微妙的天空照明。通过协调的空中烟花编排形成“2026”，而非火花棒或霓虹文字。这些数字应醒目、清晰、远距离可辨，采用明亮的白色和香槟金，自然地融入天空，带有逼真的烟雾和消散效果。匹配原始的寒冷冬夜光线。颜色限制为白色、金色以及微妙的红色或蓝色点缀。不要过度饱和，也不要给建筑物或主体添加光晕。让烟花位于主体后方和上方，避免重叠。不要改变天际线轮廓或视角。风格：超逼真、电影感但自然、高动态范围。禁用：天际线变化、地标改动、火花棒书写、霓虹文字、卡通效果、奇幻色彩、夸张的光晕或人工智能塑料质感。"
+        example_image_url = None
+
+    elif style_type == "winter_four_frame_grid":
+        # 风格2参数配置
+        prompt = ("创建一个逼真的 2×2 单人照片网格拼贴画，四幅画面中均为同一位年轻亚裔女性。所有画面中的面部特征、脸型、皮肤质感、发型和身份必须 100% "
+                  "一致，不能有任何变化。主题：圣诞冬季人像，沉浸式降雪氛围，高端工作室时尚摄影。主体：年轻亚裔女性（20-23 "
+                  "岁），面容精致优雅，拥有大而有神的双眼皮眼睛、高颧骨，肌肤白皙如瓷，质感真实，毛孔清晰可见。妆容（重要 —— "
+                  "精致冬日妆容）：冬日轻薄透亮的妆容风格。底妆通透干净，带有自然光泽。脸颊上淡淡晕染着柔和细腻的粉色腮红。淡雅的裸粉色眼影，妆面干净。极细的内眼线修饰眼型，毫无厚重感。睫毛自然卷曲，根根分明，精致动人。"
+                  "水润有光泽的玫瑰豆沙色 / 柔和淡紫色唇釉，质地柔软水润。整体妆容显得清新、优雅且高端。发型（重要 —— 自然动感）：齐肩深棕色头发，带有柔和的蓬松度和自然的垂坠感。几缕纤细的发丝被冬日微风轻轻吹起。"
+                  "一些散落的发丝轻柔地拂过脸颊和下颌线附近。头发的动感显得微妙、可控且自然 —— 绝不凌乱，也不过分夸张。服装（所有画面保持一致）：鲜红色粗针织无边便帽，鲜红色粗羊毛围巾（质感优良，尽显高级），黑色羊毛大衣。"
+                  "帽子的针织纹路、围巾的褶皱、发丝、肩膀和大衣表面都明显积有雪花。背景与氛围（重要）：高调明亮的白色工作室背景，干净且富有光泽。纯白色调，带有柔和的光晕，无灰色调、无渐变、无纹理。在明亮的背景下，雪花依然清晰可见。"
+                  "雪景与氛围：大量多层次的雪花布满整个场景。前景是大片柔软的雪花，主体周围是中等大小的雪花，背景则是细小的飘雪。雪花缓缓飘落，有些略带动态模糊，柔和地反射着光线。"
+                  "光线与氛围：专业工作室柔光照明，以清冷的冬日自然光为基调，脸部带有微妙的温暖高光。光线均匀，对比度柔和，皮肤过渡自然，无刺眼阴影。营造出干净、明亮、通透且优雅的冬日氛围。相机与画质：85 毫米人像镜头效果，浅景深（f/1.8–2.8）。高分辨率，超逼真的皮肤细节，高端时尚人像质感，色彩平衡精致自然。2×2 画面构图：左上：近距离工作室人像。女性轻轻将红色围巾拢在唇边附近，直视镜头。几缕纤细的发丝轻柔地划过脸颊。雪花从镜头前飘过，增添了层次感。表情温暖而优雅。右上：侧颜人像。女性微微抬头望向飘落的雪花。微风拂起脸部附近的几缕发丝，更添柔美与动感。左下：正面人像，头上举着一把红色雨伞。伞沿堆积着雪花。头发保持整齐，仅脸颊附近有微妙的动感。目光平静而沉稳。右下：四分之三侧面人像。女性身体微微转动，轻轻触碰着围巾。一抹温柔的微笑，几缕散落的发丝拂过脸庞，营造出自然而亲切的冬日感觉。")
+        example_image_url = None
+
+    #宽幅拍立得
+    elif style_type == "wide_format_instant_camera":
+        # 风格3参数配置
+        prompt = """
                         一张横向宽幅的宝丽来照片，采用风景 orientation。一个单独的宽幅宝丽来相框内，
                         有两张人像照片水平并排放置在同一个相框中。这张宝丽来照片的宽度明显大于高度，
                         类似于复古的宽幅即时胶片格式。
@@ -209,12 +405,12 @@ async def submit_basic_compose(task_data: Dict[str, Any]):
                         没有文字、没有标识、没有水印。
                         不锐利、不清晰，呈现出真实的即时照片质感。
                     """
-            example_image_url = None
+        example_image_url = None
 
-        #2026雪地图
-        elif style_type == "style4":
-            # 风格4参数配置
-            prompt = """
+    #2026雪地图
+    elif style_type == "style4":
+        # 风格4参数配置
+        prompt = """
             生成一张俯视视角的雪地照片。
 
             从线描的角度先提取图中的主体角色线条轮廓，
@@ -241,12 +437,12 @@ async def submit_basic_compose(task_data: Dict[str, Any]):
             高清，近景拍摄，
             真实细腻的雪地质感。
 """
-            example_image_url = None
+        example_image_url = None
 
-        # 卡通涂鸦
-        elif style_type == "doodle_subject":
-            # 风格5参数配置
-            prompt = """
+    # 卡通涂鸦
+    elif style_type == "doodle_subject":
+        # 风格5参数配置
+        prompt = """
             基于原始图像，将整个场景制作成带有手绘卡通风格叠加层的混合媒体插画。
 
             根据原始图像中的现有元素，
@@ -269,39 +465,92 @@ async def submit_basic_compose(task_data: Dict[str, Any]):
             整体风格应给人以有趣、年轻和轻快的感觉，
             类似于叠加在真实照片上的手绘涂鸦。
             """
-            example_image_url = None
+        example_image_url = None
 
-        # 换装体验
-        elif style_type == "selfie_living":
-            # 风格6参数配置
-            prompt = """
+    # 换装体验
+    elif style_type == "selfie_living":
+        # 风格6参数配置
+        prompt = """
             保持图1人物五官不变，保持图1人物相似性，参考图2的姿势、服装、角度、景别、构图和光影。
             不同姿势和表情，景别（近景，特写，中景，仰视等），俯视平视等镜头，生成1张图。
             """
 
-            # 获取参考图片URL
-            reference_image_url = task_data.get("reference_image")
+        # 获取参考图片URL
+        reference_image_url = task_data.get("reference_image")
+
+        # 强制进行面部和头发遮罩处理
+        if reference_image_url:
+            logger.info(f"开始对服装图片进行面部和头发遮罩处理: {reference_image_url}")
+            try:
+                example_image_url = await anonymize_faces_with_hair(reference_image_url)
+                logger.info(f"面部和头发遮罩处理完成，处理后的URL: {example_image_url}")
+            except Exception as e:
+                logger.error(f"面部和头发遮罩处理失败: {e}", exc_info=True)
+                # 如果处理失败，使用原始URL
+                example_image_url = reference_image_url
+                logger.warning("面部和头发遮罩处理失败，使用原始图片URL")
+        else:
+            example_image_url = None
+
+    return {
+        "prompt": prompt,
+        "example_image_url": example_image_url
+    }
 
-            # 强制进行面部和头发遮罩处理
-            if reference_image_url:
-                logger.info(f"开始对服装图片进行面部和头发遮罩处理: {reference_image_url}")
-                try:
-                    example_image_url = await anonymize_faces_with_hair(reference_image_url)
-                    logger.info(f"面部和头发遮罩处理完成，处理后的URL: {example_image_url}")
-                except Exception as e:
-                    logger.error(f"面部和头发遮罩处理失败: {e}", exc_info=True)
-                    # 如果处理失败，使用原始URL
-                    example_image_url = reference_image_url
-                    logger.warning("面部和头发遮罩处理失败，使用原始图片URL")
-            else:
-                example_image_url = None
+
+@app.post("/api/basic/compose")
+async def submit_basic_compose(task_data: Dict[str, Any], request: Request):
+    """
+    提交基础构图任务（同步模式下客户端断开时取消任务）
+
+    参数：
+    - image_url: 基础图像URL (必填)
+    - style_type: 特效风格类型 (style1, style2, style3, style4, style5, style6) (可选)
+    - user_id: 用户ID (可选，未提供时按客户端地址区分)
+    - async_mode: 为 true 时立即返回 task_id，结果通过 /api/tasks/{task_id} 查询 (可选)
+    - no_cache: 为 true 时不使用结果缓存，强制重新生成 (可选)
+    """
+    try:
+        # 验证必填参数
+        if not task_data.get("image_url"):
+            raise HTTPException(status_code=400, detail="image_url参数不能为空")
+
+        # 获取参数
+        image_url = task_data.get("image_url")
+        user_id = task_data.get("user_id", "anonymous")
+
+        # 根据风格类型设置不同参数
+        style_params = await resolve_basic_style(task_data)
+        prompt = style_params["prompt"]
+        example_image_url = style_params["example_image_url"]
+
+        # 内容指纹：相同图片 + 提示词 + 示例图直接返回缓存结果
+        fingerprint = await build_compose_fingerprint(
+            "basic", task_data, [image_url, example_image_url], prompt=prompt
+        )
+
+        # 异步模式：提交后立即返回任务ID
+        if task_data.get("async_mode"):
+            task_id = await ServiceFactory.dispatch_basic_task(
+                prompt=prompt,
+                image_url=image_url,
+                example_image_url=example_image_url,
+                user_id=user_id,
+                fingerprint=fingerprint
+            )
+            return {
+                "success": True,
+                "data": {"task_id": task_id, "status": "queued"}
+            }
 
         # 使用服务工厂提交任务
-        result = ServiceFactory.submit_basic_task(
+        result = await ServiceFactory.asubmit_basic_task(
             prompt=prompt,
             image_url=image_url,
             example_image_url=example_image_url,
-            user_id=user_id
+            user_id=user_id,
+            fingerprint=fingerprint,
+            is_disconnected=request.is_disconnected
         )
 
         if result is None:
@@ -312,23 +561,185 @@ async def submit_basic_compose(task_data: Dict[str, Any]):
             "data": result
         }
 
-    except HTTPException:
+    except (HTTPException, AdmissionRejected):
         raise
     except Exception as e:
         logger.error(f"提交基础构图任务失败: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"提交任务失败: {str(e)}")
 
 
+def _get_batch_jobs(task_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """校验并返回批量请求中的任务列表"""
+    jobs = task_data.get("jobs")
+    if not isinstance(jobs, list) or not jobs:
+        raise HTTPException(status_code=400, detail="jobs参数必须是非空数组")
+    if len(jobs) > Config.BATCH_MAX_JOBS:
+        raise HTTPException(status_code=400, detail=f"单次最多提交 {Config.BATCH_MAX_JOBS} 个任务")
+    return jobs
+
+
+def _batch_response(task_ids: List[str], stream: bool):
+    """
+    构建批量提交的响应
+
+    stream 为 false 时立即返回任务ID列表；为 true 时以 NDJSON 流逐条返回完成的任务结果
+    """
+    if not stream:
+        return {
+            "success": True,
+            "data": {
+                "tasks": [
+                    {"index": index, "task_id": task_id, "status": "queued"}
+                    for index, task_id in enumerate(task_ids)
+                ]
+            }
+        }
+
+    async def wait_one(index: int, task_id: str):
+        record = await task_store.wait_final(task_id, timeout=Config.TASK_TIMEOUT)
+        return index, task_id, record
+
+    async def result_stream():
+        for finished in asyncio.as_completed([wait_one(i, t) for i, t in enumerate(task_ids)]):
+            index, task_id, record = await finished
+            line = {
+                "index": index,
+                "task_id": task_id,
+                "status": record['status'] if record else "timeout",
+                "data": record['result'] if record else None,
+                "error": record['error'] if record else "任务处理超时"
+            }
+            yield json.dumps(line, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(result_stream(), media_type="application/x-ndjson")
+
+
+@app.post("/api/basic/compose/batch")
+async def submit_basic_compose_batch(task_data: Dict[str, Any]):
+    """
+    批量提交基础构图任务（同一通道流水线发布）
+
+    参数：
+    - jobs: 任务列表，每项包含 image_url (必填)、style_type、reference_image、user_id、no_cache (可选)
+    - user_id: 默认用户ID (可选，未提供时按客户端地址区分)
+    - stream: 为 true 时以 NDJSON 流逐条返回完成的结果，否则立即返回任务ID列表 (可选)
+    """
+    try:
+        jobs = _get_batch_jobs(task_data)
+        default_user_id = task_data.get("user_id", "anonymous")
+
+        for index, job in enumerate(jobs):
+            if not isinstance(job, dict) or not job.get("image_url"):
+                raise HTTPException(status_code=400, detail=f"第 {index} 个任务的image_url参数不能为空")
+
+        # 并发解析各任务的风格参数（参考图遮罩处理可并行）
+        style_params_list = await asyncio.gather(*[resolve_basic_style(job) for job in jobs])
+        fingerprints = await asyncio.gather(*[
+            build_compose_fingerprint(
+                "basic", job, [job["image_url"], style_params["example_image_url"]],
+                prompt=style_params["prompt"]
+            )
+            for job, style_params in zip(jobs, style_params_list)
+        ])
+
+        task_ids = await ServiceFactory.dispatch_basic_batch([
+            {
+                "prompt": style_params["prompt"],
+                "image_url": job["image_url"],
+                "example_image_url": style_params["example_image_url"],
+                "user_id": job.get("user_id", default_user_id),
+                "fingerprint": fingerprint
+            }
+            for job, style_params, fingerprint in zip(jobs, style_params_list, fingerprints)
+        ])
+
+        return _batch_response(task_ids, task_data.get("stream", False))
+
+    except (HTTPException, AdmissionRejected):
+        raise
+    except Exception as e:
+        logger.error(f"批量提交基础构图任务失败: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"提交任务失败: {str(e)}")
+
+
+def resolve_advanced_style(style_type: str) -> Dict[str, Any]:
+    """
+    根据风格类型解析高级构图任务参数
+
+    Args:
+        style_type: 特效风格类型
+
+    Returns:
+        Dict: 包含 prompt, example_image_url, composition_type 和 layout
+    """
+    # 根据风格类型设置不同参数
+    prompt = ""
+    example_image_url = None
+    composition_type = "grid"
+    layout = {}
+
+    if style_type == "style1":
+        # 风格1参数配置
+        prompt = ""
+        example_image_url = None
+        composition_type = "grid"
+        layout = {}
+
+    elif style_type == "style2":
+        # 风格2参数配置
+        prompt = ""
+        example_image_url = None
+        composition_type = "grid"
+        layout = {}
+
+    elif style_type == "style3":
+        # 风格3参数配置
+        prompt = ""
+        example_image_url = None
+        composition_type = "grid"
+        layout = {}
+
+    elif style_type == "style4":
+        # 风格4参数配置
+        prompt = ""
+        example_image_url = None
+        composition_type = "grid"
+        layout = {}
+
+    elif style_type == "style5":
+        # 风格5参数配置
+        prompt = ""
+        example_image_url = None
+        composition_type = "grid"
+        layout = {}
+
+    elif style_type == "style6":
+        # 风格6参数配置
+        prompt = ""
+        example_image_url = None
+        composition_type = "grid"
+        layout = {}
+
+    return {
+        "prompt": prompt,
+        "example_image_url": example_image_url,
+        "composition_type": composition_type,
+        "layout": layout
+    }
+
+
 @app.post("/api/advanced/compose")
-async def submit_advanced_compose(task_data: Dict[str, Any]):
+async def submit_advanced_compose(task_data: Dict[str, Any], request: Request):
     """
-    提交高级构图任务
+    提交高级构图任务（同步模式下客户端断开时取消任务）
 
     参数：
     - images: 图像列表，每个元素包含 url 和 weight (可选)
     - image_url: 单张图像URL (可选，与images二选一)
     - style_type: 特效风格类型 (style1, style2, style3, style4, style5, style6) (可选)
-    - user_id: 用户ID (可选)
+    - user_id: 用户ID (可选，未提供时按客户端地址区分)
+    - async_mode: 为 true 时立即返回 task_id，结果通过 /api/tasks/{task_id} 查询 (可选)
+    - no_cache: 为 true 时不使用结果缓存，强制重新生成 (可选)
     """
     try:
         # 支持两种模式：images数组 或 单张image_url
@@ -343,62 +754,50 @@ async def submit_advanced_compose(task_data: Dict[str, Any]):
         user_id = task_data.get("user_id", "anonymous")
 
         # 根据风格类型设置不同参数
-        prompt = ""
-        example_image_url = None
-        composition_type = "grid"
-        layout = {}
-
-        if style_type == "style1":
-            # 风格1参数配置
-            prompt = ""
-            example_image_url = None
-            composition_type = "grid"
-            layout = {}
-
-        elif style_type == "style2":
-            # 风格2参数配置
-            prompt = ""
-            example_image_url = None
-            composition_type = "grid"
-            layout = {}
-
-        elif style_type == "style3":
-            # 风格3参数配置
-            prompt = ""
-            example_image_url = None
-            composition_type = "grid"
-            layout = {}
-
-        elif style_type == "style4":
-            # 风格4参数配置
-            prompt = ""
-            example_image_url = None
-            composition_type = "grid"
-            layout = {}
-
-        elif style_type == "style5":
-            # 风格5参数配置
-            prompt = ""
-            example_image_url = None
-            composition_type = "grid"
-            layout = {}
+        style_params = resolve_advanced_style(style_type)
+        prompt = style_params["prompt"]
+        example_image_url = style_params["example_image_url"]
+        composition_type = style_params["composition_type"]
+        layout = style_params["layout"]
+
+        # 内容指纹：相同图片 + 参数直接返回缓存结果
+        fingerprint = await build_compose_fingerprint(
+            "advanced", task_data,
+            [image_url, example_image_url] + [image.get("url") for image in images or []],
+            prompt=prompt,
+            weights=[image.get("weight") for image in images or []],
+            composition_type=composition_type,
+            layout=layout
+        )
 
-        elif style_type == "style6":
-            # 风格6参数配置
-            prompt = ""
-            example_image_url = None
-            composition_type = "grid"
-            layout = {}
+        # 异步模式：提交后立即返回任务ID
+        if task_data.get("async_mode"):
+            task_id = await ServiceFactory.dispatch_advanced_task(
+                prompt=prompt,
+                images=images,
+                image_url=image_url,
+                example_image_url=example_image_url,
+                composition_type=composition_type,
+                layout=layout,
+                user_id=user_id,
+                fingerprint=fingerprint
+            )
+            return {
+                "success": True,
+                "data": {"task_id": task_id, "status": "queued"}
+            }
 
         # 使用服务工厂提交任务
-        result = ServiceFactory.submit_advanced_task(
+        result = await ServiceFactory.asubmit_advanced_task(
             prompt=prompt,
             images=images,
             image_url=image_url,
             example_image_url=example_image_url,
             composition_type=composition_type,
             layout=layout,
-            user_id=user_id
+            user_id=user_id,
+            fingerprint=fingerprint,
+            is_disconnected=request.is_disconnected
         )
 
         if result is None:
@@ -409,13 +808,68 @@ async def submit_advanced_compose(task_data: Dict[str, Any]):
             "data": result
         }
 
-    except HTTPException:
+    except (HTTPException, AdmissionRejected):
         raise
     except Exception as e:
         logger.error(f"提交高级构图任务失败: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"提交任务失败: {str(e)}")
 
 
+@app.post("/api/advanced/compose/batch")
+async def submit_advanced_compose_batch(task_data: Dict[str, Any]):
+    """
+    批量提交高级构图任务（同一通道流水线发布）
+
+    参数：
+    - jobs: 任务列表，每项包含 images 或 image_url (必填)、style_type、user_id、no_cache (可选)
+    - user_id: 默认用户ID (可选，未提供时按客户端地址区分)
+    - stream: 为 true 时以 NDJSON 流逐条返回完成的结果，否则立即返回任务ID列表 (可选)
+    """
+    try:
+        jobs = _get_batch_jobs(task_data)
+        default_user_id = task_data.get("user_id", "anonymous")
+
+        for index, job in enumerate(jobs):
+            if not isinstance(job, dict) or (not job.get("images") and not job.get("image_url")):
+                raise HTTPException(status_code=400, detail=f"第 {index} 个任务必须提供images或image_url参数")
+
+        style_params_list = [resolve_advanced_style(job.get("style_type")) for job in jobs]
+        # 并发计算各任务的内容指纹（每张图片可能需要查询 COS）
+        fingerprints = await asyncio.gather(*[
+            build_compose_fingerprint(
+                "advanced", job,
+                [job.get("image_url"), style_params["example_image_url"]]
+                + [image.get("url") for image in job.get("images") or []],
+                prompt=style_params["prompt"],
+                weights=[image.get("weight") for image in job.get("images") or []],
+                composition_type=style_params["composition_type"],
+                layout=style_params["layout"]
+            )
+            for job, style_params in zip(jobs, style_params_list)
+        ])
+
+        task_ids = await ServiceFactory.dispatch_advanced_batch([
+            {
+                "prompt": style_params["prompt"],
+                "images": job.get("images"),
+                "image_url": job.get("image_url"),
+                "composition_type": style_params["composition_type"],
+                "layout": style_params["layout"],
+                "example_image_url": style_params["example_image_url"],
+                "user_id": job.get("user_id", default_user_id),
+                "fingerprint": fingerprint
+            }
+            for job, style_params, fingerprint in zip(jobs, style_params_list, fingerprints)
+        ])
+        return _batch_response(task_ids, task_data.get("stream", False))
+
+    except (HTTPException, AdmissionRejected):
+        raise
+    except Exception as e:
+        logger.error(f"批量提交高级构图任务失败: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"提交任务失败: {str(e)}")
+
+
 @app.get("/api/services")
 async def get_services():
     """获取所有可用服务信息"""
@@ -425,15 +879,142 @@ async def get_services():
     }
 
 
+@app.get("/api/metrics")
+async def get_metrics():
+    """获取运行指标"""
+    return {
+        "result_cache": result_cache.stats(),
+        "single_flight": single_flight.stats(),
+        "masked_reference_cache": masked_reference_cache.stats(),
+        "admission": admission_controller.stats(),
+        "cancellations": async_producer.cancel_stats(),
+        "scheduler": fair_scheduler.stats(),
+        "pending_tasks": async_producer.pending_count
+    }
+
+
 @app.get("/api/tasks/{task_id}")
 async def get_task_result(task_id: str):
     """
-    获取任务结果（预留接口，用于异步模式）
+    获取任务结果（异步模式）
+
+    Returns:
+        - task_id: 任务ID
+        - status: 任务状态 (queued, done, failed, timeout, cancelled)
+        - data: 任务结果（完成后返回）
     """
+    record = task_store.get(task_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+
+    # 客户端改为轮询，不再取消
+    _keep_task(task_id)
+
     return {
         "task_id": task_id,
-        "status": "not_implemented"
+        "status": record['status'],
+        "data": record['result'],
+        "error": record['error'],
+        "progress": record['progress']
+    }
+
+
+def _format_task_event(record: Dict[str, Any]) -> str:
+    """将任务记录格式化为 SSE 事件"""
+    payload = {
+        "task_id": record['task_id'],
+        "status": record['status'],
+        "data": record['result'],
+        "error": record['error'],
+        "progress": record['progress']
     }
+    return f"event: {record['status']}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+# SSE 连接在任务结束前关闭的任务：task_id -> 延迟取消的定时器
+_orphaned_tasks: Dict[str, asyncio.TimerHandle] = {}
+# 进行中的取消任务，持有引用避免被垃圾回收
+_orphan_cancellations = set()
+
+
+def _keep_task(task_id: str):
+    """客户端重新订阅或轮询任务时，撤销延迟取消"""
+    timer = _orphaned_tasks.pop(task_id, None)
+    if timer is not None:
+        timer.cancel()
+
+
+def _cancel_orphaned_task(task_id: str):
+    """等待期结束后仍没有客户端关注的任务，取消"""
+    _orphaned_tasks.pop(task_id, None)
+    if task_store.has_subscribers(task_id):
+        return
+    logger.info(f"SSE 连接已关闭且客户端未改为轮询，取消任务: {task_id}")
+    cancellation = asyncio.ensure_future(ServiceFactory.cancel_task(task_id))
+    _orphan_cancellations.add(cancellation)
+    cancellation.add_done_callback(_orphan_cancellations.discard)
+
+
+def _schedule_orphan_cancel(task_id: str):
+    """
+    SSE 连接在任务结束前关闭时，延迟取消任务
+
+    页面在 SSE 出错时会改为轮询，等待 SSE_CANCEL_GRACE 秒，期间查询或重新订阅过的任务不取消
+    """
+    _keep_task(task_id)
+    loop = asyncio.get_running_loop()
+    _orphaned_tasks[task_id] = loop.call_later(Config.SSE_CANCEL_GRACE, _cancel_orphaned_task, task_id)
+
+
+@app.get("/api/tasks/{task_id}/events")
+async def stream_task_events(task_id: str):
+    """
+    以 Server-Sent Events 推送任务状态（异步模式）
+
+    事件类型：queued / started / done / failed / timeout / cancelled，终态事件发送后连接关闭。
+    连接在任务结束前关闭且客户端没有改为轮询时取消任务，见 _schedule_orphan_cancel
+    """
+    record = task_store.get(task_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+
+    _keep_task(task_id)
+
+    # 先订阅再发送当前状态，避免错过两者之间的状态变化
+    queue = task_store.subscribe(task_id)
+
+    async def event_stream():
+        finished = record['status'] in TaskStatus.FINAL
+        try:
+            yield _format_task_event(record)
+            if finished:
+                return
+
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # 心跳注释，防止代理因空闲断开连接
+                    yield ": keep-alive\n\n"
+                    continue
+
+                finished = event['status'] in TaskStatus.FINAL
+                yield _format_task_event(event)
+                if finished:
+                    return
+        finally:
+            task_store.unsubscribe(task_id, queue)
+            if not finished:
+                _schedule_orphan_cancel(task_id)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,179 @@
+"""
+准入控制
+任务队列积压、在途任务过多、预计排队时间超过任务超时或事件循环延迟过高时拒绝新任务，避免提交注定超时的任务
+"""
+
+import asyncio
+import time
+import logging
+from typing import Dict, Any, Optional, Tuple
+
+from config import Config
+from .async_producer import async_producer
+
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """任务被准入控制拒绝"""
+
+    def __init__(self, message: str, retry_after: int):
+        """
+        Args:
+            message: 拒绝原因
+            retry_after: 建议客户端重试前等待的秒数
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    准入控制器
+
+    功能：
+    1. 通过被动声明队列采样任务队列的消息数，采样结果缓存一段时间
+    2. 统计本进程在途任务数（已发送未完成的任务和公平调度器中本地排队的任务）
+    3. 按调度器的完成速率估算本地排队时间
+    4. 后台协程测量事件循环延迟
+    5. 任一指标超过阈值时拒绝新任务
+    """
+
+    # 事件循环延迟的测量间隔（秒）
+    LAG_PROBE_INTERVAL = 0.5
+
+    def __init__(self):
+        """初始化准入控制器"""
+        self.config = Config()
+        self.enabled = self.config.ADMISSION_ENABLED
+        self.max_queue_depth = self.config.ADMISSION_MAX_QUEUE_DEPTH
+        self.max_inflight = self.config.ADMISSION_MAX_INFLIGHT
+        self.max_loop_lag = self.config.ADMISSION_MAX_LOOP_LAG
+        self.sample_interval = self.config.ADMISSION_SAMPLE_INTERVAL
+        self.retry_after = self.config.ADMISSION_RETRY_AFTER
+        self.loop_lag = 0.0
+        self.rejected = 0
+        # 公平调度器（由调度器模块登记），提供本地排队任务数和预计排队时间
+        self.scheduler = None
+        # 队列名 -> (采样时间, 消息数)
+        self._depths: Dict[str, Tuple[float, int]] = {}
+        self._sample_locks: Dict[str, asyncio.Lock] = {}
+        self._lag_monitor: Optional[asyncio.Task] = None
+
+    def attach_scheduler(self, scheduler):
+        """
+        登记公平调度器
+
+        启用调度器后已发送未完成的任务数不超过 SCHEDULER_MAX_INFLIGHT，其余任务在本地排队，
+        只看生产者的在途任务数和队列深度永远不会超过阈值，需要把本地排队的任务一起计入
+
+        Args:
+            scheduler: 提供 backlog_size 和 estimated_wait(count) 的调度器
+        """
+        self.scheduler = scheduler
+
+    @property
+    def backlog(self) -> int:
+        """公平调度器中本地排队的任务数"""
+        return self.scheduler.backlog_size if self.scheduler is not None else 0
+
+    def start(self):
+        """启动事件循环延迟监测"""
+        if self._lag_monitor is None:
+            self._lag_monitor = asyncio.create_task(self._monitor_loop_lag())
+
+    async def stop(self):
+        """停止事件循环延迟监测"""
+        if self._lag_monitor is not None:
+            self._lag_monitor.cancel()
+            try:
+                await self._lag_monitor
+            except asyncio.CancelledError:
+                pass
+            self._lag_monitor = None
+
+    async def _monitor_loop_lag(self):
+        """定期测量 sleep 的实际唤醒延迟，作为事件循环延迟"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.LAG_PROBE_INTERVAL)
+            self.loop_lag = max(0.0, loop.time() - started - self.LAG_PROBE_INTERVAL)
+
+    async def queue_depth(self, queue_name: str) -> Optional[int]:
+        """
+        获取任务队列的消息数（缓存 sample_interval 秒）
+
+        Returns:
+            int: 消息数，采样失败时返回 None
+        """
+        sampled = self._depths.get(queue_name)
+        if sampled is not None and time.monotonic() - sampled[0] < self.sample_interval:
+            return sampled[1]
+
+        lock = self._sample_locks.setdefault(queue_name, asyncio.Lock())
+        async with lock:
+            # 等锁期间其他请求可能已完成采样
+            sampled = self._depths.get(queue_name)
+            if sampled is not None and time.monotonic() - sampled[0] < self.sample_interval:
+                return sampled[1]
+
+            try:
+                depth = await async_producer.get_message_count(queue_name)
+            except Exception as e:
+                logger.warning(f"[{queue_name}] 采样队列深度失败: {e}")
+                return None
+
+            self._depths[queue_name] = (time.monotonic(), depth)
+            return depth
+
+    async def check(self, queue_name: str, count: int = 1):
+        """
+        检查是否允许发送新任务
+
+        Args:
+            queue_name: 任务队列名称
+            count: 本次要发送的任务数
+
+        Raises:
+            AdmissionRejected: 超过任一阈值
+        """
+        if not self.enabled:
+            return
+
+        backlog = self.backlog
+        inflight = async_producer.pending_count + backlog
+        wait = self.scheduler.estimated_wait(count) if self.scheduler is not None else None
+
+        reason = None
+        if self.max_loop_lag and self.loop_lag > self.max_loop_lag:
+            reason = f"事件循环延迟过高 ({self.loop_lag * 1000:.0f}ms)"
+        elif self.max_inflight and inflight + count > self.max_inflight:
+            reason = f"在途任务过多 ({inflight})"
+        elif wait is not None and wait > self.config.TASK_TIMEOUT:
+            reason = "近期没有任务完成" if wait == float('inf') else f"预计排队时间过长 ({wait:.0f}s)"
+        elif self.max_queue_depth:
+            depth = await self.queue_depth(queue_name)
+            if depth is not None and depth + backlog + count > self.max_queue_depth:
+                reason = f"任务队列积压 ({depth + backlog})"
+
+        if reason is not None:
+            self.rejected += 1
+            logger.warning(f"[{queue_name}] 拒绝新任务: {reason}")
+            raise AdmissionRejected(f"服务繁忙，请稍后重试: {reason}", self.retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        """准入控制统计"""
+        return {
+            'enabled': self.enabled,
+            'loop_lag_ms': round(self.loop_lag * 1000, 2),
+            'inflight': async_producer.pending_count,
+            'backlog': self.backlog,
+            'queue_depths': {name: depth for name, (_, depth) in self._depths.items()},
+            'rejected': self.rejected
+        }
+
+
+# 创建全局准入控制器实例
+admission_controller = AdmissionController()
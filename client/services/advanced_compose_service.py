@@ -3,8 +3,7 @@
 提供高级构图功能
 """
 
-import time
-from typing import Dict, Any, List
+from typing import Awaitable, Callable, Dict, Any, List
 from config import Config
 from .base_service import BaseComposeService
 
@@ -28,13 +27,13 @@ class AdvancedComposeService(BaseComposeService):
             'result_queue': self.result_queue_name
         }
     
-    def submit_task(self, prompt: str, images: List[Dict[str, Any]] = None,
+    def build_task_data(self, prompt: str, images: List[Dict[str, Any]] = None,
                   image_url: str = None,
                   composition_type: str = 'grid', layout: Dict = None,
                   example_image_url: str = None,
                   user_id: str = 'anonymous') -> Dict[str, Any]:
         """
-        提交高级构图任务
+        构建高级构图任务数据
 
         Args:
             prompt: 提示词
@@ -46,12 +45,10 @@ class AdvancedComposeService(BaseComposeService):
             user_id: 用户ID
 
         Returns:
-            Dict: 任务结果
+            Dict: 任务数据
         """
-        task_id = f"advanced_{int(time.time() * 1000)}"
-
-        task_data = {
-            'task_id': task_id,
+        return {
+            'task_id': self.generate_task_id('advanced'),
             'prompt': prompt,
             'images': images if images else [],
             'image_url': image_url,
@@ -61,13 +58,103 @@ class AdvancedComposeService(BaseComposeService):
             'user_id': user_id
         }
 
+    def submit_task(self, prompt: str, images: List[Dict[str, Any]] = None,
+                  image_url: str = None,
+                  composition_type: str = 'grid', layout: Dict = None,
+                  example_image_url: str = None,
+                  user_id: str = 'anonymous') -> Dict[str, Any]:
+        """
+        提交高级构图任务
+
+        Args:
+            prompt: 提示词
+            images: 图像列表，每个元素包含 url 和 weight (可选)
+            image_url: 单张图像URL (可选，与images二选一)
+            composition_type: 构图类型 (grid, collage, blend, overlay, stitch)
+            layout: 布局参数
+            example_image_url: 示例图像URL（可选）
+            user_id: 用户ID
+
+        Returns:
+            Dict: 任务结果
+        """
+        task_data = self.build_task_data(prompt, images, image_url, composition_type, layout, example_image_url, user_id)
         return self.send_task(task_data)
 
+    async def asubmit_task(self, prompt: str, images: List[Dict[str, Any]] = None,
+                  image_url: str = None,
+                  composition_type: str = 'grid', layout: Dict = None,
+                  example_image_url: str = None,
+                  user_id: str = 'anonymous',
+                  fingerprint: str = None,
+                  is_disconnected: Callable[[], Awaitable[bool]] = None) -> Dict[str, Any]:
+        """
+        提交高级构图任务并等待结果（asyncio）
+
+        Args:
+            prompt: 提示词
+            images: 图像列表，每个元素包含 url 和 weight (可选)
+            image_url: 单张图像URL (可选，与images二选一)
+            composition_type: 构图类型 (grid, collage, blend, overlay, stitch)
+            layout: 布局参数
+            example_image_url: 示例图像URL（可选）
+            user_id: 用户ID
+            fingerprint: 任务内容指纹，用于结果缓存（可选）
+            is_disconnected: 检查客户端是否已断开的回调，断开后取消任务（可选）
+
+        Returns:
+            Dict: 任务结果
+        """
+        task_data = self.build_task_data(prompt, images, image_url, composition_type, layout, example_image_url, user_id)
+        return await self.asend_task(task_data, fingerprint=fingerprint, is_disconnected=is_disconnected)
+
+    async def dispatch_task(self, prompt: str, images: List[Dict[str, Any]] = None,
+                  image_url: str = None,
+                  composition_type: str = 'grid', layout: Dict = None,
+                  example_image_url: str = None,
+                  user_id: str = 'anonymous',
+                  fingerprint: str = None) -> str:
+        """
+        提交高级构图任务后立即返回（asyncio），结果由后台写入任务存储
+
+        Args:
+            prompt: 提示词
+            images: 图像列表，每个元素包含 url 和 weight (可选)
+            image_url: 单张图像URL (可选，与images二选一)
+            composition_type: 构图类型 (grid, collage, blend, overlay, stitch)
+            layout: 布局参数
+            example_image_url: 示例图像URL（可选）
+            user_id: 用户ID
+            fingerprint: 任务内容指纹，用于结果缓存（可选）
+
+        Returns:
+            str: 任务ID
+        """
+        task_data = self.build_task_data(prompt, images, image_url, composition_type, layout, example_image_url, user_id)
+        await self.dispatch(task_data, fingerprint=fingerprint)
+        return task_data['task_id']
+
+    async def dispatch_batch(self, jobs: List[Dict[str, Any]]) -> List[str]:
+        """
+        批量提交高级构图任务后立即返回（asyncio），所有任务在同一通道上流水线发布
+
+        Args:
+            jobs: 任务参数列表，每项包含 build_task_data 的参数，以及可选的 fingerprint
+
+        Returns:
+            List[str]: 与任务一一对应的任务ID
+        """
+        jobs = [dict(job) for job in jobs]
+        fingerprints = [job.pop('fingerprint', None) for job in jobs]
+        task_data_list = [self.build_task_data(**job) for job in jobs]
+        await self.dispatch_many(task_data_list, fingerprints=fingerprints, batch=True)
+        return [task_data['task_id'] for task_data in task_data_list]
+
     def submit_task_async(self, prompt: str, images: List[Dict[str, Any]] = None,
-                       image_url: str = None,
-                       composition_type: str = 'grid', layout: Dict = None,
-                       example_image_url: str = None,
-                       user_id: str = 'anonymous') -> bool:
+                  image_url: str = None,
+                  composition_type: str = 'grid', layout: Dict = None,
+                  example_image_url: str = None,
+                  user_id: str = 'anonymous') -> bool:
         """
         异步提交高级构图任务
 
@@ -83,17 +170,5 @@ class AdvancedComposeService(BaseComposeService):
         Returns:
             bool: 是否提交成功
         """
-        task_id = f"advanced_{int(time.time() * 1000)}"
-
-        task_data = {
-            'task_id': task_id,
-            'prompt': prompt,
-            'images': images if images else [],
-            'image_url': image_url,
-            'composition_type': composition_type,
-            'layout': layout or {},
-            'example_image_url': example_image_url,
-            'user_id': user_id
-        }
-
+        task_data = self.build_task_data(prompt, images, image_url, composition_type, layout, example_image_url, user_id)
         return self.send_task_async(task_data)
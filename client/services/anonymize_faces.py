@@ -1,12 +1,13 @@
-import shutil
+import asyncio
+import math
+import queue
 import aiofiles
 import cv2
 import os
-import aiohttp
-import uuid
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, unquote
 from threading import Lock
-from typing import Tuple
+from typing import Callable, Dict, Optional, Tuple, TypeVar, Union
 import numpy as np
 
 # MediaPipe 依赖
@@ -14,12 +15,18 @@ import mediapipe as mp
 from mediapipe.tasks import python
 from mediapipe.tasks.python import vision
 
+from config import Config
+
 # 导入 COS 上传服务
 from .cos_service import cos_service
+from .http_client import image_downloader
+from .result_cache import ResultCache, build_fingerprint
 # import cos_service
 # 模型路径
 MODEL_PATH = 'model/selfie_multiclass_256x256.tflite'
 
+T = TypeVar('T')
+
 
 class FaceHairSegmenter:
     """人脸和头发分割器"""
@@ -45,13 +52,81 @@ class FaceHairSegmenter:
         return result.category_mask.numpy_view()
 
 
+class SegmenterPool:
+    """
+    分割器池
+
+    功能：
+    1. 持有多个 FaceHairSegmenter 实例，每个实例同一时间只被一个线程使用
+    2. 解码、推理、膨胀和混合在专用线程池中执行（OpenCV 和 MediaPipe 推理期间释放 GIL），
+       不阻塞事件循环，吞吐随实例数（CPU 核数）扩展
+    3. 排队 + 处理中的任务数有上限，超过时直接拒绝
+    """
+
+    def __init__(self, model_path: str, size: int, max_pending: int):
+        """
+        初始化分割器池
+
+        Args:
+            model_path: 模型路径
+            size: 分割器实例数（同时也是线程数）
+            max_pending: 排队 + 处理中的最大任务数
+        """
+        self.size = size
+        self.max_pending = max_pending
+        self._segmenters: "queue.Queue[FaceHairSegmenter]" = queue.Queue()
+        for _ in range(size):
+            self._segmenters.put(FaceHairSegmenter(model_path))
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='segmenter')
+        self._pending = 0
+
+    @property
+    def pending_count(self) -> int:
+        """排队 + 处理中的任务数"""
+        return self._pending
+
+    def run(self, image_rgb: np.ndarray) -> np.ndarray:
+        """借用一个空闲的分割器执行推理，返回类别掩码"""
+        segmenter = self._segmenters.get()
+        try:
+            return segmenter.run(image_rgb)
+        finally:
+            self._segmenters.put(segmenter)
+
+    async def submit(self, func: Callable[..., T], *args) -> T:
+        """
+        在分割线程池中执行任务
+
+        Raises:
+            RuntimeError: 排队任务已满
+        """
+        if self._pending >= self.max_pending:
+            raise RuntimeError(f"遮罩处理队列已满 ({self.max_pending})")
+
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self._pending -= 1
+
+
+# 参考图遮罩缓存：参考图内容 -> 遮罩处理后已上传的URL
+masked_reference_cache = ResultCache(
+    ttl=Config.MASK_CACHE_TTL,
+    max_size=Config.MASK_CACHE_MAX_SIZE,
+    cache_dir=Config.MASK_CACHE_DIR,
+    max_disk_entries=Config.MASK_CACHE_DISK_MAX_ENTRIES
+)
+
 # 全局初始化，避免每次请求重新加载模型
 try:
-    global_segmenter = FaceHairSegmenter(MODEL_PATH)
-    print(f"✅ 模型 {MODEL_PATH} 加载成功")
+    config = Config()
+    segmenter_pool = SegmenterPool(MODEL_PATH, config.SEGMENTER_POOL_SIZE, config.SEGMENTER_MAX_PENDING)
+    print(f"✅ 模型 {MODEL_PATH} 加载成功（{segmenter_pool.size} 个实例）")
 except Exception as e:
     print(f"❌ 模型加载失败: {e}")
-    global_segmenter = None
+    segmenter_pool = None
 
 
 def get_filename_from_url(file_url: str, default_name: str = "temp_image.jpg") -> str:
@@ -69,129 +144,265 @@ def get_filename_from_url(file_url: str, default_name: str = "temp_image.jpg") -
         return os.path.basename(file_url) or default_name
 
 
-async def anonymize_faces_with_hair(
-    file_url: str,
+def mask_faces_and_hair(
+    image_bytes: Union[bytes, bytearray],
+    ext: str = ".jpg",
     gray_color: Tuple[int, int, int] = (128, 128, 128),
-    alpha: float = 1.0
-) -> str:
+    alpha: float = 1.0,
+    mask_max_side: int = None
+) -> bytes:
     """
-    检测图片中的人脸和头发，并用灰色遮罩覆盖。
+    在内存中检测人脸和头发并覆盖灰色遮罩（同步，CPU 密集）
+
+    分割、类别筛选和膨胀都在缩小后的图片上完成（膨胀核按比例缩放），只把遮罩的外接矩形区域
+    放大回原尺寸，并在原图上就地混合，不创建整帧大小的临时数组。
 
     参数：
-        file_url (str): 输入图片的本地路径或URL
-        gray_color (tuple): 遮罩颜色，默认灰色 (128, 128, 128)
-        alpha (float): 遮罩浓度 (0.0 - 1.0)，默认 1.0 (完全不透明)
+        image_bytes (bytes): 原始图片数据
+        ext (str): 输出编码格式对应的扩展名，如 ".jpg"、".png"
+        gray_color (tuple): 遮罩颜色
+        alpha (float): 遮罩浓度 (0.0 - 1.0)
+        mask_max_side (int): 计算遮罩时的最大边长，默认取 SEGMENTER_MASK_MAX_SIDE，0 表示使用原图尺寸
 
     返回：
-        str: 处理后上传到COS的图片URL
+        bytes: 编码后的处理结果
 
     异常：
         RuntimeError: 模型未能正确加载
-        ValueError: 图片加载失败
-        Exception: 图片下载失败或上传失败
+        ValueError: 图片解码或编码失败
     """
-    if global_segmenter is None:
+    if segmenter_pool is None:
         raise RuntimeError("服务启动失败：模型未能正确加载")
 
-    # 在 temp 文件夹下创建随机临时目录
-    temp_base_dir = os.path.join(os.path.dirname(__file__), "temp")
-    temp_dir = os.path.join(temp_base_dir, f"temp_{uuid.uuid4().hex[:12]}")
-    os.makedirs(temp_dir, exist_ok=True)
-
-    try:
-        # 获取文件名
-        filename = get_filename_from_url(file_url)
-        local_input_path = os.path.join(temp_dir, f"download_{filename}")
-        output_path = os.path.join(temp_dir, f"processed_{filename}")
-
-        # ====== 1. 下载或复制输入图片 ======
-        if file_url.startswith("http://") or file_url.startswith("https://"):
-            async with aiohttp.ClientSession() as session:
-                async with session.get(file_url) as resp:
-                    if resp.status != 200:
-                        raise Exception(f"图片下载失败: {file_url} ({resp.status})")
-                    async with aiofiles.open(local_input_path, "wb") as f:
-                        await f.write(await resp.read())
-        else:
-            if not os.path.exists(file_url):
-                raise FileNotFoundError(f"本地文件不存在: {file_url}")
-            # 使用 shutil 替代 os.system 更加安全
-            shutil.copy(file_url, local_input_path)
+    # 直接从内存解码
+    img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("图片加载失败：无法解码图片数据")
 
-        # ====== 2. 读取与处理图片 ======
+    height, width = img.shape[:2]
+    if mask_max_side is None:
+        mask_max_side = Config.SEGMENTER_MASK_MAX_SIDE
+    scale = min(1.0, mask_max_side / max(height, width)) if mask_max_side else 1.0
 
-        # 读取图片
-        img = cv2.imread(local_input_path)
-        if img is None:
-            raise ValueError(f"图片加载失败：{local_input_path}")
+    # 缩小后再分割（模型输入仅 256x256，原图分辨率不会提高精度）
+    if scale < 1.0:
+        mask_width, mask_height = max(1, round(width * scale)), max(1, round(height * scale))
+        small = cv2.resize(img, (mask_width, mask_height), interpolation=cv2.INTER_AREA)
+    else:
+        mask_width, mask_height = width, height
+        small = img
 
-        # 转为 RGB 供 MediaPipe 使用
-        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    # 转为 RGB 供 MediaPipe 使用
+    img_rgb = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
 
-        # 执行分割
-        mask_np = global_segmenter.run(img_rgb)
+    # 执行分割
+    mask_np = segmenter_pool.run(img_rgb)
 
-        # MediaPipe Multiclass 索引: 1=头发, 3=脸部皮肤
-        target_indices = [1, 3]
+    # MediaPipe Multiclass 索引: 1=头发, 3=脸部皮肤
+    target_indices = [1, 3]
 
-        # 生成二值掩码 (属于人脸或头发的区域为 1)
-        face_hair_mask = np.isin(mask_np, target_indices).astype(np.uint8)
+    # 生成二值掩码 (属于人脸或头发的区域为 1)
+    face_hair_mask = np.isin(mask_np, target_indices).astype(np.uint8)
 
-        # 对掩码进行膨胀操作，使mask向外扩展
-        kernel = np.ones((20, 20), np.uint8)  # 20x20的核，可根据效果调整大小
-        face_hair_mask = cv2.dilate(face_hair_mask, kernel, iterations=3)
+    # 对掩码进行膨胀操作，使mask向外扩展
+    # 原图尺寸下为 20x20 的核，缩小计算时按比例缩放并向上取整，扩展范围不小于原图尺寸下的结果
+    kernel_size = max(1, math.ceil(20 * scale))
+    kernel = np.ones((kernel_size, kernel_size), np.uint8)
+    face_hair_mask = cv2.dilate(face_hair_mask, kernel, iterations=3)
 
-        # --- 绘制灰色遮罩 ---
-        gray_layer = np.zeros_like(img)
-        gray_layer[:] = gray_color
+    if np.any(face_hair_mask):  # 如果检测到了人脸或头发
+        # 只把遮罩的外接矩形区域放大回原尺寸
+        x, y, box_width, box_height = cv2.boundingRect(face_hair_mask)
+        x_ratio, y_ratio = width / mask_width, height / mask_height
+        left, top = int(x * x_ratio), int(y * y_ratio)
+        right = min(width, int(np.ceil((x + box_width) * x_ratio)))
+        bottom = min(height, int(np.ceil((y + box_height) * y_ratio)))
 
-        # 仅提取掩码区域
-        roi_indices = (face_hair_mask == 1)
+        roi_mask = face_hair_mask[y:y + box_height, x:x + box_width]
+        if (right - left, bottom - top) != (box_width, box_height):
+            roi_mask = cv2.resize(roi_mask, (right - left, bottom - top), interpolation=cv2.INTER_NEAREST)
+        roi_where = roi_mask.view(bool)[..., None]
 
-        if np.any(roi_indices):  # 如果检测到了人脸或头发
-            img_part = img[roi_indices]
-            gray_part = gray_layer[roi_indices]
+        # 原图上的视图，修改直接写回原图
+        roi = img[top:bottom, left:right]
 
-            # 混合运算: 原图*(1-a) + 灰色*a
-            blended_part = cv2.addWeighted(img_part, 1 - alpha, gray_part, alpha, 0)
+        if alpha >= 1:
+            np.copyto(roi, np.array(gray_color, dtype=np.uint8), where=roi_where)
+        else:
+            # 混合运算: 原图*(1-a) + 灰色*a（只在外接矩形内计算）
+            gray_roi = np.empty_like(roi)
+            gray_roi[:] = gray_color
+            blended = cv2.addWeighted(roi, 1 - alpha, gray_roi, alpha, 0)
+            np.copyto(roi, blended, where=roi_where)
 
-            # 填回原图
-            img[roi_indices] = blended_part
+    # 直接编码到内存
+    ok, encoded = cv2.imencode(ext, img)
+    if not ok:
+        raise ValueError(f"图片编码失败：{ext}")
+    return encoded.tobytes()
 
-        # ====== 3. 保存结果 ======
-        cv2.imwrite(output_path, img)
-        print(f"处理完成: {output_path}")
 
-        # ====== 4. 上传到COS ======
+async def load_image_bytes(file_url: str) -> Union[bytes, bytearray]:
+    """
+    读取图片数据：URL 通过共享下载客户端下载到内存，本地路径直接读取
 
-        # 构造上传到 COS 的 key
-        cos_key = f"temp"
+    异常：
+        FileNotFoundError: 本地文件不存在
+        DownloadError: 图片下载失败、超时或超过大小限制
+    """
+    if file_url.startswith("http://") or file_url.startswith("https://"):
+        return await image_downloader.fetch(file_url)
 
-        # 调用上传函数
-        # 注意：upload_file 需要文件对象，而不是文件路径列表
-        # 我们需要打开文件并传递给 upload_file
-        with open(output_path, 'rb') as file_obj:
-            upload_result = cos_service.upload_file(file_obj, cos_key)
+    if not os.path.exists(file_url):
+        raise FileNotFoundError(f"本地文件不存在: {file_url}")
+    async with aiofiles.open(file_url, "rb") as f:
+        return await f.read()
 
-        if not upload_result.get('success'):
-            raise Exception(f"图像上传失败: {upload_result.get('error')}")
 
-        return upload_result['data']['url']
+async def build_reference_cache_key(
+    file_url: str,
+    gray_color: Tuple[int, int, int],
+    alpha: float
+) -> Optional[str]:
+    """
+    生成参考图遮罩缓存的键
 
-    finally:
-        # ====== 5. 清理临时文件夹 ======
+    本桶内的图片使用上传时记录的 MD5 或 ETag 识别内容；其他URL通过 HEAD 请求取 ETag 或
+    Last-Modified，同一URL的图片被替换后不会命中旧遮罩；本地文件使用大小和修改时间。
+    无法识别内容时返回 None，本次不使用缓存
+    """
+    if file_url.startswith("http://") or file_url.startswith("https://"):
         try:
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
-                print(f"已清理临时文件夹: {temp_dir}")
+            content_id = await cos_service.aget_content_id(file_url)
         except Exception as e:
-            print(f"[WARN] 删除临时文件夹失败: {temp_dir}, 错误: {e}")
+            print(f"[WARN] 获取参考图内容标识失败: {file_url}, 错误: {e}")
+            content_id = None
+        if content_id is None:
+            content_id = await image_downloader.head(file_url)
+        if content_id is None:
+            return None
+    else:
+        stat = os.stat(file_url)
+        content_id = f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    return build_fingerprint(
+        'masked_reference', file_url, content_id, gray_color, alpha, Config.SEGMENTER_MASK_MAX_SIDE
+    )
+
+
+# 处理中的遮罩任务：(URL, 颜色, 浓度) -> 后台任务
+_masking_tasks: Dict[Tuple[str, Tuple[int, int, int], float], "asyncio.Task[str]"] = {}
+
+
+def start_masking(
+    file_url: str,
+    gray_color: Tuple[int, int, int] = (128, 128, 128),
+    alpha: float = 1.0
+) -> "asyncio.Task[str]":
+    """
+    在后台开始遮罩处理（同一参考图已在处理中时复用已有任务）
+
+    用于在上传参考图时提前处理，构图请求到达时通过 anonymize_faces_with_hair 等待同一任务
+
+    参数：
+        file_url (str): 输入图片的本地路径或URL
+        gray_color (tuple): 遮罩颜色
+        alpha (float): 遮罩浓度
+
+    返回：
+        asyncio.Task: 完成时返回处理后的图片URL
+    """
+    key = (file_url, tuple(gray_color), alpha)
+    task = _masking_tasks.get(key)
+    if task is not None:
+        return task
+
+    task = asyncio.create_task(_anonymize_faces_with_hair(file_url, gray_color, alpha))
+    _masking_tasks[key] = task
+
+    def on_done(done_task: "asyncio.Task[str]"):
+        _masking_tasks.pop(key, None)
+        # 取走异常，避免无人等待的后台任务报 "exception was never retrieved"
+        if not done_task.cancelled() and done_task.exception() is not None:
+            print(f"[WARN] 遮罩处理失败: {file_url}, 错误: {done_task.exception()}")
+
+    task.add_done_callback(on_done)
+    return task
+
+
+async def anonymize_faces_with_hair(
+    file_url: str,
+    gray_color: Tuple[int, int, int] = (128, 128, 128),
+    alpha: float = 1.0
+) -> str:
+    """
+    检测图片中的人脸和头发，并用灰色遮罩覆盖。
+
+    全程在内存中处理：下载的数据直接解码，处理结果编码后直接上传，不经过临时文件。
+    同一参考图（URL + 内容标识）的处理结果会被缓存，重复请求直接返回已上传的URL；
+    已在后台处理中（上传时提前开始或并发请求）的参考图直接等待同一任务。
+
+    参数：
+        file_url (str): 输入图片的本地路径或URL
+        gray_color (tuple): 遮罩颜色，默认灰色 (128, 128, 128)
+        alpha (float): 遮罩浓度 (0.0 - 1.0)，默认 1.0 (完全不透明)
+
+    返回：
+        str: 处理后上传到COS的图片URL
+
+    异常：
+        RuntimeError: 模型未能正确加载
+        ValueError: 图片加载失败
+        Exception: 图片下载失败或上传失败
+    """
+    # shield：调用方被取消时不影响后台任务，其他等待者仍可拿到结果
+    return await asyncio.shield(start_masking(file_url, gray_color, alpha))
+
+
+async def _anonymize_faces_with_hair(
+    file_url: str,
+    gray_color: Tuple[int, int, int],
+    alpha: float
+) -> str:
+    """遮罩处理的实际实现（查询缓存 -> 下载 -> 分割 -> 上传 -> 写入缓存），参数见 anonymize_faces_with_hair"""
+    if segmenter_pool is None:
+        raise RuntimeError("服务启动失败：模型未能正确加载")
+
+    # ====== 0. 查询缓存 ======
+    cache_key = None
+    if Config.MASK_CACHE_ENABLED:
+        cache_key = await build_reference_cache_key(file_url, gray_color, alpha)
+        cached = await masked_reference_cache.aget(cache_key) if cache_key is not None else None
+        if cached is not None:
+            print(f"命中参考图遮罩缓存: {file_url}")
+            return cached['url']
+
+    # 获取文件名（决定输出编码格式和上传后的扩展名）
+    filename = get_filename_from_url(file_url)
+    ext = os.path.splitext(filename)[1].lower() or ".jpg"
+
+    # ====== 1. 下载或读取输入图片 ======
+    image_bytes = await load_image_bytes(file_url)
+
+    # ====== 2. 处理图片（在分割线程池中执行，不阻塞事件循环） ======
+    processed_bytes = await segmenter_pool.submit(mask_faces_and_hair, image_bytes, ext, gray_color, alpha)
+    print(f"处理完成: {filename}")
+
+    # ====== 3. 上传到COS ======
+    upload_result = await cos_service.aupload_bytes(processed_bytes, f"processed_{filename}", "temp")
+
+    if not upload_result.get('success'):
+        raise Exception(f"图像上传失败: {upload_result.get('error')}")
+
+    masked_url = upload_result['data']['url']
+    if cache_key is not None:
+        masked_reference_cache.set(cache_key, {'url': masked_url})
+
+    return masked_url
 
 
 # 测试 main 函数
 if __name__ == "__main__":
-    import asyncio
-
     async def test_anonymize():
         example_image_url = "https://img-hzcc.huozuyun.com/effect_resource/2026/01/12/18/715911a50f6fd96626b122789fad57cd.png"
         try:
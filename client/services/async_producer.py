@@ -0,0 +1,468 @@
+"""
+异步RabbitMQ生产者
+基于 asyncio 的单连接生产者，任务结果通过 Future 等待，不阻塞事件循环
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Callable, Dict, Any, List, Optional
+
+import aio_pika
+from aio_pika.abc import AbstractIncomingMessage
+from aio_pika.pool import Pool
+
+from config import Config
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRabbitMQProducer:
+    """
+    异步RabbitMQ生产者
+
+    功能：
+    1. 整个进程共用一个自动重连的长连接，发布任务使用通道池，心跳由后台协程处理
+    2. 每个进程声明一个独占的回复队列，任务通过 reply_to/correlation_id 回传结果，
+       按 correlation_id 以 O(1) 方式分发给对应的 Future
+    3. 同一个事件循环内可同时等待大量在途任务
+    4. 队列拓扑在连接建立时声明一次，之后发布不再重复声明
+    5. 任务消息按截止时间设置过期时间，过期或被拒绝的任务转入死信队列
+    6. 取消任务时记入取消集合并向取消交换机广播，之后收到的结果直接丢弃
+
+    注意：Server 层需要将结果发布到消息属性中的 reply_to 队列，并原样带回 correlation_id。
+    status 为 started / progress 的消息视为进度通知，只回调进度处理函数，不会完成 Future。
+    Server 取到任务后应检查 deadline，已过期的任务直接丢弃；处理失败且不再重试的任务
+    应 reject(requeue=False)，由 RabbitMQ 转入死信队列。Server 应订阅取消交换机（fanout），
+    收到的 task_id 在截止时间前取到时直接丢弃。
+    仍在向共享结果队列推送的旧版 Server，可通过 RABBITMQ_CONSUME_SHARED_RESULT_QUEUE 兼容。
+    """
+
+    # 进度通知消息的状态值
+    PROGRESS_STATUSES = ('started', 'progress')
+
+    def __init__(self):
+        """初始化生产者"""
+        self.config = Config()
+        self.connection: Optional[aio_pika.abc.AbstractConnection] = None
+        self.channel: Optional[aio_pika.abc.AbstractChannel] = None
+        self.reply_queue: Optional[aio_pika.abc.AbstractQueue] = None
+        self.channel_pool: Optional[Pool] = None
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._progress_handlers: Dict[str, Callable[[str, Dict[str, Any]], None]] = {}
+        self._consumed_queues = set()
+        self._declared_queues = set()
+        # 已取消的任务：task_id -> 记录过期时间
+        self._cancelled: Dict[str, float] = {}
+        self.cancelled_count = 0
+        self.discarded_results = 0
+        self._connect_lock: Optional[asyncio.Lock] = None
+        # 固定命名的回复队列，断线重连后可按原名重新声明
+        self._reply_queue_name = f"compose.reply.{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex[:8]}"
+
+    @property
+    def is_connected(self) -> bool:
+        """连接是否可用"""
+        return self.connection is not None and not self.connection.is_closed
+
+    @property
+    def pending_count(self) -> int:
+        """在途任务数量"""
+        return len(self._pending)
+
+    async def connect(self) -> bool:
+        """连接到RabbitMQ（已建立连接时直接返回，断线由 connect_robust 在后台恢复）"""
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+
+        async with self._connect_lock:
+            if self.connection is not None:
+                return True
+
+            try:
+                # connect_robust 在断线后自动重连，并恢复通道、队列和消费者
+                self.connection = await aio_pika.connect_robust(
+                    host=self.config.RABBITMQ_HOST,
+                    port=self.config.RABBITMQ_PORT,
+                    login=self.config.RABBITMQ_USER,
+                    password=self.config.RABBITMQ_PASSWORD,
+                    virtualhost=self.config.RABBITMQ_VHOST,
+                    heartbeat=self.config.RABBITMQ_HEARTBEAT
+                )
+                self.channel = await self.connection.channel()
+                self.channel_pool = Pool(
+                    self.connection.channel,
+                    max_size=self.config.RABBITMQ_CHANNEL_POOL_SIZE
+                )
+                self._consumed_queues.clear()
+
+                # 进程独占的回复队列：连接断开后由服务器自动删除
+                self.reply_queue = await self.channel.declare_queue(
+                    self._reply_queue_name,
+                    exclusive=True,
+                    auto_delete=True
+                )
+                await self.reply_queue.consume(self._on_reply, no_ack=False)
+                logger.info(f"回复队列已声明: {self.reply_queue.name}")
+
+                await self.declare_topology()
+
+                logger.info(f"异步生产者连接成功: {self.config.RABBITMQ_HOST}:{self.config.RABBITMQ_PORT}")
+                return True
+
+            except Exception as e:
+                logger.error(f"异步生产者连接失败: {e}")
+                if self.connection is not None:
+                    await self.connection.close()
+                self.connection = None
+                self.channel = None
+                self.channel_pool = None
+                self.reply_queue = None
+                return False
+
+    async def declare_topology(self):
+        """声明死信交换机/队列和所有服务的任务队列（每个队列只声明一次）"""
+        await self._declare_dead_letter()
+        await self.channel.declare_exchange(
+            self.config.CANCEL_EXCHANGE,
+            aio_pika.ExchangeType.FANOUT,
+            durable=True
+        )
+
+        for queue_config in self.config.QUEUE_CONFIG.values():
+            queue_name = queue_config['task_queue']
+            if queue_name in self._declared_queues:
+                continue
+
+            channel = await self.connection.channel()
+            try:
+                await channel.declare_queue(
+                    queue_name,
+                    durable=True,
+                    arguments=self.config.TASK_QUEUE_ARGUMENTS
+                )
+            except aio_pika.exceptions.ChannelPreconditionFailed as e:
+                # 队列已由 Server 以不同参数声明，改为被动检查
+                logger.warning(f"队列参数不匹配，改为被动声明: {queue_name}, {e}")
+                channel = await self.connection.channel()
+                await channel.declare_queue(queue_name, passive=True)
+            finally:
+                if not channel.is_closed:
+                    await channel.close()
+
+            self._declared_queues.add(queue_name)
+            logger.info(f"任务队列已声明: {queue_name}")
+
+    async def _declare_dead_letter(self):
+        """声明死信交换机和死信队列（死信按 DEAD_LETTER_TTL 自动清理）"""
+        if self.config.DEAD_LETTER_QUEUE in self._declared_queues:
+            return
+
+        exchange = await self.channel.declare_exchange(
+            self.config.DEAD_LETTER_EXCHANGE,
+            aio_pika.ExchangeType.FANOUT,
+            durable=True
+        )
+        queue = await self.channel.declare_queue(
+            self.config.DEAD_LETTER_QUEUE,
+            durable=True,
+            arguments={'x-message-ttl': self.config.DEAD_LETTER_TTL * 1000}
+        )
+        await queue.bind(exchange)
+
+        self._declared_queues.add(self.config.DEAD_LETTER_QUEUE)
+        logger.info(f"死信队列已声明: {self.config.DEAD_LETTER_EXCHANGE} -> {self.config.DEAD_LETTER_QUEUE}")
+
+    async def _ensure_result_consumer(self, result_queue: str):
+        """兼容旧版 Server：订阅共享结果队列（每个队列只订阅一次）"""
+        if not self.config.CONSUME_SHARED_RESULT_QUEUE or result_queue in self._consumed_queues:
+            return
+
+        queue = await self.channel.declare_queue(result_queue, durable=True)
+        await queue.consume(self._on_shared_result, no_ack=False)
+        self._consumed_queues.add(result_queue)
+        logger.info(f"开始监听结果队列: {result_queue}")
+
+    def _resolve(self, message: AbstractIncomingMessage) -> Optional[bool]:
+        """
+        将结果消息分发给对应的 Future
+
+        Returns:
+            True: 已唤醒等待者；False: 无人等待；None: 消息无法解析
+        """
+        try:
+            result = json.loads(message.body.decode('utf-8'))
+        except Exception as e:
+            logger.error(f"解析结果消息失败: {e}")
+            return None
+
+        result_task_id = message.correlation_id or result.get('task_id')
+
+        if self.is_cancelled(result_task_id):
+            self.discarded_results += 1
+            logger.info(f"丢弃已取消任务的消息: task_id={result_task_id}")
+            return True
+
+        if result.get('status') in self.PROGRESS_STATUSES:
+            handler = self._progress_handlers.get(result_task_id)
+            if handler is None:
+                return False
+            handler(result_task_id, result)
+            return True
+
+        future = self._pending.pop(result_task_id, None)
+        if future is None:
+            logger.debug(f"收到无人等待的结果: task_id={result_task_id}")
+            return False
+
+        if not future.done():
+            future.set_result(result)
+        logger.info(f"收到结果: task_id={result_task_id}")
+        return True
+
+    async def _on_reply(self, message: AbstractIncomingMessage):
+        """处理本进程回复队列中的结果"""
+        if self._resolve(message) is False:
+            logger.warning(f"回复队列收到无人等待的结果: correlation_id={message.correlation_id}")
+        await message.ack()
+
+    async def _on_shared_result(self, message: AbstractIncomingMessage):
+        """处理共享结果队列中的结果（兼容旧版 Server）"""
+        resolved = self._resolve(message)
+        if resolved is False and not message.redelivered:
+            # 不属于本进程的结果，退回队列交给其他实例
+            await message.reject(requeue=True)
+        else:
+            await message.ack()
+
+    def _register(self, task_id: str,
+                  on_progress: Callable[[str, Dict[str, Any]], None] = None) -> asyncio.Future:
+        """登记在途任务，返回结果 Future"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending[task_id] = future
+        if on_progress is not None:
+            self._progress_handlers[task_id] = on_progress
+        # 完成、超时或取消时同步移除，避免在途表无限增长
+        future.add_done_callback(lambda _: self._forget(task_id))
+        return future
+
+    def _build_message(self, task_data: Dict[str, Any]) -> aio_pika.Message:
+        """构建任务消息（带截止时间的任务，到期后由 RabbitMQ 转入死信队列；带优先级的任务优先投递）"""
+        deadline = task_data.get('deadline')
+        return aio_pika.Message(
+            body=json.dumps(task_data).encode('utf-8'),
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            correlation_id=task_data['task_id'],
+            reply_to=self.reply_queue.name,
+            priority=task_data.get('priority'),
+            expiration=max(0.0, deadline - time.time()) if deadline else None
+        )
+
+    async def publish(self, queue_name: str, result_queue: str,
+                      task_data: Dict[str, Any],
+                      on_progress: Callable[[str, Dict[str, Any]], None] = None) -> asyncio.Future:
+        """
+        发送任务，返回可等待结果的 Future
+
+        Args:
+            queue_name: 任务队列名称
+            result_queue: 结果队列名称
+            task_data: 任务数据（必须包含 task_id）
+            on_progress: 收到进度通知时的回调，参数为 (task_id, 消息)（可选）
+
+        Returns:
+            asyncio.Future: 结果到达时完成
+        """
+        futures = await self.publish_many(queue_name, result_queue, [task_data], on_progress)
+        return futures[0]
+
+    async def publish_many(self, queue_name: str, result_queue: str,
+                           task_data_list: List[Dict[str, Any]],
+                           on_progress: Callable[[str, Dict[str, Any]], None] = None) -> List[asyncio.Future]:
+        """
+        在同一个通道上流水线式批量发送任务
+
+        所有消息连续发出后再统一等待发布确认，批量提交只需一次通道借用和一轮确认等待。
+
+        Args:
+            queue_name: 任务队列名称
+            result_queue: 结果队列名称
+            task_data_list: 任务数据列表（每项必须包含 task_id）
+            on_progress: 收到进度通知时的回调，参数为 (task_id, 消息)（可选）
+
+        Returns:
+            List[asyncio.Future]: 与任务数据一一对应的结果 Future
+        """
+        if not await self.connect():
+            raise ConnectionError("无法连接到RabbitMQ")
+
+        await self._ensure_result_consumer(result_queue)
+
+        futures = [self._register(task_data['task_id'], on_progress) for task_data in task_data_list]
+
+        try:
+            async with self.channel_pool.acquire() as channel:
+                await asyncio.gather(*[
+                    channel.default_exchange.publish(
+                        self._build_message(task_data),
+                        routing_key=queue_name
+                    )
+                    for task_data in task_data_list
+                ])
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+
+        task_ids = ', '.join(task_data['task_id'] for task_data in task_data_list)
+        logger.info(f"[{queue_name}] 任务已发送: {task_ids}")
+        return futures
+
+    async def get_message_count(self, queue_name: str) -> int:
+        """
+        获取队列中待消费的消息数（被动声明，不修改队列）
+
+        Args:
+            queue_name: 队列名称
+
+        Returns:
+            int: 消息数
+        """
+        if not await self.connect():
+            raise ConnectionError("无法连接到RabbitMQ")
+
+        async with self.channel_pool.acquire() as channel:
+            queue = await channel.declare_queue(queue_name, passive=True)
+            return queue.declaration_result.message_count
+
+    def is_pending(self, task_id: str) -> bool:
+        """任务是否已发送且仍在等待结果"""
+        return task_id in self._pending
+
+    def is_cancelled(self, task_id: str) -> bool:
+        """任务是否已取消（取消记录保留到任务截止时间）"""
+        expires_at = self._cancelled.get(task_id)
+        if expires_at is None:
+            return False
+        if expires_at <= time.time():
+            del self._cancelled[task_id]
+            return False
+        return True
+
+    async def cancel(self, task_id: str, deadline: float = None) -> bool:
+        """
+        取消在途任务：记入取消集合、结束等待，并向取消交换机广播
+
+        Args:
+            task_id: 任务ID
+            deadline: 任务截止时间（Unix 时间戳），取消记录和通知保留到该时间
+
+        Returns:
+            bool: 取消通知是否发送成功
+        """
+        now = time.time()
+        expires_at = deadline or now + self.config.TASK_TIMEOUT
+        # 顺带清理已过期的取消记录
+        for expired in [key for key, value in self._cancelled.items() if value <= now]:
+            del self._cancelled[expired]
+        self._cancelled[task_id] = expires_at
+        self.cancelled_count += 1
+
+        future = self._pending.pop(task_id, None)
+        if future is not None and not future.done():
+            future.set_result({'success': False, 'task_id': task_id, 'cancelled': True, 'error': '任务已取消'})
+
+        if not self.is_connected:
+            return False
+
+        try:
+            async with self.channel_pool.acquire() as channel:
+                exchange = await channel.get_exchange(self.config.CANCEL_EXCHANGE, ensure=False)
+                await exchange.publish(
+                    aio_pika.Message(
+                        body=json.dumps({'task_id': task_id, 'deadline': deadline}).encode('utf-8'),
+                        correlation_id=task_id,
+                        expiration=max(0.0, expires_at - now)
+                    ),
+                    routing_key=''
+                )
+        except Exception as e:
+            logger.error(f"发送取消通知失败: {task_id}, {e}")
+            return False
+
+        logger.info(f"任务已取消: {task_id}")
+        return True
+
+    def cancel_stats(self) -> Dict[str, Any]:
+        """取消统计"""
+        return {
+            'cancelled': self.cancelled_count,
+            'tracked': len(self._cancelled),
+            'discarded_results': self.discarded_results
+        }
+
+    def _forget(self, task_id: str):
+        """移除任务的等待记录"""
+        self._pending.pop(task_id, None)
+        self._progress_handlers.pop(task_id, None)
+
+    async def send_task(self, queue_name: str, result_queue: str,
+                        task_data: Dict[str, Any], timeout: int = Config.TASK_TIMEOUT) -> Optional[Dict[str, Any]]:
+        """
+        发送任务并等待结果
+
+        Args:
+            queue_name: 任务队列名称
+            result_queue: 结果队列名称
+            task_data: 任务数据
+            timeout: 超时时间（秒）
+
+        Returns:
+            Dict: 任务结果，发送失败或超时返回 None
+        """
+        task_id = task_data.get('task_id')
+        task_data.setdefault('deadline', time.time() + timeout)
+
+        try:
+            future = await self.publish(queue_name, result_queue, task_data)
+        except Exception as e:
+            logger.error(f"[{queue_name}] 发送任务失败: {e}")
+            return None
+
+        try:
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"[{queue_name}] 等待结果超时: {task_id}")
+            return None
+        finally:
+            self._pending.pop(task_id, None)
+
+    async def close(self):
+        """关闭连接并取消所有等待中的任务"""
+        for future in self._pending.values():
+            if not future.done():
+                future.cancel()
+        self._pending.clear()
+        self._progress_handlers.clear()
+
+        if self.channel_pool is not None:
+            await self.channel_pool.close()
+
+        if self.connection is not None:
+            await self.connection.close()
+            logger.info("异步生产者连接已关闭")
+
+        self.connection = None
+        self.channel = None
+        self.channel_pool = None
+        self.reply_queue = None
+        self._consumed_queues.clear()
+
+
+# 创建全局异步生产者实例
+async_producer = AsyncRabbitMQProducer()
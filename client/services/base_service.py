@@ -4,15 +4,27 @@
 """
 
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Optional
-import pika
-import json
+from typing import Awaitable, Callable, Dict, Any, List, Optional
+import asyncio
 import time
+import uuid
 import logging
 
+from config import Config
+from .async_producer import async_producer
+from .connection_pool import blocking_pool
+from .task_store import task_store, TaskStatus
+from .result_cache import result_cache
+from .single_flight import SingleFlight, single_flight
+from .admission import admission_controller, AdmissionRejected
+from .fair_scheduler import fair_scheduler
+
 
 logger = logging.getLogger(__name__)
 
+# 请求被取消后在后台执行的取消任务，持有引用避免被垃圾回收
+_cancellations = set()
+
 
 class BaseComposeService(ABC):
     """构图服务基类"""
@@ -27,10 +39,6 @@ class BaseComposeService(ABC):
         """
         self.queue_name = queue_name
         self.result_queue_name = result_queue_name
-        self.connection: Optional[pika.BlockingConnection] = None
-        self.channel: Optional[pika.channel.Channel] = None
-        self.response = None
-        self.task_id = None
     
     @abstractmethod
     def get_queue_names(self) -> Dict[str, str]:
@@ -41,163 +49,290 @@ class BaseComposeService(ABC):
             Dict: 包含 task_queue 和 result_queue
         """
         pass
+
+    @staticmethod
+    def get_priority(user_id: str = None, batch: bool = False) -> int:
+        """
+        计算任务优先级：指定用户按配置，其他用户单个提交高于批量提交
+        
+        Args:
+            user_id: 用户ID
+            batch: 是否为批量提交
+        
+        Returns:
+            int: 消息优先级（0 ~ TASK_MAX_PRIORITY）
+        """
+        priority = Config.TASK_PRIORITY_USERS.get(user_id)
+        if priority is None:
+            priority = Config.TASK_PRIORITY_BATCH if batch else Config.TASK_PRIORITY_INTERACTIVE
+        return max(0, min(priority, Config.TASK_MAX_PRIORITY))
+
+    @staticmethod
+    def generate_task_id(prefix: str) -> str:
+        """生成任务ID（毫秒时间戳 + 随机后缀，避免并发请求冲突）"""
+        return f"{prefix}_{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
     
-    def connect(self) -> bool:
-        """连接到RabbitMQ"""
-        from config import Config
-        config = Config()
+    def send_task(self, task_data: Dict[str, Any], timeout: int = Config.TASK_TIMEOUT) -> Optional[Dict[str, Any]]:
+        """
+        发送任务并等待结果（同步，复用连接池中的长连接）
+        
+        Args:
+            task_data: 任务数据
+            timeout: 超时时间（秒）
+        
+        Returns:
+            Dict: 任务结果
+        """
+        task_data.setdefault('priority', self.get_priority(task_data.get('user_id')))
         
         try:
-            credentials = pika.PlainCredentials(
-                config.RABBITMQ_USER,
-                config.RABBITMQ_PASSWORD
-            )
-            
-            parameters = pika.ConnectionParameters(
-                host=config.RABBITMQ_HOST,
-                port=config.RABBITMQ_PORT,
-                virtual_host=config.RABBITMQ_VHOST,
-                credentials=credentials,
-                heartbeat=600
-            )
+            with blocking_pool.acquire(self.queue_name) as conn:
+                response = conn.call(self.queue_name, task_data, timeout)
             
-            self.connection = pika.BlockingConnection(parameters)
-            self.channel = self.connection.channel()
-            
-            logger.info(f"[{self.queue_name}] 连接成功")
-            return True
+            if response is None:
+                logger.warning(f"[{self.queue_name}] 等待结果超时")
+            return response
             
         except Exception as e:
-            logger.error(f"[{self.queue_name}] 连接失败: {e}")
-            return False
+            logger.error(f"[{self.queue_name}] 发送任务失败: {e}")
+            return None
     
-    def _declare_result_queue(self) -> bool:
-        """声明结果队列并开始消费"""
+    def send_task_async(self, task_data: Dict[str, Any], timeout: int = Config.TASK_TIMEOUT) -> bool:
+        """
+        发送任务（异步，不等待结果）
+        
+        Args:
+            task_data: 任务数据
+            timeout: 超时时间（秒），决定任务截止时间，超过后仍未被取走的消息转入死信队列
+        
+        Returns:
+            bool: 是否发送成功
+        """
+        # 不等待结果的任务按批量优先级处理
+        task_data.setdefault('priority', self.get_priority(task_data.get('user_id'), batch=True))
+        task_data.setdefault('deadline', time.time() + timeout)
+        
         try:
-            # 声明结果队列
-            self.channel.queue_declare(
-                queue=self.result_queue_name,
-                durable=True
-            )
-            logger.info(f"[{self.queue_name}] 结果队列已声明: {self.result_queue_name}")
-            
-            # 设置预取数量为1，确保公平分配
-            self.channel.basic_qos(prefetch_count=1)
+            with blocking_pool.acquire(self.queue_name) as conn:
+                conn.publish(self.queue_name, task_data)
             
-            # 开始消费结果队列
-            self.channel.basic_consume(
-                queue=self.result_queue_name,
-                on_message_callback=self._on_result,
-                auto_ack=False  # 手动确认，避免消息丢失
-            )
-            logger.info(f"[{self.queue_name}] 开始监听结果队列")
+            logger.info(f"[{self.queue_name}] 任务已发送（异步）: {task_data.get('task_id')}")
             return True
+            
         except Exception as e:
-            logger.error(f"[{self.queue_name}] 声明结果队列失败: {e}")
+            logger.error(f"[{self.queue_name}] 发送任务失败: {e}")
             return False
     
-    def _on_result(self, ch, method, props, body):
-        """处理结果消息"""
-        try:
-            result = json.loads(body.decode('utf-8'))
-            result_task_id = result.get('task_id')
-            logger.info(f"[{self.queue_name}] 收到结果: task_id={result_task_id}, 期望的task_id={self.task_id}")
-            
-            if self.task_id and result_task_id == self.task_id:
-                self.response = result
-                logger.info(f"[{self.queue_name}] 结果匹配成功，设置响应")
-            
-            # 手动确认消息
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-            logger.debug(f"[{self.queue_name}] 消息已确认")
-        except Exception as e:
-            logger.error(f"[{self.queue_name}] 处理结果时出错: {e}")
+    @staticmethod
+    def _on_progress(task_id: str, message: Dict[str, Any]):
+        """收到进度通知时更新任务状态"""
+        task_store.update(task_id, TaskStatus.STARTED, progress=message.get('progress'))
     
-    def send_task(self, task_data: Dict[str, Any], timeout: int = 120) -> Optional[Dict[str, Any]]:
+    async def dispatch(self, task_data: Dict[str, Any], timeout: int = Config.TASK_TIMEOUT,
+                       fingerprint: str = None) -> Awaitable[Optional[Dict[str, Any]]]:
         """
-        发送任务并等待结果（同步）
+        发送任务并登记到任务存储，不等待结果（asyncio）
         
         Args:
             task_data: 任务数据
             timeout: 超时时间（秒）
+            fingerprint: 任务内容指纹，提供时先查结果缓存，完成后写入缓存（可选）
         
         Returns:
-            Dict: 任务结果
+            Awaitable: 完成时返回任务结果，超时返回 None
         """
-        if not self.connect():
-            return None
+        waiters = await self.dispatch_many([task_data], timeout, [fingerprint])
+        return waiters[0]
+    
+    async def dispatch_many(self, task_data_list: List[Dict[str, Any]], timeout: int = Config.TASK_TIMEOUT,
+                            fingerprints: List[Optional[str]] = None,
+                            batch: bool = False) -> List[Awaitable[Optional[Dict[str, Any]]]]:
+        """
+        批量发送任务（同一通道流水线发布）并登记到任务存储
         
-        self.response = None
-        self.task_id = task_data.get('task_id')
+        命中结果缓存的任务直接标记完成；与在途任务指纹相同的任务挂到在途任务上，
+        都不发送到 RabbitMQ。需要发送的任务先经过准入控制，再交给公平调度器按用户排队发送。
+        任务带上截止时间（deadline），超过截止时间仍未被 Server 取走的消息由 RabbitMQ 转入死信队列；
+        消息优先级见 get_priority
         
-        # 声明并订阅结果队列
-        if not self._declare_result_queue():
-            self.close()
-            return None
+        Args:
+            task_data_list: 任务数据列表
+            timeout: 超时时间（秒），同时决定任务截止时间
+            fingerprints: 与任务一一对应的内容指纹（可选）
+            batch: 是否为批量提交（按批量优先级发送）
         
-        try:
-            self.channel.basic_publish(
-                exchange='',
-                routing_key=self.queue_name,
-                properties=pika.BasicProperties(
-                    delivery_mode=2
-                ),
-                body=json.dumps(task_data)
-            )
+        Returns:
+            List[Awaitable]: 与任务一一对应，完成时返回任务结果，超时返回 None
+        
+        Raises:
+            AdmissionRejected: 队列积压、在途任务过多、事件循环延迟过高或用户待发送任务过多
+        """
+        fingerprints = fingerprints or [None] * len(task_data_list)
+        waiters: List[Optional[Awaitable]] = [None] * len(task_data_list)
+        to_publish = []
+        # 领头任务下标 -> 在途登记的占位 Future
+        placeholders: Dict[int, asyncio.Future] = {}
+        
+        for index, (task_data, fingerprint) in enumerate(zip(task_data_list, fingerprints)):
+            task_id = task_data['task_id']
+            task_store.create(task_id, self.service_name, task_data.get('user_id', 'anonymous'), fingerprint)
             
-            logger.info(f"[{self.queue_name}] 任务已发送: {self.task_id}")
+            cached = await result_cache.aget(fingerprint) if fingerprint else None
+            if cached is not None:
+                result = dict(cached, task_id=task_id, cached=True)
+                task_store.update(task_id, TaskStatus.DONE, result=result)
+                waiters[index] = self._completed(result)
+                logger.info(f"[{self.queue_name}] 命中结果缓存: {task_id}")
+                continue
             
-            # 等待结果
-            start_time = time.time()
-            while self.response is None:
-                self.connection.process_data_events(time_limit=1)
-                if time.time() - start_time > timeout:
-                    logger.warning(f"[{self.queue_name}] 等待结果超时")
-                    self.close()
-                    return None
+            # 查找与登记之间不能有 await，否则相同的并发请求都会未命中而重复发送；
+            # 同一批次内的重复任务同样挂到占位 Future 上
+            leader = single_flight.join(fingerprint, task_id) if fingerprint else None
+            if leader is not None:
+                waiters[index] = self._follow(task_id, fingerprint, leader, timeout)
+                continue
             
-            self.close()
-            return self.response
+            if fingerprint:
+                placeholders[index] = single_flight.claim(fingerprint)
+            to_publish.append(index)
+        
+        if to_publish:
+            publish_list = [task_data_list[index] for index in to_publish]
+            deadline = time.time() + timeout
+            for task_data in publish_list:
+                task_data.setdefault('deadline', deadline)
+                task_data.setdefault('priority', self.get_priority(task_data.get('user_id'), batch))
+            try:
+                await admission_controller.check(self.queue_name, len(publish_list))
+                futures = await fair_scheduler.submit(
+                    self.queue_name,
+                    self.result_queue_name,
+                    publish_list,
+                    on_progress=self._on_progress
+                )
+            except Exception as e:
+                error = str(e) if isinstance(e, AdmissionRejected) else f"任务发送失败: {e}"
+                for index in to_publish:
+                    task_store.update(task_data_list[index]['task_id'], TaskStatus.FAILED, error=error)
+                # 跟随者随占位 Future 一起失败
+                for placeholder in placeholders.values():
+                    if not placeholder.done():
+                        placeholder.set_result({'success': False, 'error': error})
+                raise
             
+            for index, future in zip(to_publish, futures):
+                collector = task_store.collect(task_data_list[index]['task_id'], future, timeout)
+                if index in placeholders:
+                    SingleFlight.chain(placeholders[index], future)
+                    collector.add_done_callback(self._cache_callback(fingerprints[index]))
+                waiters[index] = collector
+        
+        return waiters
+    
+    def _follow(self, task_id: str, fingerprint: str, leader: asyncio.Future, timeout: int) -> asyncio.Task:
+        """挂到相同指纹的在途任务上，结果到达时写入自己的任务记录；等待结束（含超时）后退出跟随"""
+        logger.info(f"[{self.queue_name}] 合并到在途任务: {task_id}")
+        collector = task_store.collect(task_id, asyncio.ensure_future(single_flight.follow(leader, task_id)), timeout)
+        collector.add_done_callback(lambda _: single_flight.leave(fingerprint, task_id))
+        return collector
+    
+    @staticmethod
+    def _completed(result: Dict[str, Any]) -> asyncio.Future:
+        """构造一个已完成的 Future"""
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(result)
+        return future
+    
+    @staticmethod
+    def _cache_callback(fingerprint: str):
+        """任务成功完成后写入结果缓存"""
+        def callback(collector: asyncio.Task):
+            if collector.cancelled() or collector.exception() is not None:
+                return
+            result = collector.result()
+            if result is not None and result.get('success', True):
+                result_cache.set(fingerprint, result)
+        return callback
+    
+    async def asend_task(self, task_data: Dict[str, Any], timeout: int = Config.TASK_TIMEOUT,
+                         fingerprint: str = None,
+                         is_disconnected: Callable[[], Awaitable[bool]] = None) -> Optional[Dict[str, Any]]:
+        """
+        发送任务并等待结果（asyncio，不阻塞事件循环）
+        
+        Args:
+            task_data: 任务数据
+            timeout: 超时时间（秒）
+            fingerprint: 任务内容指纹，用于结果缓存（可选）
+            is_disconnected: 检查客户端是否已断开的回调，断开后取消任务（可选）
+        
+        Returns:
+            Dict: 任务结果，发送失败、超时或已取消返回 None
+        
+        Raises:
+            AdmissionRejected: 被准入控制拒绝
+        """
+        try:
+            collector = await self.dispatch(task_data, timeout, fingerprint)
+        except AdmissionRejected:
+            raise
         except Exception as e:
             logger.error(f"[{self.queue_name}] 发送任务失败: {e}")
-            self.close()
             return None
+        
+        if is_disconnected is None:
+            # shield：请求被取消时，后台收集任务仍会把结果写入任务存储
+            return await asyncio.shield(collector)
+        
+        try:
+            while True:
+                # asyncio.wait 超时不会取消收集任务
+                done, _ = await asyncio.wait({collector}, timeout=Config.DISCONNECT_POLL_INTERVAL)
+                if done:
+                    return collector.result()
+                if await is_disconnected():
+                    logger.info(f"[{self.queue_name}] 客户端已断开: {task_data['task_id']}")
+                    await self.cancel_task(task_data, fingerprint)
+                    return None
+        except asyncio.CancelledError:
+            # 请求处理本身被取消（连接断开）时同样取消任务
+            cancellation = asyncio.ensure_future(self.cancel_task(task_data, fingerprint))
+            _cancellations.add(cancellation)
+            cancellation.add_done_callback(_cancellations.discard)
+            raise
     
-    def send_task_async(self, task_data: Dict[str, Any]) -> bool:
+    async def cancel_task(self, task_data: Dict[str, Any], fingerprint: str = None) -> bool:
         """
-        发送任务（异步，不等待结果）
+        取消未完成的任务
+        
+        已发送的任务广播取消通知，Server 取到时直接跳过；仍在本地排队的任务不再发送；
+        合并到在途任务的跟随者只标记自己的记录。
+        有其他请求跟随的在途任务不取消。
         
         Args:
             task_data: 任务数据
+            fingerprint: 任务内容指纹（可选）
         
         Returns:
-            bool: 是否发送成功
+            bool: 是否已取消
         """
-        if not self.connect():
+        task_id = task_data['task_id']
+        record = task_store.get(task_id)
+        if record is None or record['status'] in TaskStatus.FINAL:
             return False
         
-        try:
-            self.channel.basic_publish(
-                exchange='',
-                routing_key=self.queue_name,
-                properties=pika.BasicProperties(
-                    delivery_mode=2
-                ),
-                body=json.dumps(task_data)
-            )
-            
-            logger.info(f"[{self.queue_name}] 任务已发送（异步）: {task_data.get('task_id')}")
-            self.close()
-            return True
-            
-        except Exception as e:
-            logger.error(f"[{self.queue_name}] 发送任务失败: {e}")
-            self.close()
+        published = async_producer.is_pending(task_id)
+        queued = fair_scheduler.is_queued(task_id)
+        if (published or queued) and fingerprint and single_flight.followers(fingerprint):
+            logger.info(f"[{self.queue_name}] 任务仍有其他请求在等待，不取消: {task_id}")
             return False
-    
-    def close(self):
-        """关闭连接"""
-        if self.connection and not self.connection.is_closed:
-            self.connection.close()
-            logger.debug(f"[{self.queue_name}] 连接已关闭")
+        
+        task_store.update(task_id, TaskStatus.CANCELLED, error="客户端已断开，任务已取消")
+        if published:
+            await async_producer.cancel(task_id, task_data.get('deadline'))
+        elif queued:
+            fair_scheduler.cancel(task_id)
+        elif fingerprint:
+            # 跟随者：不再计入在途任务的等待者
+            single_flight.leave(fingerprint, task_id)
+        return True
@@ -3,8 +3,7 @@
 提供基础构图功能
 """
 
-import time
-from typing import Dict, Any
+from typing import Awaitable, Callable, Dict, Any, List
 from config import Config
 from .base_service import BaseComposeService
 
@@ -28,11 +27,11 @@ class BasicComposeService(BaseComposeService):
             'result_queue': self.result_queue_name
         }
     
-    def submit_task(self, prompt: str, image_url: str,
-                  example_image_url: str = None,
-                  user_id: str = 'anonymous') -> Dict[str, Any]:
+    def build_task_data(self, prompt: str, image_url: str,
+                        example_image_url: str = None,
+                        user_id: str = 'anonymous') -> Dict[str, Any]:
         """
-        提交基础构图任务
+        构建基础构图任务数据
 
         Args:
             prompt: 提示词
@@ -41,20 +40,94 @@ class BasicComposeService(BaseComposeService):
             user_id: 用户ID
 
         Returns:
-            Dict: 任务结果
+            Dict: 任务数据
         """
-        task_id = f"basic_{int(time.time() * 1000)}"
-
-        task_data = {
-            'task_id': task_id,
+        return {
+            'task_id': self.generate_task_id('basic'),
             'prompt': prompt,
             'image_url': image_url,
             'example_image_url': example_image_url,
             'user_id': user_id
         }
 
+    def submit_task(self, prompt: str, image_url: str,
+                  example_image_url: str = None,
+                  user_id: str = 'anonymous') -> Dict[str, Any]:
+        """
+        提交基础构图任务
+
+        Args:
+            prompt: 提示词
+            image_url: 基础图像URL
+            example_image_url: 示例图像URL（可选）
+            user_id: 用户ID
+
+        Returns:
+            Dict: 任务结果
+        """
+        task_data = self.build_task_data(prompt, image_url, example_image_url, user_id)
         return self.send_task(task_data)
 
+    async def asubmit_task(self, prompt: str, image_url: str,
+                           example_image_url: str = None,
+                           user_id: str = 'anonymous',
+                           fingerprint: str = None,
+                           is_disconnected: Callable[[], Awaitable[bool]] = None) -> Dict[str, Any]:
+        """
+        提交基础构图任务并等待结果（asyncio）
+
+        Args:
+            prompt: 提示词
+            image_url: 基础图像URL
+            example_image_url: 示例图像URL（可选）
+            user_id: 用户ID
+            fingerprint: 任务内容指纹，用于结果缓存（可选）
+            is_disconnected: 检查客户端是否已断开的回调，断开后取消任务（可选）
+
+        Returns:
+            Dict: 任务结果
+        """
+        task_data = self.build_task_data(prompt, image_url, example_image_url, user_id)
+        return await self.asend_task(task_data, fingerprint=fingerprint, is_disconnected=is_disconnected)
+
+    async def dispatch_task(self, prompt: str, image_url: str,
+                            example_image_url: str = None,
+                            user_id: str = 'anonymous',
+                            fingerprint: str = None) -> str:
+        """
+        提交基础构图任务后立即返回（asyncio），结果由后台写入任务存储
+
+        Args:
+            prompt: 提示词
+            image_url: 基础图像URL
+            example_image_url: 示例图像URL（可选）
+            user_id: 用户ID
+            fingerprint: 任务内容指纹，用于结果缓存（可选）
+
+        Returns:
+            str: 任务ID
+        """
+        task_data = self.build_task_data(prompt, image_url, example_image_url, user_id)
+        await self.dispatch(task_data, fingerprint=fingerprint)
+        return task_data['task_id']
+
+    async def dispatch_batch(self, jobs: List[Dict[str, Any]]) -> List[str]:
+        """
+        批量提交基础构图任务后立即返回（asyncio），所有任务在同一通道上流水线发布
+
+        Args:
+            jobs: 任务参数列表，每项包含 prompt, image_url, example_image_url, user_id
+                  以及可选的 fingerprint
+
+        Returns:
+            List[str]: 与任务一一对应的任务ID
+        """
+        jobs = [dict(job) for job in jobs]
+        fingerprints = [job.pop('fingerprint', None) for job in jobs]
+        task_data_list = [self.build_task_data(**job) for job in jobs]
+        await self.dispatch_many(task_data_list, fingerprints=fingerprints, batch=True)
+        return [task_data['task_id'] for task_data in task_data_list]
+
     def submit_task_async(self, prompt: str, image_url: str,
                        example_image_url: str = None,
                        user_id: str = 'anonymous') -> bool:
@@ -70,14 +143,5 @@ class BasicComposeService(BaseComposeService):
         Returns:
             bool: 是否提交成功
         """
-        task_id = f"basic_{int(time.time() * 1000)}"
-
-        task_data = {
-            'task_id': task_id,
-            'prompt': prompt,
-            'image_url': image_url,
-            'example_image_url': example_image_url,
-            'user_id': user_id
-        }
-
+        task_data = self.build_task_data(prompt, image_url, example_image_url, user_id)
         return self.send_task_async(task_data)
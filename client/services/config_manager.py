@@ -71,16 +71,32 @@ class ConfigManager:
             'upload': {
                 'allowed_extensions': ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp'],
                 'max_file_size': 10485760,  # 10MB
+                'max_workers': 8,
+                'multipart': {
+                    'threshold': 5242880,  # 5MB
+                    'part_size': 1048576,  # 1MB
+                    'concurrency': 4
+                },
+                'direct_upload': {
+                    'enabled': True,
+                    'folder': 'temp',
+                    'expires': 300,
+                    'complete_grace': 300,
+                    'header_bytes': 65536
+                },
                 'image_processing': {
                     'auto_compress': True,
                     'quality': 85,
+                    'target_max_side': 1536,
                     'max_width': 4096,
                     'max_height': 4096
                 },
                 'naming': {
                     'use_timestamp': True,
                     'use_uuid': True,
-                    'prefix': 'upload'
+                    'prefix': 'upload',
+                    'content_addressed': False,
+                    'index_ttl': 3600
                 }
             },
             'api': {
@@ -91,7 +107,10 @@ class ConfigManager:
                 'validate_file_type': True,
                 'rate_limit': {
                     'enabled': True,
-                    'max_requests_per_minute': 60
+                    'max_requests_per_minute': 60,
+                    'burst': 10,
+                    'max_backlog_per_user': 50,
+                    'user_weights': {}
                 }
             },
             'logging': {
@@ -0,0 +1,289 @@
+"""
+RabbitMQ同步连接池
+供同步调用路径（脚本、旧版生产者）复用长连接，所有构图服务共享
+"""
+
+import json
+import queue
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+
+import pika
+
+from config import Config
+
+
+logger = logging.getLogger(__name__)
+
+
+class PooledConnection:
+    """
+    池化连接
+
+    每个连接持有一个通道，并在该通道上常驻订阅直接回复队列，
+    任务结果按 correlation_id 匹配，无需每次重新订阅。
+    """
+
+    # RabbitMQ 直接回复伪队列，无需声明，结果只投递给发起请求的通道
+    DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
+
+    def __init__(self, parameters: pika.ConnectionParameters):
+        self.connection = pika.BlockingConnection(parameters)
+        self.channel = self.connection.channel()
+        self.task_id: Optional[str] = None
+        self.response: Optional[Dict[str, Any]] = None
+
+        # 直接回复模式要求 auto_ack，且必须在发布任务之前开始消费
+        self.channel.basic_consume(
+            queue=self.DIRECT_REPLY_TO,
+            on_message_callback=self._on_result,
+            auto_ack=True
+        )
+
+    @property
+    def is_open(self) -> bool:
+        """连接和通道是否可用"""
+        return self.connection.is_open and self.channel.is_open
+
+    def _on_result(self, ch, method, props, body):
+        """处理结果消息"""
+        try:
+            result = json.loads(body.decode('utf-8'))
+            result_task_id = props.correlation_id or result.get('task_id')
+
+            if self.task_id and result_task_id == self.task_id:
+                self.response = result
+            else:
+                logger.warning(f"收到无人等待的结果: task_id={result_task_id}")
+        except Exception as e:
+            logger.error(f"处理结果时出错: {e}")
+
+    def publish(self, queue_name: str, task_data: Dict[str, Any], reply: bool = False):
+        """
+        发布任务
+
+        Args:
+            queue_name: 任务队列名称
+            task_data: 任务数据（带 deadline 时按截止时间设置消息过期时间，带 priority 时设置消息优先级）
+            reply: 是否要求 Server 通过直接回复队列返回结果
+        """
+        task_id = task_data.get('task_id')
+        deadline = task_data.get('deadline')
+        self.channel.basic_publish(
+            exchange='',
+            routing_key=queue_name,
+            properties=pika.BasicProperties(
+                delivery_mode=2,
+                correlation_id=task_id,
+                reply_to=self.DIRECT_REPLY_TO if reply else None,
+                priority=task_data.get('priority'),
+                # 过期时间为毫秒字符串
+                expiration=str(max(0, int((deadline - time.time()) * 1000))) if deadline else None
+            ),
+            body=json.dumps(task_data)
+        )
+
+    def call(self, queue_name: str, task_data: Dict[str, Any], timeout: int) -> Optional[Dict[str, Any]]:
+        """
+        发布任务并等待结果
+
+        Returns:
+            Dict: 任务结果，超时返回 None
+        """
+        self.task_id = task_data.get('task_id')
+        self.response = None
+        deadline = task_data.setdefault('deadline', time.time() + timeout)
+
+        try:
+            self.publish(queue_name, task_data, reply=True)
+
+            while self.response is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.connection.process_data_events(time_limit=min(1, remaining))
+
+            return self.response
+        finally:
+            self.task_id = None
+
+    def close(self):
+        """关闭连接"""
+        try:
+            if self.connection.is_open:
+                self.connection.close()
+        except Exception as e:
+            logger.debug(f"关闭连接时出错: {e}")
+
+
+class BlockingConnectionPool:
+    """
+    RabbitMQ同步连接池
+
+    功能：
+    1. 按需创建、复用长连接，上限为 pool_size
+    2. 队列只在首次使用时声明一次
+    3. 后台线程定期为空闲连接处理心跳，断开的连接在下次借出时透明重建
+    """
+
+    def __init__(self, pool_size: int = None, heartbeat: int = None):
+        """初始化连接池"""
+        self.config = Config()
+        self.pool_size = pool_size or self.config.RABBITMQ_POOL_SIZE
+        self.heartbeat = heartbeat or self.config.RABBITMQ_HEARTBEAT
+        self._idle: "queue.LifoQueue[PooledConnection]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+        self._declared_queues = set()
+        self._lock = threading.Lock()
+        self._heartbeat_thread: Optional[threading.Thread] = None
+
+    def _parameters(self) -> pika.ConnectionParameters:
+        """构建连接参数"""
+        credentials = pika.PlainCredentials(
+            self.config.RABBITMQ_USER,
+            self.config.RABBITMQ_PASSWORD
+        )
+        return pika.ConnectionParameters(
+            host=self.config.RABBITMQ_HOST,
+            port=self.config.RABBITMQ_PORT,
+            virtual_host=self.config.RABBITMQ_VHOST,
+            credentials=credentials,
+            heartbeat=self.heartbeat
+        )
+
+    def _start_heartbeat_thread(self):
+        """启动后台心跳线程（只启动一次）"""
+        with self._lock:
+            if self._heartbeat_thread is not None:
+                return
+            self._heartbeat_thread = threading.Thread(
+                target=self._heartbeat_loop,
+                name="rabbitmq-pool-heartbeat",
+                daemon=True
+            )
+            self._heartbeat_thread.start()
+
+    def _heartbeat_loop(self):
+        """定期轮询空闲连接，处理心跳并剔除已断开的连接"""
+        interval = max(1, self.heartbeat // 3)
+        while True:
+            time.sleep(interval)
+            for _ in range(self._idle.qsize()):
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+
+                try:
+                    conn.connection.process_data_events(time_limit=0)
+                except Exception as e:
+                    logger.info(f"空闲连接已断开，将在下次使用时重建: {e}")
+                    conn.close()
+                    continue
+
+                if conn.is_open:
+                    self._idle.put(conn)
+
+    def _declare_dead_letter(self, conn: PooledConnection):
+        """声明死信交换机和死信队列（死信按 DEAD_LETTER_TTL 自动清理）"""
+        if self.config.DEAD_LETTER_QUEUE in self._declared_queues:
+            return
+
+        conn.channel.exchange_declare(
+            exchange=self.config.DEAD_LETTER_EXCHANGE,
+            exchange_type='fanout',
+            durable=True
+        )
+        conn.channel.queue_declare(
+            queue=self.config.DEAD_LETTER_QUEUE,
+            durable=True,
+            arguments={'x-message-ttl': self.config.DEAD_LETTER_TTL * 1000}
+        )
+        conn.channel.queue_bind(queue=self.config.DEAD_LETTER_QUEUE, exchange=self.config.DEAD_LETTER_EXCHANGE)
+        self._declared_queues.add(self.config.DEAD_LETTER_QUEUE)
+
+    def _declare_queue(self, conn: PooledConnection, queue_name: str):
+        """声明任务队列（每个队列只声明一次）"""
+        if queue_name in self._declared_queues:
+            return
+
+        self._declare_dead_letter(conn)
+
+        try:
+            conn.channel.queue_declare(
+                queue=queue_name,
+                durable=True,
+                arguments=self.config.TASK_QUEUE_ARGUMENTS
+            )
+        except pika.exceptions.ChannelClosedByBroker as e:
+            # 队列已由 Server 以不同参数声明，重建通道后只做被动检查
+            logger.warning(f"队列参数不匹配，改为被动声明: {queue_name}, {e}")
+            conn.channel = conn.connection.channel()
+            conn.channel.basic_consume(
+                queue=PooledConnection.DIRECT_REPLY_TO,
+                on_message_callback=conn._on_result,
+                auto_ack=True
+            )
+            conn.channel.queue_declare(queue=queue_name, passive=True)
+
+        self._declared_queues.add(queue_name)
+
+    @contextmanager
+    def acquire(self, queue_name: str = None):
+        """
+        借出一个可用连接
+
+        Args:
+            queue_name: 将要使用的任务队列（首次使用时声明）
+
+        Yields:
+            PooledConnection: 池化连接
+        """
+        self._start_heartbeat_thread()
+        self._slots.acquire()
+
+        conn = None
+        try:
+            while conn is None:
+                try:
+                    candidate = self._idle.get_nowait()
+                except queue.Empty:
+                    conn = PooledConnection(self._parameters())
+                    logger.info(f"连接池新建连接: {self.config.RABBITMQ_HOST}:{self.config.RABBITMQ_PORT}")
+                    break
+                if candidate.is_open:
+                    conn = candidate
+                else:
+                    candidate.close()
+
+            if queue_name:
+                self._declare_queue(conn, queue_name)
+
+            yield conn
+
+        except Exception:
+            # 出错的连接不再归还，下次借出时重建
+            if conn is not None:
+                conn.close()
+                conn = None
+            raise
+
+        finally:
+            if conn is not None and conn.is_open:
+                self._idle.put(conn)
+            self._slots.release()
+
+    def close(self):
+        """关闭所有空闲连接"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+# 创建全局同步连接池实例（基础/高级构图服务共享）
+blocking_pool = BlockingConnectionPool()
@@ -3,10 +3,16 @@
 """
 
 import os
+import time
 import uuid
+import base64
+import asyncio
 import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, Optional, Any
+from typing import Dict, Optional, Any, Tuple
 import logging
 from qcloud_cos import CosConfig, CosS3Client
 from qcloud_cos.cos_exception import CosServiceError, CosClientError
@@ -26,7 +32,26 @@ class COSService:
         """初始化COS服务"""
         self.cos_config = config_manager.get_cos_config()
         self.upload_config = config_manager.get_upload_config()
+        self.max_workers = self.upload_config.get('max_workers', 8)
         self.client = self._init_client()
+        # 上传专用线程池：校验、压缩和 put_object 都在线程中执行，不阻塞事件循环
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='cos-upload')
+        # 分块上传线程池：每个上传最多同时占用 multipart.concurrency 个线程
+        part_concurrency = self.upload_config.get('multipart', {}).get('concurrency', 4)
+        self._part_executor = ThreadPoolExecutor(
+            max_workers=self.max_workers * part_concurrency,
+            thread_name_prefix='cos-part'
+        )
+        # URL -> 内容 MD5 索引，供结果缓存等按内容识别图片
+        self._content_index: "OrderedDict[str, str]" = OrderedDict()
+        self._content_index_size = 10000
+        # 内容寻址模式下已确认存在的对象：remote_key -> (ETag, 确认时间)
+        # 对象所在文件夹可能配置了生命周期，记录超过 index_ttl 后重新 head_object 确认
+        self._key_index: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._key_index_ttl = self.upload_config.get('naming', {}).get('index_ttl', 3600)
+        # 已签发的浏览器直传对象：remote_key -> 过期时间，完成回调只接受其中未过期的路径
+        self._presigned_keys: "OrderedDict[str, float]" = OrderedDict()
+        self._presigned_lock = threading.Lock()
 
     def _init_client(self) -> CosS3Client:
         """初始化COS客户端"""
@@ -39,13 +64,54 @@ class COSService:
             config = CosConfig(
                 Region=self.cos_config['region'],
                 SecretId=self.cos_config['secret_id'],
-                SecretKey=self.cos_config['secret_key']
+                SecretKey=self.cos_config['secret_key'],
+                # HTTP 连接池与上传线程数一致，并发上传可复用 keep-alive 连接
+                PoolConnections=self.max_workers,
+                PoolMaxSize=self.max_workers
             )
             return CosS3Client(config)
         except Exception as e:
             logger.error(f"初始化COS客户端失败: {e}")
             raise
 
+    def _remember_content(self, url: str, content_id: str):
+        """记录 URL 对应的内容标识（容量有限，淘汰最久未使用的记录）"""
+        self._content_index[url] = content_id
+        self._content_index.move_to_end(url)
+        while len(self._content_index) > self._content_index_size:
+            self._content_index.popitem(last=False)
+
+    def get_content_id(self, file_url: str) -> Optional[str]:
+        """
+        获取图片的内容标识
+
+        优先使用本服务上传时记录的 MD5；本桶内的其他文件通过 head_object 读取 ETag；
+        外部URL无法识别内容，返回 None
+
+        Args:
+            file_url: 文件URL
+
+        Returns:
+            str: 内容标识，无法识别时返回 None
+        """
+        content_id = self._content_index.get(file_url)
+        if content_id:
+            self._content_index.move_to_end(file_url)
+            return content_id
+
+        domain = self.cos_config.get('domain', '').rstrip('/')
+        if not domain or not file_url.startswith(f"{domain}/"):
+            return None
+
+        remote_key = file_url[len(domain) + 1:].split('?', 1)[0]
+        file_info = self.get_file_info(remote_key)
+        if not file_info.get('success') or not file_info['data'].get('etag'):
+            return None
+
+        content_id = file_info['data']['etag']
+        self._remember_content(file_url, content_id)
+        return content_id
+
     def generate_filename(self, original_filename: str) -> str:
         """生成新的文件名"""
         # 获取文件扩展名
@@ -71,24 +137,105 @@ class COSService:
         filename = "_".join(parts) + ext
         return filename
 
-    def validate_file(self, file) -> Dict[str, Any]:
-        """验证文件"""
+    def generate_content_filename(self, original_filename: str, md5_hash: str) -> str:
+        """按内容 MD5 生成文件名（内容寻址模式，相同内容得到相同文件名）"""
+        ext = os.path.splitext(original_filename)[1].lower()
+        prefix = self.upload_config.get('naming', {}).get('prefix', 'upload')
+        return f"{prefix}_{md5_hash}{ext}"
+
+    def _hash_stream(self, stream) -> str:
+        """分块计算文件流的 MD5（不整体读入内存）"""
+        chunk_size = self.upload_config.get('multipart', {}).get('part_size', 1024 * 1024)
+        md5 = hashlib.md5()
+        stream.seek(0)
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            md5.update(chunk)
+        return md5.hexdigest()
+
+    def _remember_key(self, remote_key: str, etag: str):
+        """记录已存在的对象（容量有限，淘汰最久未使用的记录）"""
+        self._key_index[remote_key] = (etag, time.time())
+        self._key_index.move_to_end(remote_key)
+        while len(self._key_index) > self._content_index_size:
+            self._key_index.popitem(last=False)
+
+    def _find_object(self, remote_key: str) -> Optional[str]:
+        """
+        查找已存在的对象：先查本地索引，未命中或记录已过期时 head_object
+
+        Returns:
+            str: 对象 ETag，不存在或查询失败时返回 None
+        """
+        indexed = self._key_index.get(remote_key)
+        if indexed is not None:
+            etag, confirmed_at = indexed
+            if time.time() - confirmed_at < self._key_index_ttl:
+                self._key_index.move_to_end(remote_key)
+                return etag
+            # 对象可能已被生命周期规则删除，重新确认
+            self._key_index.pop(remote_key, None)
+
+        try:
+            response = self.client.head_object(
+                Bucket=self.cos_config['bucket'],
+                Key=remote_key
+            )
+        except CosServiceError as e:
+            if e.get_status_code() != 404:
+                logger.warning(f"查询对象失败，按新文件上传: {remote_key}, {e}")
+            return None
+        except Exception as e:
+            logger.warning(f"查询对象失败，按新文件上传: {remote_key}, {e}")
+            return None
+
+        etag = response.get('ETag', '')
+        self._remember_key(remote_key, etag)
+        return etag
+
+    @staticmethod
+    def _get_stream(file):
+        """获取底层文件对象（兼容FastAPI的UploadFile）"""
+        return file.file if hasattr(file, 'file') else file
+
+    def _read_content(self, file) -> bytes:
+        """读取文件内容"""
+        actual_file = self._get_stream(file)
+        actual_file.seek(0)
+        return actual_file.read()
+
+    def validate_file(self, file, content: Optional[bytes] = None) -> Dict[str, Any]:
+        """
+        验证文件
+
+        图片只解析文件头获取格式和尺寸，不解码像素，也不把整个文件读入内存；
+        解析得到的图片对象通过 image 字段返回，供 process_image 复用
+
+        Args:
+            file: 上传的文件对象
+            content: 已读取的文件内容（可选，未提供时直接从 file 的流中读取）
+
+        Returns:
+            验证结果字典
+        """
         result = {
             'valid': True,
             'error': None,
             'file_size': 0,
-            'is_image': False
+            'is_image': False,
+            'image': None
         }
 
         try:
-            # 获取底层文件对象（兼容FastAPI的UploadFile）
-            actual_file = file.file if hasattr(file, 'file') else file
+            if content is not None:
+                source = io.BytesIO(content)
+                file_size = len(content)
+            else:
+                source = self._get_stream(file)
+                source.seek(0, os.SEEK_END)
+                file_size = source.tell()
+                source.seek(0)
 
             # 检查文件大小
-            actual_file.seek(0, os.SEEK_END)
-            file_size = actual_file.tell()
-            actual_file.seek(0)
-
             result['file_size'] = file_size
             max_size = self.upload_config.get('max_file_size', 10 * 1024 * 1024)
 
@@ -117,16 +264,10 @@ class COSService:
             image_extensions = ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp']
             result['is_image'] = ext in image_extensions
 
-            # 如果是图片，验证图片格式
+            # 如果是图片，解析文件头检查格式和尺寸
             if result['is_image']:
                 try:
-                    actual_file.seek(0)
-                    img = Image.open(actual_file)
-                    img.verify()  # 验证图片文件
-
-                    # 检查图片尺寸
-                    actual_file.seek(0)
-                    img = Image.open(actual_file)
+                    img = Image.open(source)
                     width, height = img.size
 
                     max_width = self.upload_config.get('image_processing', {}).get('max_width', 4096)
@@ -137,68 +278,247 @@ class COSService:
                         result['error'] = f"图片尺寸超过限制 ({max_width}x{max_height})"
                         return result
 
-                    actual_file.seek(0)
+                    result['image'] = img
 
                 except Exception as e:
                     result['valid'] = False
                     result['error'] = f"无效的图片文件: {str(e)}"
                     return result
 
-            actual_file.seek(0)
-
         except Exception as e:
             result['valid'] = False
             result['error'] = f"文件验证失败: {str(e)}"
 
         return result
 
-    def process_image(self, file, filename: str) -> bytes:
-        """处理图片（压缩等）"""
-        # 获取底层文件对象（兼容FastAPI的UploadFile）
-        actual_file = file.file if hasattr(file, 'file') else file
+    def needs_processing(self, image: Image.Image) -> bool:
+        """图片是否需要重新编码（开启自动压缩或超过存储尺寸）"""
+        processing_config = self.upload_config.get('image_processing', {})
+        target_max_side = processing_config.get('target_max_side', 0)
+        return (processing_config.get('auto_compress', False)
+                or (bool(target_max_side) and max(image.size) > target_max_side))
 
-        if not self.upload_config.get('image_processing', {}).get('auto_compress', False):
-            actual_file.seek(0)
-            return actual_file.read()
+    @staticmethod
+    def verify_image(image: Image.Image):
+        """
+        校验图片数据完整性（不保留解码结果）
 
+        Raises:
+            ValueError: 图片数据损坏
+        """
         try:
-            actual_file.seek(0)
-            img = Image.open(actual_file)
+            image.verify()
+        except Exception as e:
+            raise ValueError(f"无效的图片文件: {str(e)}")
 
-            # 转换为RGB模式（处理RGBA等）
-            if img.mode in ('RGBA', 'P'):
-                img = img.convert('RGB')
+    def process_image(self, file, filename: str, image: Optional[Image.Image] = None,
+                      content: Optional[bytes] = None) -> bytes:
+        """
+        处理图片（缩放、压缩等）
 
-            # 获取配置
-            quality = self.upload_config.get('image_processing', {}).get('quality', 85)
+        最大边超过 target_max_side 时缩小到生成所需尺寸；JPEG 通过 draft 在 DCT 阶段按
+        1/2、1/4、1/8 缩放解码，不必先解码全分辨率。开启自动压缩或需要缩放时只做一次完整解码
+        再重新编码；两者都不需要时只校验数据完整性，原样返回
+
+        Args:
+            file: 上传的文件对象
+            filename: 新文件名
+            image: validate_file 解析得到的图片对象（可选）
+            content: 已读取的文件内容（可选）
+
+        Returns:
+            bytes: 处理后的文件内容
+
+        Raises:
+            ValueError: 图片数据损坏
+        """
+        if image is None:
+            image = Image.open(io.BytesIO(content) if content is not None else self._get_stream(file))
+
+        if not self.needs_processing(image):
+            self.verify_image(image)
+            return content if content is not None else self._read_content(file)
+
+        processing_config = self.upload_config.get('image_processing', {})
+        target_max_side = processing_config.get('target_max_side', 0)
+        source_format = image.format
+        width, height = image.size
+        needs_resize = bool(target_max_side) and max(width, height) > target_max_side
 
-            # 压缩图片
+        if needs_resize:
+            scale = target_max_side / max(width, height)
+            target_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            # JPEG 按不小于目标尺寸的最大缩放比例解码，其他格式忽略
+            image.draft('RGB', target_size)
+
+        try:
+            # 唯一一次完整解码：损坏的图片在这里暴露
+            image.load()
+        except Exception as e:
+            raise ValueError(f"无效的图片文件: {str(e)}")
+
+        try:
+            if needs_resize and image.size != target_size:
+                image = image.resize(target_size, Image.LANCZOS)
+
+            # 获取配置
+            quality = processing_config.get('quality', 85)
             output = io.BytesIO()
-            img.save(output, format='JPEG', quality=quality, optimize=True)
-            output.seek(0)
 
-            logger.info(f"图片压缩完成: {filename}")
-            return output.read()
+            if processing_config.get('auto_compress', False) or source_format == 'JPEG':
+                # 转换为RGB模式（处理RGBA等）
+                if image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+
+                # 压缩图片
+                image.save(output, format='JPEG', quality=quality, optimize=True)
+            else:
+                image.save(output, format=source_format)
+
+            logger.info(f"图片处理完成: {filename}, {width}x{height} -> {image.size[0]}x{image.size[1]}")
+            return output.getvalue()
 
         except Exception as e:
             logger.error(f"图片处理失败: {e}")
-            actual_file.seek(0)
-            return actual_file.read()
+            return content if content is not None else self._read_content(file)
+
+    def _upload_part(self, remote_key: str, upload_id: str, part_number: int, chunk: bytes) -> str:
+        """上传单个分块，返回分块 ETag"""
+        response = self.client.upload_part(
+            Bucket=self.cos_config["bucket"],
+            Key=remote_key,
+            Body=chunk,
+            PartNumber=part_number,
+            UploadId=upload_id,
+            ContentMD5=base64.b64encode(hashlib.md5(chunk).digest()).decode('ascii')
+        )
+        return response['ETag']
+
+    def _multipart_upload(self, stream, remote_key: str, md5_hash: Optional[str] = None,
+                          **headers) -> Tuple[Dict[str, Any], str]:
+        """
+        分块上传（边读边传，多个分块并行上传）
+
+        每个上传同时在内存中的分块不超过 multipart.concurrency 个，内存占用与文件大小无关
+
+        Args:
+            stream: 文件流
+            remote_key: COS路径
+            md5_hash: 已知的文件内容 MD5（内容寻址模式下已计算，不再重复计算）
+            headers: 对象头（ContentType 等）
+
+        Returns:
+            Tuple: (COS 响应, 文件内容 MD5)
+        """
+        multipart_config = self.upload_config.get('multipart', {})
+        part_size = multipart_config.get('part_size', 1024 * 1024)
+        slots = threading.BoundedSemaphore(multipart_config.get('concurrency', 4))
+
+        bucket = self.cos_config["bucket"]
+        upload_id = self.client.create_multipart_upload(Bucket=bucket, Key=remote_key, **headers)['UploadId']
+
+        md5 = hashlib.md5() if md5_hash is None else None
+        futures = []
+
+        try:
+            stream.seek(0)
+            while True:
+                slots.acquire()
+                # 已有分块失败时不再继续读取
+                if any(future.done() and future.exception() for future in futures):
+                    slots.release()
+                    break
+
+                chunk = stream.read(part_size)
+                if not chunk:
+                    slots.release()
+                    break
+
+                if md5 is not None:
+                    md5.update(chunk)
+                future = self._part_executor.submit(
+                    self._upload_part, remote_key, upload_id, len(futures) + 1, chunk
+                )
+                future.add_done_callback(lambda _: slots.release())
+                futures.append(future)
+
+            parts = [
+                {'PartNumber': part_number, 'ETag': future.result()}
+                for part_number, future in enumerate(futures, start=1)
+            ]
+            response = self.client.complete_multipart_upload(
+                Bucket=bucket,
+                Key=remote_key,
+                UploadId=upload_id,
+                MultipartUpload={'Part': parts}
+            )
+        except Exception:
+            try:
+                self.client.abort_multipart_upload(Bucket=bucket, Key=remote_key, UploadId=upload_id)
+            except Exception as e:
+                logger.warning(f"取消分块上传失败: {remote_key}, {e}")
+            raise
+
+        logger.info(f"分块上传完成: {remote_key}, 分块数: {len(futures)}")
+        return response, md5_hash if md5 is None else md5.hexdigest()
+
+    def _put_stream(self, stream, size: int, remote_key: str, md5_hash: Optional[str] = None,
+                    **headers) -> Tuple[Dict[str, Any], str]:
+        """
+        上传文件流：超过 multipart.threshold 时分块上传，否则一次 put_object
+
+        MD5 在读取文件的同一遍中计算（已知时直接使用，不再重复计算），并作为 Content-MD5 交给 COS 校验。
+        重新编码后的图片（auto_compress 或超过 target_max_side）远小于默认阈值，
+        分块上传只在不重新编码的大文件上发生
+
+        Returns:
+            Tuple: (COS 响应, 文件内容 MD5)
+        """
+        threshold = self.upload_config.get('multipart', {}).get('threshold', 5 * 1024 * 1024)
+        if size > threshold:
+            return self._multipart_upload(stream, remote_key, md5_hash, **headers)
+
+        stream.seek(0)
+        body = stream.read()
+        md5_digest = bytes.fromhex(md5_hash) if md5_hash else hashlib.md5(body).digest()
+        response = self.client.put_object(
+            Bucket=self.cos_config["bucket"],
+            Key=remote_key,
+            Body=body,
+            StorageClass="STANDARD",
+            ContentMD5=base64.b64encode(md5_digest).decode('ascii'),
+            **headers
+        )
+        return response, md5_digest.hex()
 
     def upload_file(self, file, folder: Optional[str] = None) -> Dict[str, Any]:
         """
         上传文件到COS
 
+        不需要重新编码的文件直接从上传流中读取上传，大文件走分块上传，不整体读入内存；
+        需要重新编码的图片直接从流中解码（最多一次），只保留缩放后的输出。
+        MD5 只计算一次并作为 Content-MD5 交给 COS 校验
+
         Args:
             file: 上传的文件对象
             folder: 目标文件夹（可选）
 
         Returns:
-            上传结果字典
+            上传结果字典（timings 字段为各阶段耗时，单位毫秒）
         """
+        timings = {}
+        stage_start = time.perf_counter()
+
+        def mark(stage: str):
+            nonlocal stage_start
+            now = time.perf_counter()
+            timings[stage] = round((now - stage_start) * 1000, 2)
+            stage_start = now
+
         try:
             # 验证文件
             validation_result = self.validate_file(file)
+            mark('validate')
             if not validation_result['valid']:
                 return {
                     'success': False,
@@ -213,16 +533,31 @@ class COSService:
             # 生成新文件名
             new_filename = self.generate_filename(original_filename)
 
-            # 处理文件内容
-            if validation_result['is_image']:
-                file_content = self.process_image(file, new_filename)
-            else:
-                actual_file = file.file if hasattr(file, 'file') else file
-                actual_file.seek(0)
-                file_content = actual_file.read()
+            # 处理文件内容：需要重新编码的图片得到新内容，其余直接使用上传流
+            stream, stream_size = self._get_stream(file), file_size
+            image = validation_result['image']
+            try:
+                if image is not None and self.needs_processing(image):
+                    file_content = self.process_image(file, new_filename, image)
+                    stream, stream_size = io.BytesIO(file_content), len(file_content)
+                elif image is not None:
+                    self.verify_image(image)
+            except ValueError as e:
+                return {
+                    'success': False,
+                    'error': str(e),
+                    'code': 'INVALID_FILE'
+                }
+            mark('process')
 
-            # 构建远程路径
+            # 构建远程路径（内容寻址模式下文件名由内容 MD5 决定）
             upload_folder = folder or self.cos_config.get('upload_folder', 'uploads')
+            content_addressed = self.upload_config.get('naming', {}).get('content_addressed', False)
+            md5_hash = None
+            if content_addressed:
+                md5_hash = self._hash_stream(stream)
+                new_filename = self.generate_content_filename(original_filename, md5_hash)
+                mark('hash')
             remote_key = f"{upload_folder}/{new_filename}"
 
             # 上传到COS
@@ -234,27 +569,32 @@ class COSService:
             if not content_type:
                 # 如果无法猜测，默认用二进制流
                 content_type = "application/octet-stream"
-            # 执行上传
-            response = self.client.put_object(
-                Bucket=self.cos_config["bucket"],
-                Key=remote_key,
-                Body=file_content,
-                StorageClass="STANDARD",
-                EnableMD5=True,
-
-                ContentType=content_type,
-                ContentDisposition="inline",  # 明确告诉浏览器这是展示内容
-                CacheControl=cache_control  # 避免错误 header 缓存
-            )
+            # 相同内容已存在时跳过上传
+            existing_etag = self._find_object(remote_key) if content_addressed else None
+            if existing_etag is not None:
+                response = {'ETag': existing_etag}
+                logger.info(f"文件内容已存在，跳过上传: {remote_key}")
+            else:
+                # 执行上传（同时计算MD5）
+                response, md5_hash = self._put_stream(
+                    stream,
+                    stream_size,
+                    remote_key,
+                    md5_hash,
+                    ContentType=content_type,
+                    ContentDisposition="inline",  # 明确告诉浏览器这是展示内容
+                    CacheControl=cache_control  # 避免错误 header 缓存
+                )
+                if content_addressed:
+                    self._remember_key(remote_key, response.get('ETag', ''))
+            mark('upload')
 
             # 生成访问URL
             file_url = f"{self.cos_config['domain']}/{remote_key}"
-
-            # 计算文件MD5
-            md5_hash = hashlib.md5(file_content).hexdigest()
+            self._remember_content(file_url, md5_hash)
 
             # 记录日志
-            logger.info(f"文件上传成功: {original_filename} -> {remote_key}")
+            logger.info(f"文件上传成功: {original_filename} -> {remote_key}, 耗时(ms): {timings}")
 
             return {
                 'success': True,
@@ -268,7 +608,9 @@ class COSService:
                     'content_type': 'image' if validation_result['is_image'] else 'document'
                 },
                 'etag': response.get('ETag', ''),
-                'upload_time': datetime.now().isoformat()
+                'deduplicated': existing_etag is not None,
+                'upload_time': datetime.now().isoformat(),
+                'timings': timings
             }
 
         except (CosServiceError, CosClientError) as e:
@@ -286,6 +628,298 @@ class COSService:
                 'code': 'UPLOAD_ERROR'
             }
 
+    def _direct_upload_config(self) -> Dict[str, Any]:
+        """浏览器直传配置"""
+        return self.upload_config.get('direct_upload', {})
+
+    def create_presigned_upload(self, original_filename: str, size: int,
+                                content_type: Optional[str] = None,
+                                folder: Optional[str] = None) -> Dict[str, Any]:
+        """
+        生成浏览器直传 COS 的预签名 PUT URL
+
+        Content-Length 参与签名，上传的文件必须与声明的大小一致，不能借此上传超过大小限制的对象。
+        签发的对象路径在服务端登记，浏览器上传完成后需调用 complete_direct_upload 完成校验和缩放
+
+        Args:
+            original_filename: 原始文件名
+            size: 文件大小（字节），不能超过 max_file_size
+            content_type: 文件类型（会参与签名，上传时必须使用相同的 Content-Type）
+            folder: 目标文件夹（可选）
+
+        Returns:
+            结果字典，data 中包含 upload_url、key、url、expires_in、headers
+        """
+        direct_config = self._direct_upload_config()
+        if not direct_config.get('enabled', True):
+            return {
+                'success': False,
+                'error': "未开启浏览器直传",
+                'code': 'DIRECT_UPLOAD_DISABLED'
+            }
+
+        ext = os.path.splitext(original_filename or '')[1][1:].lower()
+        if ext not in self.upload_config.get('allowed_extensions', []):
+            return {
+                'success': False,
+                'error': f"不支持的文件类型: {ext}",
+                'code': 'INVALID_FILE'
+            }
+
+        max_size = self.upload_config.get('max_file_size', 10 * 1024 * 1024)
+        if not isinstance(size, int) or isinstance(size, bool) or size <= 0 or size > max_size:
+            return {
+                'success': False,
+                'error': f"文件大小无效或超过限制 ({max_size} 字节)",
+                'code': 'INVALID_FILE'
+            }
+
+        upload_folder = folder or direct_config.get('folder', 'temp')
+        remote_key = f"{upload_folder}/{self.generate_filename(original_filename)}"
+        content_type = content_type or mimetypes.guess_type(original_filename)[0] or "application/octet-stream"
+        headers = {'Content-Type': content_type}
+        expires = direct_config.get('expires', 300)
+
+        try:
+            upload_url = self.client.get_presigned_url(
+                Bucket=self.cos_config['bucket'],
+                Key=remote_key,
+                Method='PUT',
+                Expired=expires,
+                # Content-Length 由浏览器按请求体自动设置，不在返回的 headers 中
+                Headers=dict(headers, **{'Content-Length': str(size)})
+            )
+        except Exception as e:
+            logger.error(f"生成预签名URL失败: {e}")
+            return {
+                'success': False,
+                'error': f"生成预签名URL失败: {str(e)}",
+                'code': 'COS_ERROR'
+            }
+
+        self._register_presigned_key(remote_key, expires + direct_config.get('complete_grace', 300))
+
+        return {
+            'success': True,
+            'data': {
+                'upload_url': upload_url,
+                'key': remote_key,
+                'size': size,
+                'url': f"{self.cos_config['domain']}/{remote_key}",
+                'expires_in': expires,
+                'headers': headers
+            }
+        }
+
+    def _register_presigned_key(self, remote_key: str, ttl: float):
+        """登记已签发的直传对象路径（同时清理过期的登记）"""
+        now = time.time()
+        with self._presigned_lock:
+            while self._presigned_keys and next(iter(self._presigned_keys.values())) <= now:
+                self._presigned_keys.popitem(last=False)
+            self._presigned_keys[remote_key] = now + ttl
+
+    def _claim_presigned_key(self, remote_key: str) -> bool:
+        """
+        取出已签发且未过期的直传对象路径（只能取出一次）
+
+        防止对服务端上传的对象或其他任意对象执行完成回调（重新下载、覆盖或删除）
+        """
+        with self._presigned_lock:
+            expires_at = self._presigned_keys.pop(remote_key, None)
+        return expires_at is not None and expires_at > time.time()
+
+    def _get_object_bytes(self, remote_key: str, byte_range: Optional[str] = None) -> bytes:
+        """读取对象内容（可只读取指定范围）"""
+        kwargs = {'Range': byte_range} if byte_range else {}
+        response = self.client.get_object(
+            Bucket=self.cos_config['bucket'],
+            Key=remote_key,
+            **kwargs
+        )
+        return response['Body'].get_raw_stream().read()
+
+    def complete_direct_upload(self, remote_key: str) -> Dict[str, Any]:
+        """
+        浏览器直传完成回调：按需校验和缩放
+
+        只读取对象元数据和文件头检查大小、格式和尺寸；仅在超过存储尺寸时才下载全文、
+        缩放并覆盖原对象。校验失败的对象会被删除
+
+        Args:
+            remote_key: create_presigned_upload 返回的 key
+
+        Returns:
+            上传结果字典（与 upload_file 一致）
+        """
+        if not self._claim_presigned_key(remote_key):
+            return {
+                'success': False,
+                'error': f"无效的对象路径: {remote_key}",
+                'code': 'INVALID_KEY'
+            }
+
+        timings = {}
+        stage_start = time.perf_counter()
+
+        def mark(stage: str):
+            nonlocal stage_start
+            now = time.perf_counter()
+            timings[stage] = round((now - stage_start) * 1000, 2)
+            stage_start = now
+
+        def reject(error: str) -> Dict[str, Any]:
+            self.delete_file(remote_key)
+            return {
+                'success': False,
+                'error': error,
+                'code': 'INVALID_FILE'
+            }
+
+        try:
+            head = self.client.head_object(
+                Bucket=self.cos_config['bucket'],
+                Key=remote_key
+            )
+            file_size = int(head.get('Content-Length', 0))
+            etag = head.get('ETag', '').strip('"')
+
+            max_size = self.upload_config.get('max_file_size', 10 * 1024 * 1024)
+            if file_size > max_size:
+                return reject(f"文件大小超过限制 ({max_size} 字节)")
+
+            filename = os.path.basename(remote_key)
+            ext = os.path.splitext(filename)[1][1:].lower()
+            is_image = ext in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp']
+            md5_hash = None
+
+            if is_image:
+                # 先只读取文件头解析尺寸，解析失败（文件头较大）再读取全文
+                header_bytes = self._direct_upload_config().get('header_bytes', 65536)
+                content = None
+                try:
+                    image = Image.open(io.BytesIO(self._get_object_bytes(remote_key, f"bytes=0-{header_bytes - 1}")))
+                except Exception:
+                    content = self._get_object_bytes(remote_key)
+                    try:
+                        image = Image.open(io.BytesIO(content))
+                    except Exception as e:
+                        return reject(f"无效的图片文件: {str(e)}")
+                mark('validate')
+
+                processing_config = self.upload_config.get('image_processing', {})
+                width, height = image.size
+                if width > processing_config.get('max_width', 4096) or height > processing_config.get('max_height', 4096):
+                    return reject(f"图片尺寸超过限制 ({processing_config.get('max_width', 4096)}x"
+                                  f"{processing_config.get('max_height', 4096)})")
+
+                target_max_side = processing_config.get('target_max_side', 0)
+                if target_max_side and max(width, height) > target_max_side:
+                    if content is None:
+                        content = self._get_object_bytes(remote_key)
+                    try:
+                        file_content = self.process_image(None, filename, content=content)
+                    except ValueError as e:
+                        return reject(str(e))
+                    mark('process')
+
+                    response, md5_hash = self._put_stream(
+                        io.BytesIO(file_content),
+                        len(file_content),
+                        remote_key,
+                        ContentType=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+                        ContentDisposition="inline",
+                        CacheControl="no-cache, max-age=0, must-revalidate"
+                    )
+                    etag = response.get('ETag', '').strip('"')
+                    mark('upload')
+
+            file_url = f"{self.cos_config['domain']}/{remote_key}"
+            # 简单上传的 ETag 即内容 MD5，可作为内容标识
+            self._remember_content(file_url, md5_hash or etag)
+
+            logger.info(f"直传文件已确认: {remote_key}, 耗时(ms): {timings}")
+
+            return {
+                'success': True,
+                'data': {
+                    'url': file_url,
+                    'filename': filename,
+                    'size': file_size,
+                    'md5': md5_hash,
+                    'folder': os.path.dirname(remote_key),
+                    'content_type': 'image' if is_image else 'document'
+                },
+                'etag': etag,
+                'upload_time': datetime.now().isoformat(),
+                'timings': timings
+            }
+
+        except (CosServiceError, CosClientError) as e:
+            logger.error(f"确认直传文件失败: {e}")
+            return {
+                'success': False,
+                'error': f"COS服务错误: {str(e)}",
+                'code': 'COS_ERROR'
+            }
+        except Exception as e:
+            logger.error(f"确认直传文件失败: {e}")
+            return {
+                'success': False,
+                'error': f"确认上传失败: {str(e)}",
+                'code': 'UPLOAD_ERROR'
+            }
+
+    async def aupload_file(self, file, folder: Optional[str] = None) -> Dict[str, Any]:
+        """
+        上传文件到COS（asyncio，在上传线程池中执行，不阻塞事件循环）
+
+        Args:
+            file: 上传的文件对象
+            folder: 目标文件夹（可选）
+
+        Returns:
+            上传结果字典
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.upload_file, file, folder)
+
+    def upload_bytes(self, content: bytes, filename: str, folder: Optional[str] = None) -> Dict[str, Any]:
+        """
+        上传内存中的文件内容到COS
+
+        Args:
+            content: 文件内容
+            filename: 文件名（用于校验扩展名和生成新文件名）
+            folder: 目标文件夹（可选）
+
+        Returns:
+            上传结果字典
+        """
+        file_obj = io.BytesIO(content)
+        file_obj.name = filename
+        return self.upload_file(file_obj, folder)
+
+    async def aupload_bytes(self, content: bytes, filename: str, folder: Optional[str] = None) -> Dict[str, Any]:
+        """上传内存中的文件内容到COS（asyncio，在上传线程池中执行）"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.upload_bytes, content, filename, folder)
+
+    async def acomplete_direct_upload(self, remote_key: str) -> Dict[str, Any]:
+        """浏览器直传完成回调（asyncio，在上传线程池中执行）"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.complete_direct_upload, remote_key)
+
+    async def aget_content_id(self, file_url: str) -> Optional[str]:
+        """获取图片的内容标识（asyncio，在上传线程池中执行）"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.get_content_id, file_url)
+
+    def close(self):
+        """关闭上传线程池（等待进行中的上传完成）"""
+        self._executor.shutdown(wait=True)
+        self._part_executor.shutdown(wait=True)
+
     def delete_file(self, remote_key: str) -> Dict[str, Any]:
         """删除COS文件"""
         try:
@@ -294,6 +928,8 @@ class COSService:
                 Key=remote_key
             )
 
+            self._key_index.pop(remote_key, None)
+
             logger.info(f"文件删除成功: {remote_key}")
             return {
                 'success': True,
@@ -0,0 +1,432 @@
+"""
+公平调度
+任务先进入按用户划分的待发送队列，按令牌桶限速、加权轮询发送到 RabbitMQ，
+单个用户的大量请求不会挤占其他用户
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+import logging
+from collections import deque
+from contextvars import ContextVar
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from config import Config
+from .async_producer import async_producer
+from .admission import AdmissionRejected, admission_controller
+from .config_manager import config_manager
+
+
+logger = logging.getLogger(__name__)
+
+# 当前请求的客户端地址（由 main.py 的中间件按请求设置），匿名任务按此区分调度用户
+client_address: ContextVar[Optional[str]] = ContextVar('client_address', default=None)
+
+
+def scheduling_key(task_data: Dict[str, Any]) -> str:
+    """
+    任务在调度器中所属的用户（限速、排队上限和权重按此划分）
+
+    未提供 user_id 或为 anonymous 的任务按提交请求的客户端地址区分（anonymous:<地址>），
+    避免所有未登录设备共用一个令牌桶和待发送队列。只用于调度，发送给 Server 的 user_id 保持原样
+
+    Args:
+        task_data: 任务数据
+
+    Returns:
+        str: 调度用户
+    """
+    user_id = task_data.get('user_id') or 'anonymous'
+    if user_id != 'anonymous':
+        return user_id
+    address = client_address.get()
+    return f"anonymous:{address}" if address else user_id
+
+
+class TokenBucket:
+    """令牌桶：按固定速率补充令牌，容量即允许的突发数"""
+
+    def __init__(self, rate: float, capacity: int):
+        """
+        Args:
+            rate: 每秒补充的令牌数
+            capacity: 令牌桶容量
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        """按流逝时间补充令牌"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_take(self) -> bool:
+        """取一个令牌，没有可用令牌时返回 False"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self) -> float:
+        """距离下一个令牌可用的秒数"""
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self) -> bool:
+        """令牌是否已补满（与新建的令牌桶等价）"""
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class FairScheduler:
+    """
+    公平调度器
+
+    功能：
+    1. 每个用户一个待发送队列（同一用户内优先级高的任务先发），超过上限时拒绝新任务
+    2. 每个用户一个令牌桶（security.rate_limit），限制发送到 RabbitMQ 的速率
+    3. 按用户权重加权轮询，从各用户的待发送队列中取任务批量发送
+    4. 已发送未完成的任务数不超过 SCHEDULER_MAX_INFLIGHT，其余任务留在本地排队，
+       保证新到的用户只需等待一个发送窗口
+    5. 统计最近的完成速率，供准入控制估算排队时间
+    """
+
+    # 统计完成速率的时间窗口（秒）
+    THROUGHPUT_WINDOW = 60
+    # 清理空闲令牌桶的间隔（秒）
+    BUCKET_PRUNE_INTERVAL = 60
+
+    def __init__(self):
+        """初始化公平调度器"""
+        rate_limit = config_manager.get_security_config().get('rate_limit', {})
+        self.rate_limit_enabled = rate_limit.get('enabled', True)
+        self.rate = rate_limit.get('max_requests_per_minute', 60) / 60
+        self.burst = rate_limit.get('burst', 10)
+        self.max_backlog = rate_limit.get('max_backlog_per_user', 50)
+        self.weights: Dict[str, int] = rate_limit.get('user_weights') or {}
+        self.max_inflight = Config.SCHEDULER_MAX_INFLIGHT
+        self.enabled = self.max_inflight > 0
+
+        # 用户 -> 待发送任务堆 [(-优先级, 序号, 任务)]
+        self._backlogs: Dict[str, List[Tuple[int, int, Dict[str, Any]]]] = {}
+        # task_id -> 待发送任务
+        self._queued: Dict[str, Dict[str, Any]] = {}
+        # 轮询顺序和各用户本轮剩余份额
+        self._ring: "deque[str]" = deque()
+        self._credits: Dict[str, int] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._buckets_pruned_at = time.monotonic()
+        # 最近完成（释放发送窗口）的时间
+        self._completions: "deque[float]" = deque()
+        self._started_at = time.monotonic()
+        self._sequence = itertools.count()
+        self._inflight = 0
+        self.dispatched = 0
+        self.rejected = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._refill_timer: Optional[asyncio.TimerHandle] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    @property
+    def backlog_size(self) -> int:
+        """本地排队的任务数"""
+        return len(self._queued)
+
+    def start(self):
+        """启动发送协程"""
+        if self.enabled and self._dispatcher is None:
+            self._started_at = time.monotonic()
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止发送协程，排队中的任务按发送失败处理"""
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        if self._refill_timer is not None:
+            self._refill_timer.cancel()
+            self._refill_timer = None
+
+        for job in list(self._queued.values()):
+            self._finish(job, '服务正在关闭')
+        self._queued.clear()
+        self._backlogs.clear()
+        self._ring.clear()
+
+    def _weight(self, user_id: str) -> int:
+        """用户权重（每轮最多连续发送的任务数）"""
+        return max(1, int(self.weights.get(user_id, 1)))
+
+    def _bucket(self, user_id: str) -> TokenBucket:
+        """获取用户的令牌桶"""
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def _prune_buckets(self):
+        """删除没有待发送任务且令牌已补满的令牌桶（每个出现过的用户都会留下一个令牌桶）"""
+        now = time.monotonic()
+        if now - self._buckets_pruned_at < self.BUCKET_PRUNE_INTERVAL:
+            return
+        self._buckets_pruned_at = now
+        for user_id in [user_id for user_id, bucket in self._buckets.items()
+                        if user_id not in self._backlogs and bucket.is_full()]:
+            del self._buckets[user_id]
+
+    def estimated_wait(self, count: int = 1) -> Optional[float]:
+        """
+        按最近的完成速率估算新任务在本地排队的时间
+
+        Args:
+            count: 新任务数
+
+        Returns:
+            float: 预计等待秒数；发送窗口有空位时为 0，统计窗口内没有任何任务完成时为 inf；
+                   启动不久、尚无完成记录时无法估算，返回 None
+        """
+        if not self.enabled or (not self._queued and self._inflight + count <= self.max_inflight):
+            return 0.0
+
+        now = time.monotonic()
+        while self._completions and now - self._completions[0] > self.THROUGHPUT_WINDOW:
+            self._completions.popleft()
+        elapsed = min(self.THROUGHPUT_WINDOW, now - self._started_at)
+        if not self._completions:
+            return float('inf') if elapsed >= self.THROUGHPUT_WINDOW else None
+        return (len(self._queued) + count) * elapsed / len(self._completions)
+
+    async def submit(self, queue_name: str, result_queue: str,
+                     task_data_list: List[Dict[str, Any]],
+                     on_progress: Callable[[str, Dict[str, Any]], None] = None) -> List[asyncio.Future]:
+        """
+        提交任务到待发送队列（参数与 async_producer.publish_many 一致）
+
+        Args:
+            queue_name: 任务队列名称
+            result_queue: 结果队列名称
+            task_data_list: 任务数据列表（每项必须包含 task_id）
+            on_progress: 收到进度通知时的回调（可选）
+
+        Returns:
+            List[asyncio.Future]: 与任务数据一一对应的结果 Future
+
+        Raises:
+            AdmissionRejected: 用户待发送任务超过上限
+        """
+        if not self.enabled:
+            return await async_producer.publish_many(queue_name, result_queue, task_data_list, on_progress)
+
+        user_ids = [scheduling_key(task_data) for task_data in task_data_list]
+        counts: Dict[str, int] = {}
+        for user_id in user_ids:
+            counts[user_id] = counts.get(user_id, 0) + 1
+        for user_id, count in counts.items():
+            if len(self._backlogs.get(user_id, ())) + count > self.max_backlog:
+                self.rejected += 1
+                logger.warning(f"[{queue_name}] 用户待发送任务过多，拒绝: {user_id}")
+                raise AdmissionRejected(
+                    f"请求过于频繁，请稍后重试: 待处理任务已达上限 ({self.max_backlog})",
+                    Config.ADMISSION_RETRY_AFTER
+                )
+
+        self.start()
+        self._prune_buckets()
+        loop = asyncio.get_running_loop()
+        futures = []
+        for task_data, user_id in zip(task_data_list, user_ids):
+            job = {
+                'task_data': task_data,
+                'target': (queue_name, result_queue, on_progress),
+                'future': loop.create_future()
+            }
+            if user_id not in self._backlogs:
+                self._backlogs[user_id] = []
+                self._credits[user_id] = self._weight(user_id)
+                self._ring.append(user_id)
+            entry = (-(task_data.get('priority') or 0), next(self._sequence), job)
+            heapq.heappush(self._backlogs[user_id], entry)
+            self._queued[task_data['task_id']] = job
+            # 等待方超时或取消时立即移出排队计数（堆中的条目在轮到时丢弃）
+            job['future'].add_done_callback(lambda _, job=job: self._unqueue(job))
+            futures.append(job['future'])
+
+        self._wakeup.set()
+        return futures
+
+    def _unqueue(self, job: Dict[str, Any]):
+        """移除排队记录（只移除同一个任务，避免误删相同 task_id 后来提交的任务）"""
+        task_id = job['task_data']['task_id']
+        if self._queued.get(task_id) is job:
+            del self._queued[task_id]
+
+    def is_queued(self, task_id: str) -> bool:
+        """任务是否仍在本地排队"""
+        return task_id in self._queued
+
+    def cancel(self, task_id: str) -> bool:
+        """
+        取消本地排队中的任务（不会再发送）
+
+        Returns:
+            bool: 任务是否仍在排队
+        """
+        job = self._queued.pop(task_id, None)
+        if job is None:
+            return False
+        if not job['future'].done():
+            job['future'].set_result({'success': False, 'task_id': task_id, 'cancelled': True, 'error': '任务已取消'})
+        return True
+
+    @staticmethod
+    def _finish(job: Dict[str, Any], error: str):
+        """以发送失败结束任务"""
+        if not job['future'].done():
+            job['future'].set_result({
+                'success': False,
+                'task_id': job['task_data']['task_id'],
+                'error': f"任务发送失败: {error}"
+            })
+
+    def _select(self, limit: int) -> List[Dict[str, Any]]:
+        """
+        加权轮询选出本轮要发送的任务
+
+        用户本轮份额用完时轮到下一个用户；令牌不足的用户跳过，所有用户都被限速时提前结束。
+        """
+        selected = []
+        blocked = 0
+        while len(selected) < limit and self._ring:
+            user_id = self._ring[0]
+            backlog = self._backlogs[user_id]
+
+            # 丢弃已取消或已结束的任务
+            while backlog and backlog[0][2]['future'].done():
+                self._queued.pop(heapq.heappop(backlog)[2]['task_data']['task_id'], None)
+            if not backlog:
+                self._ring.popleft()
+                del self._backlogs[user_id]
+                del self._credits[user_id]
+                continue
+
+            if self._credits[user_id] <= 0:
+                self._credits[user_id] = self._weight(user_id)
+                self._ring.rotate(-1)
+                continue
+
+            if self.rate_limit_enabled and not self._bucket(user_id).try_take():
+                self._ring.rotate(-1)
+                blocked += 1
+                if blocked >= len(self._ring):
+                    break
+                continue
+
+            blocked = 0
+            job = heapq.heappop(backlog)[2]
+            self._queued.pop(job['task_data']['task_id'], None)
+            self._credits[user_id] -= 1
+            selected.append(job)
+
+        return selected
+
+    def _next_refill(self) -> Optional[float]:
+        """所有排队用户都被限速时，距离最早一个令牌可用的秒数"""
+        if not self.rate_limit_enabled or not self._ring:
+            return None
+        return min(self._bucket(user_id).wait_time() for user_id in self._ring)
+
+    async def _run(self):
+        """发送协程：窗口有空位且有任务时按轮询结果批量发送"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            jobs = self._select(self.max_inflight - self._inflight)
+            if not jobs:
+                delay = self._next_refill() if self._inflight < self.max_inflight else None
+                if delay is not None:
+                    if self._refill_timer is not None:
+                        self._refill_timer.cancel()
+                    self._refill_timer = loop.call_later(max(delay, 0.01), self._wakeup.set)
+                continue
+
+            # 按目标队列分组，每组在同一通道上流水线发布
+            groups: Dict[Tuple, List[Dict[str, Any]]] = {}
+            for job in jobs:
+                groups.setdefault(job['target'], []).append(job)
+
+            for (queue_name, result_queue, on_progress), group in groups.items():
+                try:
+                    inner_futures = await async_producer.publish_many(
+                        queue_name, result_queue, [job['task_data'] for job in group], on_progress
+                    )
+                except Exception as e:
+                    logger.error(f"[{queue_name}] 发送任务失败: {e}")
+                    for job in group:
+                        self._finish(job, str(e))
+                    continue
+
+                for job, inner in zip(group, inner_futures):
+                    self._chain(job['future'], inner)
+                self.dispatched += len(group)
+
+            # 本轮可能未取满窗口，继续下一轮
+            self._wakeup.set()
+
+    def _chain(self, outer: asyncio.Future, inner: asyncio.Future):
+        """将生产者的结果 Future 接到调度器返回的 Future 上，并占用一个发送窗口"""
+        self._inflight += 1
+
+        def on_inner_done(_):
+            self._inflight -= 1
+            # 只统计 Server 实际处理完成的任务，超时或取消的任务不计入完成速率
+            if (not inner.cancelled() and inner.exception() is None
+                    and not inner.result().get('cancelled')):
+                self._completions.append(time.monotonic())
+            self._wakeup.set()
+            if outer.done():
+                return
+            if inner.cancelled():
+                outer.cancel()
+            else:
+                outer.set_result(inner.result())
+
+        def on_outer_done(_):
+            # 等待方超时或取消时，同时结束生产者的等待记录
+            if not inner.done():
+                inner.cancel()
+
+        inner.add_done_callback(on_inner_done)
+        outer.add_done_callback(on_outer_done)
+
+    def stats(self) -> Dict[str, Any]:
+        """调度统计"""
+        return {
+            'enabled': self.enabled,
+            'inflight': self._inflight,
+            'backlog': len(self._queued),
+            'users': len(self._ring),
+            'buckets': len(self._buckets),
+            'dispatched': self.dispatched,
+            'rejected': self.rejected
+        }
+
+
+# 创建全局公平调度器实例
+fair_scheduler = FairScheduler()
+# 准入控制计入本地排队的任务（admission 不能直接导入本模块，否则循环导入）
+admission_controller.attach_scheduler(fair_scheduler)
@@ -0,0 +1,149 @@
+"""
+图片下载客户端
+进程内共享一个带连接池的 aiohttp 会话，所有需要下载远程图片的组件复用
+"""
+
+import asyncio
+import logging
+from typing import Optional
+
+import aiohttp
+
+from config import Config
+
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadError(Exception):
+    """图片下载失败"""
+
+
+class ImageDownloader:
+    """
+    图片下载客户端
+
+    功能：
+    1. 整个进程共用一个会话：连接保活、DNS 缓存、TLS 会话复用
+    2. 总连接数和单主机连接数有上限
+    3. 连接、读取和总耗时都有超时
+    4. 限制响应体大小，按 Content-Length 预分配缓冲区并流式写入
+    """
+
+    def __init__(self):
+        """初始化下载客户端（会话在首次下载时创建，需在事件循环内）"""
+        self.config = Config()
+        self.max_bytes = self.config.DOWNLOAD_MAX_BYTES
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_lock: Optional[asyncio.Lock] = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """获取共享会话（不存在或已关闭时创建）"""
+        if self._session_lock is None:
+            self._session_lock = asyncio.Lock()
+
+        async with self._session_lock:
+            if self._session is None or self._session.closed:
+                connector = aiohttp.TCPConnector(
+                    limit=self.config.DOWNLOAD_POOL_SIZE,
+                    limit_per_host=self.config.DOWNLOAD_LIMIT_PER_HOST,
+                    ttl_dns_cache=300,
+                    keepalive_timeout=60
+                )
+                timeout = aiohttp.ClientTimeout(
+                    total=self.config.DOWNLOAD_TIMEOUT,
+                    connect=self.config.DOWNLOAD_CONNECT_TIMEOUT,
+                    sock_read=self.config.DOWNLOAD_CONNECT_TIMEOUT * 2
+                )
+                self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+                logger.info("图片下载会话已创建")
+            return self._session
+
+    async def fetch(self, url: str) -> bytearray:
+        """
+        下载图片到内存
+
+        Args:
+            url: 图片URL
+
+        Returns:
+            bytearray: 图片数据
+
+        Raises:
+            DownloadError: 状态码异常、超过大小限制或超时
+        """
+        session = await self._get_session()
+
+        try:
+            async with session.get(url) as resp:
+                if resp.status != 200:
+                    raise DownloadError(f"图片下载失败: {url} ({resp.status})")
+
+                content_length = resp.content_length
+                if content_length is not None and content_length > self.max_bytes:
+                    raise DownloadError(f"图片超过大小限制: {url} ({content_length} > {self.max_bytes} 字节)")
+
+                if resp.headers.get('Content-Encoding', 'identity') != 'identity':
+                    # 压缩传输时 Content-Length 为压缩后长度，按未知长度处理
+                    content_length = None
+
+                if content_length is not None:
+                    # 已知长度：预分配缓冲区，分块直接写入
+                    buffer = bytearray(content_length)
+                    view = memoryview(buffer)
+                    offset = 0
+                    async for chunk in resp.content.iter_chunked(64 * 1024):
+                        end = offset + len(chunk)
+                        if end > content_length:
+                            raise DownloadError(f"图片数据超过声明长度: {url}")
+                        view[offset:end] = chunk
+                        offset = end
+                    if offset != content_length:
+                        raise DownloadError(f"图片数据不完整: {url} ({offset}/{content_length} 字节)")
+                    return buffer
+
+                # 未知长度（分块传输）：边读边检查大小
+                buffer = bytearray()
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    buffer += chunk
+                    if len(buffer) > self.max_bytes:
+                        raise DownloadError(f"图片超过大小限制: {url} (> {self.max_bytes} 字节)")
+                return buffer
+
+        except asyncio.TimeoutError:
+            raise DownloadError(f"图片下载超时: {url}")
+        except aiohttp.ClientError as e:
+            raise DownloadError(f"图片下载失败: {url} ({e})")
+
+    async def head(self, url: str) -> Optional[str]:
+        """
+        发送 HEAD 请求获取图片的版本标识（不下载图片数据）
+
+        Args:
+            url: 图片URL
+
+        Returns:
+            Optional[str]: ETag，没有时为 Last-Modified；请求失败或服务器均未返回时为 None
+        """
+        session = await self._get_session()
+
+        try:
+            async with session.head(url, allow_redirects=True) as resp:
+                if resp.status != 200:
+                    logger.warning(f"获取图片版本标识失败: {url} ({resp.status})")
+                    return None
+                return resp.headers.get('ETag') or resp.headers.get('Last-Modified')
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            logger.warning(f"获取图片版本标识失败: {url} ({e})")
+            return None
+
+    async def close(self):
+        """关闭共享会话"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("图片下载会话已关闭")
+        self._session = None
+
+
+# 创建全局图片下载客户端实例
+image_downloader = ImageDownloader()
@@ -0,0 +1,256 @@
+"""
+结果缓存
+按任务内容指纹缓存生成结果，相同输入直接返回，不再发送到 RabbitMQ
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+from config import Config
+
+
+logger = logging.getLogger(__name__)
+
+
+def build_fingerprint(*parts: Any) -> str:
+    """
+    根据任务内容生成指纹
+
+    Args:
+        parts: 参与计算的内容（图片内容标识、提示词、示例图等），需可 JSON 序列化
+
+    Returns:
+        str: SHA-256 十六进制指纹
+    """
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    结果缓存
+
+    功能：
+    1. 内存层：LRU + TTL，超过容量淘汰最久未访问的条目
+    2. 磁盘层（可选）：每个条目一个 JSON 文件，进程重启后仍可命中；
+       超过条目上限时删除最久未访问的文件
+    3. 在事件循环中使用时，磁盘读写在线程池中执行，不阻塞事件循环
+    4. 统计命中/未命中次数
+    """
+
+    def __init__(self, ttl: int = None, max_size: int = None, cache_dir: str = None,
+                 max_disk_entries: int = None):
+        """
+        初始化结果缓存
+
+        Args:
+            ttl: 条目有效期（秒）
+            max_size: 内存层最大条目数
+            cache_dir: 磁盘层目录，为空时不启用磁盘层
+            max_disk_entries: 磁盘层最大条目数
+        """
+        config = Config()
+        self.ttl = ttl or config.RESULT_CACHE_TTL
+        self.max_size = max_size or config.RESULT_CACHE_MAX_SIZE
+        self.cache_dir = config.RESULT_CACHE_DIR if cache_dir is None else cache_dir
+        self.max_disk_entries = max_disk_entries or config.RESULT_CACHE_DISK_MAX_ENTRIES
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # 磁盘层索引（按访问顺序），线程池与事件循环共同访问，需加锁
+        self._disk_keys: "OrderedDict[str, None]" = OrderedDict()
+        self._disk_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._load_disk_index()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _disk_path(self, key: str) -> str:
+        """磁盘层文件路径（按前两位分目录，避免单目录文件过多）"""
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _load_disk_index(self):
+        """扫描磁盘层，按修改时间建立索引并淘汰超出上限的文件"""
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    files.append((os.path.getmtime(os.path.join(root, name)), name[:-len('.json')]))
+                except OSError:
+                    pass
+
+        with self._disk_lock:
+            for _, key in sorted(files):
+                self._disk_keys[key] = None
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """删除超出条目上限的最久未访问文件（调用方持有锁）"""
+        while len(self._disk_keys) > self.max_disk_entries:
+            key, _ = self._disk_keys.popitem(last=False)
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def _in_disk(self, key: str) -> bool:
+        """磁盘层是否有该条目（只查索引，不访问磁盘）"""
+        return bool(self.cache_dir) and key in self._disk_keys
+
+    @staticmethod
+    def _run_off_loop(func, *args):
+        """在事件循环中时交给线程池执行，否则直接执行"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            func(*args)
+            return
+        loop.run_in_executor(None, func, *args)
+
+    def _read_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        """从磁盘层读取条目"""
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            with self._disk_lock:
+                self._disk_keys.pop(key, None)
+            return None
+        except Exception as e:
+            logger.warning(f"读取磁盘缓存失败: {path}, {e}")
+            return None
+
+        with self._disk_lock:
+            if key in self._disk_keys:
+                self._disk_keys.move_to_end(key)
+        return entry
+
+    def _write_disk(self, key: str, entry: Dict[str, Any]):
+        """写入磁盘层（先写临时文件再替换，避免读到半个文件）"""
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"写入磁盘缓存失败: {path}, {e}")
+            return
+
+        with self._disk_lock:
+            self._disk_keys[key] = None
+            self._disk_keys.move_to_end(key)
+            self._evict_disk()
+
+    def _remove_disk(self, key: str):
+        """删除磁盘层条目"""
+        with self._disk_lock:
+            self._disk_keys.pop(key, None)
+        try:
+            os.remove(self._disk_path(key))
+        except OSError:
+            pass
+
+    def _put_memory(self, key: str, entry: Dict[str, Any]):
+        """写入内存层并按容量淘汰"""
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        查询缓存（同步读取磁盘层，事件循环中请使用 aget）
+
+        Args:
+            key: 任务指纹
+
+        Returns:
+            Dict: 缓存的结果，未命中或已过期返回 None
+        """
+        entry = self._entries.get(key)
+
+        if entry is None and self._in_disk(key):
+            entry = self._read_disk(key)
+            if entry is not None:
+                self._put_memory(key, entry)
+
+        return self._resolve(key, entry)
+
+    async def aget(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        查询缓存（磁盘层在线程池中读取）
+
+        Args:
+            key: 任务指纹
+
+        Returns:
+            Dict: 缓存的结果，未命中或已过期返回 None
+        """
+        entry = self._entries.get(key)
+
+        if entry is None and self._in_disk(key):
+            entry = await asyncio.get_running_loop().run_in_executor(None, self._read_disk, key)
+            if entry is not None:
+                self._put_memory(key, entry)
+
+        return self._resolve(key, entry)
+
+    def _resolve(self, key: str, entry: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """检查条目是否有效并统计命中"""
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if entry['expires_at'] <= time.time():
+            self._entries.pop(key, None)
+            if self.cache_dir:
+                self._run_off_loop(self._remove_disk, key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry['value']
+
+    def set(self, key: str, value: Dict[str, Any]):
+        """
+        写入缓存
+
+        Args:
+            key: 任务指纹
+            value: 任务结果
+        """
+        entry = {'expires_at': time.time() + self.ttl, 'value': value}
+        self._put_memory(key, entry)
+        if self.cache_dir:
+            self._run_off_loop(self._write_disk, key, entry)
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存统计"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'disk_size': len(self._disk_keys),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0
+        }
+
+
+# 创建全局结果缓存实例
+result_cache = ResultCache()
@@ -3,9 +3,10 @@
 统一管理所有构图服务
 """
 
-from typing import Dict, Any, List
+from typing import Awaitable, Callable, Dict, Any, List
 from .basic_compose_service import BasicComposeService
 from .advanced_compose_service import AdvancedComposeService
+from .task_store import task_store
 import logging
 
 
@@ -54,6 +55,65 @@ class ServiceFactory:
         service = BasicComposeService()
         return service.submit_task(prompt, image_url, example_image_url, user_id)
 
+    @classmethod
+    async def asubmit_basic_task(cls, prompt: str, image_url: str,
+                                 example_image_url: str = None,
+                                 user_id: str = 'anonymous',
+                                 fingerprint: str = None,
+                                 is_disconnected: Callable[[], Awaitable[bool]] = None) -> Dict[str, Any]:
+        """
+        快捷方法：提交基础构图任务并等待结果（asyncio，不阻塞事件循环）
+
+        Args:
+            prompt: 提示词
+            image_url: 基础图像URL
+            example_image_url: 示例图像URL（可选）
+            user_id: 用户ID
+            fingerprint: 任务内容指纹，用于结果缓存（可选）
+            is_disconnected: 检查客户端是否已断开的回调，断开后取消任务（可选）
+
+        Returns:
+            Dict: 任务结果
+        """
+        service = BasicComposeService()
+        return await service.asubmit_task(prompt, image_url, example_image_url, user_id, fingerprint, is_disconnected)
+
+    @classmethod
+    async def dispatch_basic_task(cls, prompt: str, image_url: str,
+                                  example_image_url: str = None,
+                                  user_id: str = 'anonymous',
+                                  fingerprint: str = None) -> str:
+        """
+        快捷方法：提交基础构图任务后立即返回任务ID（结果通过 /api/tasks/{task_id} 查询）
+
+        Args:
+            prompt: 提示词
+            image_url: 基础图像URL
+            example_image_url: 示例图像URL（可选）
+            user_id: 用户ID
+            fingerprint: 任务内容指纹，用于结果缓存（可选）
+
+        Returns:
+            str: 任务ID
+        """
+        service = BasicComposeService()
+        return await service.dispatch_task(prompt, image_url, example_image_url, user_id, fingerprint)
+
+    @classmethod
+    async def dispatch_basic_batch(cls, jobs: List[Dict[str, Any]]) -> List[str]:
+        """
+        快捷方法：批量提交基础构图任务，立即返回任务ID列表
+
+        Args:
+            jobs: 任务参数列表，每项包含 prompt, image_url, example_image_url, user_id
+                  以及可选的 fingerprint
+
+        Returns:
+            List[str]: 与任务一一对应的任务ID
+        """
+        service = BasicComposeService()
+        return await service.dispatch_batch(jobs)
+
     @classmethod
     def submit_advanced_task(cls, prompt: str, images: List[Dict[str, Any]] = None,
                           image_url: str = None,
@@ -77,6 +137,96 @@ class ServiceFactory:
         """
         service = AdvancedComposeService()
         return service.submit_task(prompt, images, image_url, composition_type, layout, example_image_url, user_id)
+
+    @classmethod
+    async def asubmit_advanced_task(cls, prompt: str, images: List[Dict[str, Any]] = None,
+                                    image_url: str = None,
+                                    composition_type: str = 'grid', layout: Dict = None,
+                                    example_image_url: str = None,
+                                    user_id: str = 'anonymous',
+                                    fingerprint: str = None,
+                                    is_disconnected: Callable[[], Awaitable[bool]] = None) -> Dict[str, Any]:
+        """
+        快捷方法：提交高级构图任务并等待结果（asyncio，不阻塞事件循环）
+
+        Args:
+            prompt: 提示词
+            images: 图像列表 (可选)
+            image_url: 单张图像URL (可选，与images二选一)
+            composition_type: 构图类型
+            layout: 布局参数
+            example_image_url: 示例图像URL（可选）
+            user_id: 用户ID
+            fingerprint: 任务内容指纹，用于结果缓存（可选）
+            is_disconnected: 检查客户端是否已断开的回调，断开后取消任务（可选）
+
+        Returns:
+            Dict: 任务结果
+        """
+        service = AdvancedComposeService()
+        return await service.asubmit_task(prompt, images, image_url, composition_type, layout, example_image_url, user_id, fingerprint, is_disconnected)
+
+    @classmethod
+    async def dispatch_advanced_task(cls, prompt: str, images: List[Dict[str, Any]] = None,
+                                     image_url: str = None,
+                                     composition_type: str = 'grid', layout: Dict = None,
+                                     example_image_url: str = None,
+                                     user_id: str = 'anonymous',
+                                     fingerprint: str = None) -> str:
+        """
+        快捷方法：提交高级构图任务后立即返回任务ID（结果通过 /api/tasks/{task_id} 查询）
+
+        Args:
+            prompt: 提示词
+            images: 图像列表 (可选)
+            image_url: 单张图像URL (可选，与images二选一)
+            composition_type: 构图类型
+            layout: 布局参数
+            example_image_url: 示例图像URL（可选）
+            user_id: 用户ID
+            fingerprint: 任务内容指纹，用于结果缓存（可选）
+
+        Returns:
+            str: 任务ID
+        """
+        service = AdvancedComposeService()
+        return await service.dispatch_task(prompt, images, image_url, composition_type, layout, example_image_url, user_id, fingerprint)
+    
+    @classmethod
+    async def dispatch_advanced_batch(cls, jobs: List[Dict[str, Any]]) -> List[str]:
+        """
+        快捷方法：批量提交高级构图任务，立即返回任务ID列表
+
+        Args:
+            jobs: 任务参数列表，每项包含 prompt, images, image_url, composition_type,
+                  layout, example_image_url, user_id 以及可选的 fingerprint
+
+        Returns:
+            List[str]: 与任务一一对应的任务ID
+        """
+        service = AdvancedComposeService()
+        return await service.dispatch_batch(jobs)
+    
+    @classmethod
+    async def cancel_task(cls, task_id: str) -> bool:
+        """
+        按任务ID取消未完成的任务（用于只持有任务ID的异步模式）
+        
+        Args:
+            task_id: 任务ID
+        
+        Returns:
+            bool: 是否已取消
+        """
+        record = task_store.get(task_id)
+        if record is None:
+            return False
+        
+        for service_type in ('basic', 'advanced'):
+            service = cls.get_service(service_type)
+            if service.service_name == record['service']:
+                return await service.cancel_task({'task_id': task_id}, record['fingerprint'])
+        return False
     
     @classmethod
     def get_all_queue_info(cls) -> Dict[str, Dict[str, str]]:
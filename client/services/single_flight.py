@@ -0,0 +1,148 @@
+"""
+在途请求合并
+相同内容指纹的任务在途时，新请求复用已发出任务的结果，不再重复发送
+"""
+
+import asyncio
+import logging
+from typing import Dict, Any, Optional, Set
+
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    在途请求合并（single-flight）
+
+    功能：
+    1. 按内容指纹登记在途任务的结果 Future
+    2. 相同指纹的后续请求挂到已有 Future 上
+    3. Future 完成、超时或取消时自动移除登记
+    4. 统计合并命中/未命中次数，记录每个在途任务仍在等待的跟随者
+    """
+
+    def __init__(self):
+        """初始化"""
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # 指纹 -> 仍在等待的跟随任务ID
+        self._followers: Dict[str, Set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    def join(self, key: str, task_id: str) -> Optional[asyncio.Future]:
+        """
+        查找在途任务，命中时登记为跟随者（跟随者结束等待时调用 leave）
+
+        Args:
+            key: 任务指纹
+            task_id: 跟随任务ID
+
+        Returns:
+            asyncio.Future: 在途任务的结果 Future，没有在途任务时返回 None
+        """
+        future = self._inflight.get(key)
+        if future is None or future.done():
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._followers.setdefault(key, set()).add(task_id)
+        return future
+
+    def leave(self, key: str, task_id: str):
+        """跟随者不再等待（完成、超时或取消），可重复调用"""
+        followers = self._followers.get(key)
+        if followers is None:
+            return
+        followers.discard(task_id)
+        if not followers:
+            del self._followers[key]
+
+    def claim(self, key: str) -> asyncio.Future:
+        """
+        登记占位 Future（查找未命中后、任何 await 之前调用）
+
+        Args:
+            key: 任务指纹
+
+        Returns:
+            asyncio.Future: 占位 Future，任务发送后用 chain 接上结果
+        """
+        placeholder = asyncio.get_running_loop().create_future()
+        self.register(key, placeholder)
+        return placeholder
+
+    @staticmethod
+    def chain(placeholder: asyncio.Future, future: asyncio.Future):
+        """任务结果 Future 完成时同步到占位 Future（超时或取消时占位 Future 一并取消）"""
+        def on_done(_):
+            if placeholder.done():
+                return
+            if future.cancelled():
+                placeholder.cancel()
+            elif future.exception() is not None:
+                placeholder.set_exception(future.exception())
+            else:
+                placeholder.set_result(future.result())
+
+        future.add_done_callback(on_done)
+
+    def followers(self, key: str) -> int:
+        """在途任务仍在等待的跟随者数量（有跟随者的任务不能随发起者断开而取消）"""
+        return len(self._followers.get(key, ()))
+
+    def register(self, key: str, future: asyncio.Future):
+        """
+        登记在途任务
+
+        Args:
+            key: 任务指纹
+            future: 任务结果 Future
+        """
+        self._inflight[key] = future
+        future.add_done_callback(lambda _: self._forget(key, future))
+
+    def _forget(self, key: str, future: asyncio.Future):
+        """移除登记（只移除同一个 Future，避免误删后来登记的任务）"""
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+            self._followers.pop(key, None)
+
+    @staticmethod
+    async def follow(leader: asyncio.Future, task_id: str) -> Dict[str, Any]:
+        """
+        等待在途任务的结果，并改写为跟随任务自己的 task_id
+
+        Args:
+            leader: 在途任务的结果 Future
+            task_id: 跟随任务ID
+
+        Returns:
+            Dict: 任务结果
+
+        Raises:
+            asyncio.TimeoutError: 在途任务超时或被取消
+        """
+        # 不直接 await，避免跟随者超时或取消时连带取消在途任务
+        await asyncio.wait({leader})
+        if leader.cancelled():
+            raise asyncio.TimeoutError()
+        return dict(leader.result(), task_id=task_id, coalesced=True)
+
+    def stats(self) -> Dict[str, Any]:
+        """合并统计"""
+        total = self.hits + self.misses
+        return {
+            'inflight': len(self._inflight),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0
+        }
+
+
+# 创建全局在途请求合并实例
+single_flight = SingleFlight()
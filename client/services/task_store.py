@@ -0,0 +1,264 @@
+"""
+任务存储
+内存中保存任务状态和结果，支持 TTL 过期和 LRU 容量上限，供异步模式查询
+"""
+
+import asyncio
+import time
+import logging
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional
+
+from config import Config
+
+
+logger = logging.getLogger(__name__)
+
+
+class TaskStatus:
+    """任务状态"""
+    QUEUED = 'queued'
+    STARTED = 'started'
+    DONE = 'done'
+    FAILED = 'failed'
+    TIMEOUT = 'timeout'
+    CANCELLED = 'cancelled'
+
+    # 终态：不会再发生变化
+    FINAL = (DONE, FAILED, TIMEOUT, CANCELLED)
+
+
+class TaskStore:
+    """
+    任务存储
+
+    功能：
+    1. 记录每个任务的状态、结果和时间戳
+    2. 超过 TTL 的记录在访问或写入时淘汰
+    3. 超过容量上限时淘汰最久未访问的记录
+    4. 在后台等待任务结果并写回存储
+    5. 状态变化时推送给订阅者（用于 SSE 推送）
+    """
+
+    def __init__(self, ttl: int = None, max_size: int = None):
+        """
+        初始化任务存储
+
+        Args:
+            ttl: 记录保留时间（秒）
+            max_size: 最大记录数
+        """
+        config = Config()
+        self.ttl = ttl or config.TASK_STORE_TTL
+        self.max_size = max_size or config.TASK_STORE_MAX_SIZE
+        self._tasks: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._collectors = set()
+        self._subscribers: Dict[str, List[asyncio.Queue]] = {}
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def _is_expired(self, record: Dict[str, Any], now: float) -> bool:
+        """记录是否已过期"""
+        return now - record['updated_at'] > self.ttl
+
+    def _evict(self):
+        """淘汰过期记录和超出容量的记录"""
+        now = time.time()
+        while self._tasks:
+            record = next(iter(self._tasks.values()))
+            if len(self._tasks) > self.max_size or self._is_expired(record, now):
+                self._tasks.popitem(last=False)
+            else:
+                break
+
+    def create(self, task_id: str, service: str, user_id: str = 'anonymous',
+               fingerprint: str = None) -> Dict[str, Any]:
+        """
+        登记新任务
+
+        Args:
+            task_id: 任务ID
+            service: 服务名称
+            user_id: 用户ID
+            fingerprint: 任务内容指纹（可选，按任务ID取消时用于判断是否有其他请求在等待）
+
+        Returns:
+            Dict: 任务记录
+        """
+        now = time.time()
+        record = {
+            'task_id': task_id,
+            'service': service,
+            'user_id': user_id,
+            'fingerprint': fingerprint,
+            'status': TaskStatus.QUEUED,
+            'result': None,
+            'error': None,
+            'progress': None,
+            'created_at': now,
+            'updated_at': now
+        }
+        self._tasks[task_id] = record
+        self._tasks.move_to_end(task_id)
+        self._evict()
+        return record
+
+    def update(self, task_id: str, status: str, result: Dict[str, Any] = None,
+               error: str = None, progress: Any = None) -> Optional[Dict[str, Any]]:
+        """
+        更新任务状态
+
+        Args:
+            task_id: 任务ID
+            status: 新状态
+            result: 任务结果（可选）
+            error: 错误信息（可选）
+            progress: 进度信息（可选）
+
+        Returns:
+            Dict: 更新后的记录，任务不存在时返回 None
+        """
+        record = self._tasks.get(task_id)
+        if record is None:
+            return None
+
+        record['status'] = status
+        record['updated_at'] = time.time()
+        if result is not None:
+            record['result'] = result
+        if error is not None:
+            record['error'] = error
+        if progress is not None:
+            record['progress'] = progress
+
+        self._tasks.move_to_end(task_id)
+        self._notify(record)
+        return record
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """
+        查询任务记录
+
+        Args:
+            task_id: 任务ID
+
+        Returns:
+            Dict: 任务记录，不存在或已过期时返回 None
+        """
+        record = self._tasks.get(task_id)
+        if record is None:
+            return None
+
+        if self._is_expired(record, time.time()):
+            del self._tasks[task_id]
+            return None
+
+        self._tasks.move_to_end(task_id)
+        return record
+
+    def subscribe(self, task_id: str) -> asyncio.Queue:
+        """
+        订阅任务状态变化
+
+        Args:
+            task_id: 任务ID
+
+        Returns:
+            asyncio.Queue: 每次状态变化时放入最新的任务记录
+        """
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(task_id, []).append(queue)
+        return queue
+
+    def has_subscribers(self, task_id: str) -> bool:
+        """任务是否有订阅者"""
+        return bool(self._subscribers.get(task_id))
+
+    def unsubscribe(self, task_id: str, queue: asyncio.Queue):
+        """取消订阅"""
+        queues = self._subscribers.get(task_id)
+        if not queues:
+            return
+        if queue in queues:
+            queues.remove(queue)
+        if not queues:
+            del self._subscribers[task_id]
+
+    def _notify(self, record: Dict[str, Any]):
+        """将最新记录推送给订阅者"""
+        for queue in self._subscribers.get(record['task_id'], []):
+            queue.put_nowait(dict(record))
+
+    async def wait_final(self, task_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """
+        等待任务进入终态
+
+        Args:
+            task_id: 任务ID
+            timeout: 最长等待时间（秒）
+
+        Returns:
+            Dict: 终态记录，任务不存在或等待超时返回 None
+        """
+        queue = self.subscribe(task_id)
+        try:
+            record = self.get(task_id)
+            deadline = time.time() + timeout
+            while record is not None and record['status'] not in TaskStatus.FINAL:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                try:
+                    record = await asyncio.wait_for(queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    return None
+            return record
+        finally:
+            self.unsubscribe(task_id, queue)
+
+    def _is_cancelled(self, task_id: str) -> bool:
+        """任务是否已取消"""
+        record = self._tasks.get(task_id)
+        return record is not None and record['status'] == TaskStatus.CANCELLED
+
+    def collect(self, task_id: str, future: asyncio.Future, timeout: int) -> asyncio.Task:
+        """
+        在后台等待任务结果并写回存储
+
+        Args:
+            task_id: 任务ID
+            future: 生产者返回的结果 Future
+            timeout: 超时时间（秒）
+
+        Returns:
+            asyncio.Task: 完成时返回任务结果，超时返回 None
+        """
+        collector = asyncio.create_task(self._collect(task_id, future, timeout))
+        # 持有引用，避免后台任务被垃圾回收
+        self._collectors.add(collector)
+        collector.add_done_callback(self._collectors.discard)
+        return collector
+
+    async def _collect(self, task_id: str, future: asyncio.Future, timeout: int) -> Optional[Dict[str, Any]]:
+        """等待结果并更新状态（已取消的任务不再更新）"""
+        try:
+            result = await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            if not self._is_cancelled(task_id):
+                logger.warning(f"任务结果超时: {task_id}")
+                self.update(task_id, TaskStatus.TIMEOUT, error="任务处理超时")
+            return None
+
+        if self._is_cancelled(task_id):
+            return None
+
+        if result.get('success', True):
+            self.update(task_id, TaskStatus.DONE, result=result)
+        else:
+            self.update(task_id, TaskStatus.FAILED, result=result, error=result.get('error'))
+        return result
+
+
+# 创建全局任务存储实例
+task_store = TaskStore()
@@ -8,6 +8,10 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from services.basic_compose_service import BasicComposeService
 from services.advanced_compose_service import AdvancedComposeService
 from services.service_factory import ServiceFactory
+from services.task_store import TaskStore, TaskStatus
+from services.result_cache import ResultCache, build_fingerprint
+from services.fair_scheduler import FairScheduler, TokenBucket
+from services.single_flight import single_flight
 
 
 def test_basic_service():
@@ -94,11 +98,421 @@ def test_service_factory():
         print(f"    结果队列: {queues['result_queue']}")
 
 
+def test_task_store():
+    """测试任务存储"""
+    import asyncio
+    import time
+
+    print("\n" + "=" * 60)
+    print("测试任务存储")
+    print("=" * 60)
+
+    # 测试容量上限淘汰最久未访问的记录
+    print("\n[测试1] LRU 容量淘汰")
+    store = TaskStore(ttl=60, max_size=2)
+    store.create('t1', 'basic_compose')
+    store.create('t2', 'basic_compose')
+    store.get('t1')
+    store.create('t3', 'basic_compose')
+    print(f"剩余任务: {[t for t in ('t1', 't2', 't3') if store.get(t)]}")
+    assert store.get('t2') is None
+    assert store.get('t1') is not None and store.get('t3') is not None
+
+    # 测试过期
+    print("\n[测试2] TTL 过期")
+    store = TaskStore(ttl=60, max_size=10)
+    record = store.create('t1', 'basic_compose')
+    record['updated_at'] = time.time() - 120
+    assert store.get('t1') is None
+
+    # 测试后台收集结果
+    print("\n[测试3] 后台收集结果")
+
+    async def collect():
+        store = TaskStore(ttl=60, max_size=10)
+        loop = asyncio.get_running_loop()
+
+        store.create('done', 'basic_compose')
+        future = loop.create_future()
+        collector = store.collect('done', future, timeout=1)
+        future.set_result({'task_id': 'done', 'success': True})
+        await collector
+
+        store.create('slow', 'basic_compose')
+        await store.collect('slow', loop.create_future(), timeout=0.01)
+        return store
+
+    store = asyncio.run(collect())
+    print(f"done: {store.get('done')['status']}, slow: {store.get('slow')['status']}")
+    assert store.get('done')['status'] == TaskStatus.DONE
+    assert store.get('slow')['status'] == TaskStatus.TIMEOUT
+
+
+def test_result_cache():
+    """测试结果缓存"""
+    import tempfile
+
+    print("\n" + "=" * 60)
+    print("测试结果缓存")
+    print("=" * 60)
+
+    # 指纹与参数顺序无关的字典内容一致
+    print("\n[测试1] 内容指纹")
+    assert build_fingerprint('basic', {'a': 1, 'b': 2}) == build_fingerprint('basic', {'b': 2, 'a': 1})
+    assert build_fingerprint('basic', 'x') != build_fingerprint('basic', 'y')
+
+    # 测试命中、过期与磁盘层
+    print("\n[测试2] 命中与磁盘层")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = ResultCache(ttl=60, max_size=1, cache_dir=cache_dir)
+        cache.set('k1', {'success': True, 'image_urls': ['a']})
+        cache.set('k2', {'success': True, 'image_urls': ['b']})
+        assert len(cache) == 1
+        # k1 已被内存层淘汰，从磁盘层读回
+        assert cache.get('k1')['image_urls'] == ['a']
+        assert cache.get('missing') is None
+
+        # 磁盘层超过条目上限时删除最久未访问的文件
+        cache = ResultCache(ttl=60, max_size=1, cache_dir=cache_dir, max_disk_entries=2)
+        assert cache.stats()['disk_size'] == 2
+        cache.set('k3', {'success': True, 'image_urls': ['c']})
+        assert cache.stats()['disk_size'] == 2
+        assert cache.get('k1') is None
+
+        # 事件循环中读取磁盘层
+        import asyncio
+        assert asyncio.run(cache.aget('k2'))['image_urls'] == ['b']
+
+        cache = ResultCache(ttl=-1, max_size=10, cache_dir='')
+        cache.set('k1', {'success': True})
+        assert cache.get('k1') is None
+        print(f"统计: {cache.stats()}")
+
+
+
+def test_fair_scheduler():
+    """测试公平调度"""
+    import asyncio
+
+    print("\n" + "=" * 60)
+    print("测试公平调度")
+    print("=" * 60)
+
+    # 测试令牌桶突发上限
+    print("\n[测试1] 令牌桶")
+    bucket = TokenBucket(rate=1, capacity=2)
+    assert bucket.try_take() and bucket.try_take()
+    assert not bucket.try_take()
+    assert 0 < bucket.wait_time() <= 1
+
+    # 测试加权轮询：权重 2 的用户每轮连续发送 2 个任务
+    print("\n[测试2] 加权轮询")
+
+    async def select():
+        scheduler = FairScheduler()
+        scheduler.rate_limit_enabled = False
+        scheduler.weights = {'vip': 2}
+        jobs = [{'task_id': f"{user}_{i}", 'user_id': user} for user in ('a', 'vip') for i in range(4)]
+        await scheduler.submit('queue', 'result', jobs)
+        selected = [job['task_data']['user_id'] for job in scheduler._select(6)]
+        await scheduler.stop()
+        return selected
+
+    order = asyncio.run(select())
+    print(f"发送顺序: {order}")
+    assert order == ['a', 'vip', 'vip', 'a', 'vip', 'vip']
+
+    # 测试准入控制计入本地排队的任务，空闲用户的令牌桶被清理
+    print("\n[测试3] 准入控制与令牌桶清理")
+    from services.admission import AdmissionController, AdmissionRejected
+
+    async def admit():
+        scheduler = FairScheduler()
+        scheduler.max_inflight = 1
+        controller = AdmissionController()
+        controller.max_loop_lag = controller.max_queue_depth = 0
+        controller.max_inflight = 3
+        controller.attach_scheduler(scheduler)
+
+        await scheduler.submit('queue', 'result', [{'task_id': f"t{i}", 'user_id': 'a'} for i in range(3)])
+        try:
+            await controller.check('queue')
+            rejected = False
+        except AdmissionRejected:
+            rejected = True
+        await scheduler.stop()
+
+        scheduler._bucket('idle')
+        scheduler._buckets_pruned_at -= scheduler.BUCKET_PRUNE_INTERVAL
+        scheduler._prune_buckets()
+        return rejected, controller.backlog, list(scheduler._buckets)
+
+    rejected, backlog, buckets = asyncio.run(admit())
+    print(f"拒绝: {rejected}, 排队: {backlog}, 令牌桶: {buckets}")
+    assert rejected
+    assert 'idle' not in buckets
+
+    # 匿名任务按客户端地址分别排队，任务数据中的 user_id 不变
+    print("\n[测试4] 匿名任务按客户端地址调度")
+    from services.fair_scheduler import client_address
+
+    async def anonymous():
+        scheduler = FairScheduler()
+        scheduler.rate_limit_enabled = False
+        jobs = []
+        for address in ('10.0.0.1', '10.0.0.2'):
+            client_address.set(address)
+            job = {'task_id': f"anon_{address}", 'user_id': 'anonymous'}
+            await scheduler.submit('queue', 'result', [job])
+            jobs.append(job)
+        users = sorted(scheduler._backlogs)
+        await scheduler.stop()
+        return users, [job['user_id'] for job in jobs]
+
+    users, wire_user_ids = asyncio.run(anonymous())
+    print(f"调度用户: {users}")
+    assert users == ['anonymous:10.0.0.1', 'anonymous:10.0.0.2']
+    assert wire_user_ids == ['anonymous', 'anonymous']
+
+
+
+def test_single_flight():
+    """测试在途请求合并"""
+    import asyncio
+    import uuid
+    from services import base_service
+
+    print("\n" + "=" * 60)
+    print("测试在途请求合并")
+    print("=" * 60)
+
+    # 准入检查期间到达的相同请求也应合并，只发送一次
+    print("\n[测试1] 并发相同请求")
+
+    async def dispatch_twice():
+        loop = asyncio.get_running_loop()
+        futures = []
+
+        async def check(queue_name, count=1):
+            await asyncio.sleep(0.01)
+
+        async def submit(queue_name, result_queue, task_data_list, on_progress=None):
+            futures.extend(loop.create_future() for _ in task_data_list)
+            return futures[-len(task_data_list):]
+
+        original = (base_service.admission_controller.check, base_service.fair_scheduler.submit)
+        base_service.admission_controller.check = check
+        base_service.fair_scheduler.submit = submit
+        try:
+            service = BasicComposeService()
+            fingerprint = uuid.uuid4().hex
+            hits = single_flight.hits
+            tasks = [service.build_task_data('p', 'https://example.com/a.jpg') for _ in range(2)]
+            waiters = await asyncio.gather(*[service.dispatch(task, timeout=1, fingerprint=fingerprint) for task in tasks])
+
+            futures[0].set_result({'success': True, 'image_url': 'x'})
+            results = await asyncio.gather(*waiters)
+            return len(futures), single_flight.hits - hits, results
+        finally:
+            base_service.admission_controller.check, base_service.fair_scheduler.submit = original
+
+    published, hits, results = asyncio.run(dispatch_twice())
+    print(f"发送次数: {published} (应为 1), 合并次数: {hits}")
+    assert published == 1 and hits == 1
+    assert [result['image_url'] for result in results] == ['x', 'x']
+    assert results[1].get('coalesced')
+
+    # 跟随者超时或断开后不再计入，发起者随后断开时在途任务被取消
+    print("\n[测试2] 跟随者离开后发起者断开")
+
+    async def leader_after_followers_left():
+        loop = asyncio.get_running_loop()
+        cancelled = []
+
+        async def check(queue_name, count=1):
+            pass
+
+        async def submit(queue_name, result_queue, task_data_list, on_progress=None):
+            return [loop.create_future() for _ in task_data_list]
+
+        scheduler = base_service.fair_scheduler
+        original = (base_service.admission_controller.check, scheduler.submit, scheduler.is_queued, scheduler.cancel)
+        base_service.admission_controller.check = check
+        scheduler.submit = submit
+        scheduler.is_queued = lambda task_id: task_id == leader['task_id']
+        scheduler.cancel = cancelled.append
+        try:
+            service = BasicComposeService()
+            fingerprint = uuid.uuid4().hex
+            leader, slow, gone = [service.build_task_data('p', 'https://example.com/b.jpg') for _ in range(3)]
+            await service.dispatch(leader, timeout=5, fingerprint=fingerprint)
+            slow_waiter = await service.dispatch(slow, timeout=0.01, fingerprint=fingerprint)
+            await service.dispatch(gone, timeout=5, fingerprint=fingerprint)
+            assert single_flight.followers(fingerprint) == 2
+
+            await slow_waiter
+            await service.cancel_task(gone, fingerprint)
+            followers = single_flight.followers(fingerprint)
+            return followers, await service.cancel_task(leader, fingerprint), cancelled == [leader['task_id']]
+        finally:
+            (base_service.admission_controller.check, scheduler.submit,
+             scheduler.is_queued, scheduler.cancel) = original
+
+    followers, leader_cancelled, unqueued = asyncio.run(leader_after_followers_left())
+    print(f"剩余跟随者: {followers} (应为 0), 发起者已取消: {leader_cancelled}")
+    assert followers == 0 and leader_cancelled and unqueued
+
+
+def test_disconnect_cancel():
+    """测试客户端断开后取消任务（经过 main.app 的中间件和接口）"""
+    import asyncio
+    import json
+    import pytest
+    from config import Config
+    from services import base_service
+    from services.task_store import task_store
+
+    print("\n" + "=" * 60)
+    print("测试客户端断开后取消任务")
+    print("=" * 60)
+
+    try:
+        import main
+    except (ImportError, ValueError) as e:
+        # main.py 需要 mediapipe 等运行依赖和 COS 配置
+        pytest.skip(f"无法加载 main.py: {e}")
+
+    # 请求体读完后客户端断开，/api/basic/compose 通过 request.is_disconnected() 感知并取消排队中的任务
+    print("\n[测试1] 同步模式请求断开")
+
+    async def request_then_disconnect():
+        loop = asyncio.get_running_loop()
+        submitted = []
+        cancelled = []
+        responses = []
+
+        async def check(queue_name, count=1):
+            pass
+
+        async def submit(queue_name, result_queue, task_data_list, on_progress=None):
+            submitted.extend(task_data['task_id'] for task_data in task_data_list)
+            return [loop.create_future() for _ in task_data_list]
+
+        disconnected = asyncio.Event()
+        body = json.dumps({'image_url': 'https://example.com/a.jpg', 'no_cache': True}).encode('utf-8')
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            responses.append(message)
+
+        scheduler = base_service.fair_scheduler
+        original = (base_service.admission_controller.check, scheduler.submit, scheduler.is_queued,
+                    scheduler.cancel, Config.DISCONNECT_POLL_INTERVAL)
+        base_service.admission_controller.check = check
+        scheduler.submit = submit
+        scheduler.is_queued = lambda task_id: True
+        scheduler.cancel = cancelled.append
+        Config.DISCONNECT_POLL_INTERVAL = 0.01
+        try:
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+                'method': 'POST', 'scheme': 'http', 'path': '/api/basic/compose', 'raw_path': b'/api/basic/compose',
+                'query_string': b'', 'root_path': '', 'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+            }
+            request = asyncio.create_task(main.app(scope, receive, send))
+            await asyncio.sleep(0.1)
+            disconnected.set()
+            await asyncio.wait_for(request, timeout=2)
+            return submitted, cancelled, responses
+        finally:
+            (base_service.admission_controller.check, scheduler.submit, scheduler.is_queued,
+             scheduler.cancel, Config.DISCONNECT_POLL_INTERVAL) = original
+
+    submitted, cancelled, responses = asyncio.run(request_then_disconnect())
+    assert len(submitted) == 1
+    task_id = submitted[0]
+    status = task_store.get(task_id)['status']
+    print(f"任务状态: {status} (应为 cancelled)")
+    assert status == TaskStatus.CANCELLED
+    assert cancelled == [task_id]
+    # 响应仍经过摄像头权限中间件
+    start = next(message for message in responses if message['type'] == 'http.response.start')
+    assert (b'permissions-policy', b'camera=(self), microphone=(self)') in start['headers']
+
+
+def test_cos_multipart():
+    """测试 COS 分块上传"""
+    import io
+    import hashlib
+    import pytest
+
+    print("\n" + "=" * 60)
+    print("测试 COS 分块上传")
+    print("=" * 60)
+
+    try:
+        from services.cos_service import cos_service
+    except ValueError as e:
+        pytest.skip(f"COS 未配置: {e}")
+
+    class FakeClient:
+        """记录分块上传请求的 COS 客户端"""
+
+        def __init__(self):
+            self.parts = []
+
+        def create_multipart_upload(self, Bucket, Key, **headers):
+            return {'UploadId': 'upload'}
+
+        def upload_part(self, Bucket, Key, Body, PartNumber, UploadId, ContentMD5):
+            self.parts.append((PartNumber, len(Body)))
+            return {'ETag': f'"part{PartNumber}"'}
+
+        def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+            return {'ETag': '"done"', 'parts': len(MultipartUpload['Part'])}
+
+        def abort_multipart_upload(self, Bucket, Key, UploadId):
+            pass
+
+    # 超过阈值的文件分块上传；已知 MD5（内容寻址模式）时直接使用，不再重新计算
+    print("\n[测试1] 超过阈值分块上传")
+    original = (cos_service.client, cos_service.upload_config)
+    cos_service.client = FakeClient()
+    cos_service.upload_config = dict(
+        original[1], multipart={'threshold': 1024 * 1024, 'part_size': 1024 * 1024, 'concurrency': 2}
+    )
+    try:
+        data = os.urandom(2 * 1024 * 1024 + 100)
+        response, md5_hash = cos_service._put_stream(io.BytesIO(data), len(data), 'temp/large.bin')
+        assert response['parts'] == 3
+        assert sorted(cos_service.client.parts) == [(1, 1024 * 1024), (2, 1024 * 1024), (3, 100)]
+        assert md5_hash == hashlib.md5(data).hexdigest()
+
+        _, reused = cos_service._put_stream(io.BytesIO(data), len(data), 'temp/large.bin', 'known')
+        assert reused == 'known'
+        print(f"分块数: {response['parts']}, MD5: {md5_hash}")
+    finally:
+        cos_service.client, cos_service.upload_config = original
+
+
 if __name__ == '__main__':
     try:
         test_basic_service()
         test_advanced_service()
         test_service_factory()
+        test_task_store()
+        test_result_cache()
+        test_fair_scheduler()
+        test_single_flight()
+        test_disconnect_cancel()
+        test_cos_multipart()
         
         print("\n" + "=" * 60)
         print("所有测试完成！")